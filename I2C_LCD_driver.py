@@ -21,28 +21,50 @@ I2CBUS = 1
 # LCD Address
 ADDRESS = 0x27
 
-import smbus
-from time import sleep
+# smbus2 adds i2c_rdwr, which sends a whole byte sequence in one transaction
+try:
+   import smbus2 as smbus
+   from smbus2 import i2c_msg
+except ImportError:
+   try:
+      import smbus
+   except ImportError:
+      # only needed to open the real bus, the encoders work without it
+      smbus = None
+   i2c_msg = None
+import hal
 
 class i2c_device:
    def __init__(self, addr, port=I2CBUS):
       self.addr = addr
-      self.bus = smbus.SMBus(port)
+      # a bus registered with the hal (e.g. a FakeSMBus) stands in for the real one
+      self.bus = hal.i2c_buses[port] if port in hal.i2c_buses else smbus.SMBus(port)
 
 # Write a single command
    def write_cmd(self, cmd):
       self.bus.write_byte(self.addr, cmd)
-      sleep(0.0001)
+      hal.clock.sleep(0.0001)
 
 # Write a command and argument
    def write_cmd_arg(self, cmd, data):
       self.bus.write_byte_data(self.addr, cmd, data)
-      sleep(0.0001)
+      hal.clock.sleep(0.0001)
 
 # Write a block of data
    def write_block_data(self, cmd, data):
       self.bus.write_block_data(self.addr, cmd, data)
-      sleep(0.0001)
+      hal.clock.sleep(0.0001)
+
+# Write a sequence of bytes in as few transactions as the bus allows. The
+# PCF8574 latches every byte it receives, so bus clocking (about 90us per
+# byte at 100kHz) spaces the lcd writes instead of sleeps.
+   def write_bytes(self, data):
+      if i2c_msg is not None:
+         self.bus.i2c_rdwr(i2c_msg.write(self.addr, data))
+         return
+      # SMBus i2c block writes: a command byte plus up to 32 data bytes
+      for start in range(0, len(data), 33):
+         self.bus.write_i2c_block_data(self.addr, data[start], list(data[start + 1:start + 33]))
 
 # Read a single byte
    def read(self):
@@ -103,6 +125,20 @@ En = 0b00000100 # Enable bit
 Rw = 0b00000010 # Read/Write bit
 Rs = 0b00000001 # Register select bit
 
+# DDRAM address of the first character of each line on a 20x4 display
+LCD_ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+
+# bytes clocking one value into the lcd as two nibbles (data, EN high, EN low)
+def lcd_write_sequence(value, mode=0):
+   sequence = bytearray()
+   for nibble in (value & 0xF0, (value << 4) & 0xF0):
+      data = mode | nibble | LCD_BACKLIGHT
+      sequence += bytes((data, data | En, data & ~En))
+   return bytes(sequence)
+
+# lcd_write_sequence for every value, indexed [mode][value] with mode 0 or Rs
+LCD_WRITE_SEQUENCES = (tuple(lcd_write_sequence(value) for value in range(256)), tuple(lcd_write_sequence(value, Rs) for value in range(256)))
+
 class lcd:
    #initializes objects and lcd
    def __init__(self):
@@ -117,15 +153,15 @@ class lcd:
       self.lcd_write(LCD_DISPLAYCONTROL | LCD_DISPLAYON)
       self.lcd_write(LCD_CLEARDISPLAY)
       self.lcd_write(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
-      sleep(0.2)
+      hal.clock.sleep(0.2)
 
 
    # clocks EN to latch command
    def lcd_strobe(self, data):
       self.lcd_device.write_cmd(data | En | LCD_BACKLIGHT)
-      sleep(.0005)
+      hal.clock.sleep(.0005)
       self.lcd_device.write_cmd(((data & ~En) | LCD_BACKLIGHT))
-      sleep(.0001)
+      hal.clock.sleep(.0001)
 
    def lcd_write_four_bits(self, data):
       self.lcd_device.write_cmd(data | LCD_BACKLIGHT)
@@ -142,21 +178,18 @@ class lcd:
       self.lcd_write_four_bits(mode | (charvalue & 0xF0))
       self.lcd_write_four_bits(mode | ((charvalue << 4) & 0xF0))
   
+   # byte sequence positioning the cursor and writing string
+   def lcd_encode_string(self, string, line=1, pos=0):
+      characters = LCD_WRITE_SEQUENCES[Rs]
+      return LCD_WRITE_SEQUENCES[0][LCD_SETDDRAMADDR + LCD_ROW_OFFSETS[line - 1] + pos] + b''.join(characters[ord(char) & 0xFF] for char in string)
+
+   # send a precomputed byte sequence in one bus transaction
+   def lcd_write_sequence(self, sequence):
+      self.lcd_device.write_bytes(sequence)
+
    # put string function with optional char positioning
    def lcd_display_string(self, string, line=1, pos=0):
-    if line == 1:
-      pos_new = pos
-    elif line == 2:
-      pos_new = 0x40 + pos
-    elif line == 3:
-      pos_new = 0x14 + pos
-    elif line == 4:
-      pos_new = 0x54 + pos
-
-    self.lcd_write(0x80 + pos_new)
-
-    for char in string:
-      self.lcd_write(ord(char), Rs)
+      self.lcd_write_sequence(self.lcd_encode_string(string, line, pos))
 
    # clear lcd and set to home
    def lcd_clear(self):
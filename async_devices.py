@@ -0,0 +1,100 @@
+import asyncio
+import concurrent.futures
+import hal
+
+# Each device gets a single worker thread, so its blocking calls run in the
+# order they were awaited and never overlap, while the event loop stays free
+class AsyncDevice:
+    def __init__(self, device, name):
+        self.device = device
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+# Wraps an LcdFramebuffer or LcdRenderer, which offer the lcd drawing
+# methods plus show()
+class AsyncLcd(AsyncDevice):
+    def __init__(self, lcd):
+        AsyncDevice.__init__(self, lcd, 'lcd')
+
+    async def lcd_clear(self):
+        await self.run(self.device.lcd_clear)
+
+    async def lcd_display_string(self, string, line = 1, pos = 0):
+        await self.run(self.device.lcd_display_string, string, line, pos)
+
+    # lines: (string, line, pos) tuples for show()
+    async def show(self, *lines):
+        await self.run(self.device.show, *lines)
+
+    # screen: (frame, burst) from ScreenRegistry.render
+    async def show_screen(self, screen):
+        await self.run(self.device.show_screen, screen)
+
+# keypad events are read in short slices so a cancelled wait frees the
+# executor quickly
+class AsyncKeypad(AsyncDevice):
+    def __init__(self, keypad, slice_time = .1):
+        AsyncDevice.__init__(self, keypad, 'keypad')
+        self.slice_time = slice_time
+
+    async def pressed_keys(self):
+        return await self.run(self.device.pressed_keys)
+
+    async def clear_events(self):
+        await self.run(self.device.clear_events)
+
+    # Returns the next press found in valid_keys
+    async def get_key(self, valid_keys):
+        while True:
+            key = await self.run(self.device.get_key, valid_keys, self.slice_time)
+            if key is not None:
+                return key
+
+class AsyncePort(AsyncDevice):
+    def __init__(self, eport, watcher):
+        AsyncDevice.__init__(self, eport, 'ePort')
+        self.watcher = watcher
+
+    async def send_command(self, command, data = []):
+        return await self.run(self.device.send_command, command, data)
+
+    # Sends command (if any) and returns the first status event with one of
+    # codes, or None if the command is not acknowledged; the watcher
+    # registration is dropped if the caller is cancelled
+    async def wait_status(self, codes, command = None, data = []):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def resolve(event):
+            if not future.done():
+                future.set_result(event)
+        waiter = self.watcher.expect(codes)
+        waiter.add_done_callback(lambda event: loop.call_soon_threadsafe(resolve, event))
+        try:
+            if command is not None:
+                response = await self.send_command(command, data)
+                if response[1] != 'ACK':
+                    return None
+            return await future
+        finally:
+            self.watcher.cancel(waiter)
+
+class AsyncRoboclaw(AsyncDevice):
+    def __init__(self, roboclaw):
+        AsyncDevice.__init__(self, roboclaw, 'roboclaw')
+
+    # Telemetry sampling keeps running on its own thread during the motion
+    async def execute_buffered_commands_with_logging(self, address, commands, on_commands_sent = None, motion_timeout = None):
+        def execute():
+            self.device.execute_buffered_commands_with_logging(address, commands, on_commands_sent = on_commands_sent, motion_timeout = motion_timeout)
+        await self.run(execute)
+
+# Waits for a threading.Event without parking an executor thread forever
+async def wait_threading_event(event, poll_interval = .05):
+    loop = asyncio.get_running_loop()
+    while not await loop.run_in_executor(None, hal.clock.wait, event, poll_interval):
+        pass
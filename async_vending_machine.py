@@ -0,0 +1,171 @@
+import asyncio
+import collections
+import math
+import threading
+import hal
+from ePort import ePort, ePortCRCError, ePortTimeoutError
+from async_devices import AsyncLcd, AsyncKeypad, AsyncePort, AsyncRoboclaw, wait_threading_event
+from roboclaw_zwv import RoboclawMotionTimeoutError
+from vending_machine import Vending_Machine, log_directory, products, prices, amounts, amount_descriptions, confirmations, roboclaw_address, dispense_motion_timeout, thank_you_min_time, thank_you_max_time, ePort_ready_timeout, out_of_service_time
+
+# Vend flow states
+SELECT_PRODUCT = 'select_product'
+SELECT_AMOUNT = 'select_amount'
+CONFIRM = 'confirm'
+AUTHORIZE = 'authorize'
+DISPENSE = 'dispense'
+THANK_YOU = 'thank_you'
+FAILED = 'failed'
+
+# Seconds each state may take (None waits forever) and the state entered when it runs out
+STATE_TIMEOUTS = {
+                    SELECT_PRODUCT: None,
+                    SELECT_AMOUNT: 30,
+                    CONFIRM: 30,
+                    AUTHORIZE: 45,
+                    DISPENSE: 60,
+                    THANK_YOU: thank_you_max_time + 1,
+                    FAILED: None
+                 }
+TIMEOUT_STATES = {
+                    SELECT_AMOUNT: SELECT_PRODUCT,
+                    CONFIRM: SELECT_PRODUCT,
+                    AUTHORIZE: SELECT_PRODUCT,
+                    DISPENSE: FAILED,
+                    THANK_YOU: SELECT_PRODUCT
+                 }
+
+# Vending_Machine driven by an asyncio state machine. Device calls run on
+# per-device executor threads, ePort status arrives as watcher events, so
+# no device waits on another.
+class Async_Vending_Machine(Vending_Machine):
+    def __init__(self, log_directory = log_directory):
+        Vending_Machine.__init__(self, log_directory)
+        self.async_lcd = AsyncLcd(self.display)
+        self.async_keypad = AsyncKeypad(self.keypad)
+        self.async_ePort = AsyncePort(self.ePort, self.ePort_watcher)
+        self.async_roboclaw = AsyncRoboclaw(self.roboclaw)
+        self.state = SELECT_PRODUCT
+        self.state_history = collections.deque(maxlen=1000)
+        self._handlers = {
+                            SELECT_PRODUCT: self._select_product,
+                            SELECT_AMOUNT: self._select_amount,
+                            CONFIRM: self._confirm,
+                            AUTHORIZE: self._authorize,
+                            DISPENSE: self._dispense,
+                            THANK_YOU: self._thank_you,
+                            FAILED: self._failed
+                         }
+
+    async def _select_product(self):
+        await self.async_keypad.clear_events()
+        await self.async_lcd.show_screen(self.screens.render('select_product'))
+        self.product_selection = await self.async_keypad.get_key(products)
+        self.begin_time = hal.clock.monotonic()
+        return SELECT_AMOUNT
+
+    async def _select_amount(self):
+        await self.async_lcd.show_screen(self.screens.render('select_amount'))
+        self.amount_selection = await self.async_keypad.get_key(amounts)
+        self.selection_price = math.ceil(100 * prices[self.product_selection] * amounts[self.amount_selection])
+        return CONFIRM
+
+    async def _confirm(self):
+        await self.async_keypad.clear_events()
+        await self.async_lcd.show_screen(self.screens.render('confirm',
+                                                             amount = amount_descriptions[self.amount_selection] + ' of ',
+                                                             product = products[self.product_selection],
+                                                             price = f'${self.selection_price/100:0.2f}'))
+        if await self.async_keypad.get_key(confirmations) != '1':
+            return SELECT_PRODUCT
+        return AUTHORIZE
+
+    async def _authorize(self):
+        if not self.ePort_ready.is_set():
+            await self.async_lcd.show_screen(self.screens.render('please_wait'))
+            self._rearm_ePort_in_background()
+            try:
+                await asyncio.wait_for(wait_threading_event(self.ePort_ready), hal.clock.timeout(ePort_ready_timeout))
+            except asyncio.TimeoutError:
+                await self.async_lcd.show_screen(self.screens.render('out_of_service'))
+                await asyncio.sleep(hal.clock.timeout(out_of_service_time))
+                return SELECT_PRODUCT
+        authorized = False
+        try:
+            status, _ = await asyncio.gather(self.async_ePort.wait_status(("2", "3"), ePort.AUTH_REQ, [str(self.selection_price)]),
+                                             self.async_lcd.show_screen(self.screens.render('swipe_card')))
+            authorized = status is not None and status.code == "2"
+        except (ePortTimeoutError, ePortCRCError):
+            # wait_status has cancelled its waiter, re-armed below
+            pass
+        finally:
+            if not authorized:
+                self._rearm_ePort_in_background()
+        if not authorized:
+            return SELECT_PRODUCT
+        self.authorized_time = hal.clock.monotonic()
+        self.sale_id = self.journal.record_sale(products[self.product_selection], amount_descriptions[self.amount_selection], self.selection_price)
+        return DISPENSE
+
+    async def _dispense(self):
+        await self.async_lcd.show_screen(self.screens.render('dispensing'))
+        self.commands_sent = threading.Event()
+        self.dispense_error = None
+        sale_id = self.sale_id
+        def settle():
+            self.commands_sent.set()
+            self._settle_sale(sale_id)
+        # A timeout abandons the wait, not the motion already queued
+        try:
+            await asyncio.shield(self.async_roboclaw.execute_buffered_commands_with_logging(roboclaw_address, self._dispense_commands(), settle, dispense_motion_timeout))
+        except RoboclawMotionTimeoutError as error:
+            self.jams += 1
+            self.journal.mark_dispense_error(sale_id, str(error))
+            return FAILED
+        except Exception as error:
+            # As in Vending_Machine._dispense_product, a failure after
+            # settlement started is handled as a jam
+            if self.commands_sent.is_set():
+                self.journal.mark_dispense_error(sale_id, str(error))
+                await self.async_roboclaw.run(self._stop_motor)
+            self.dispense_error = str(error)
+            return FAILED
+        self.dispensed_time = hal.clock.monotonic()
+        return THANK_YOU
+
+    async def _thank_you(self):
+        await self.async_lcd.show_screen(self.screens.render('thank_you'))
+        await asyncio.sleep(hal.clock.timeout(thank_you_min_time - (hal.clock.monotonic() - self.dispensed_time)))
+        try:
+            await asyncio.wait_for(wait_threading_event(self.ePort_ready), hal.clock.timeout(thank_you_max_time - (hal.clock.monotonic() - self.dispensed_time)))
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.get_running_loop().run_in_executor(None, self._end_cycle, self.begin_time, self.authorized_time, self.dispensed_time)
+        return SELECT_PRODUCT
+
+    async def _failed(self):
+        if not self.commands_sent.is_set():
+            self.journal.mark_dispensed(self.sale_id, False, self.dispense_error)
+            self._rearm_ePort_in_background()
+        await self.async_lcd.show_screen(self.screens.render('purchase_failed'))
+        await asyncio.sleep(hal.clock.timeout(5))
+        return SELECT_PRODUCT
+
+    async def run_state(self, state):
+        try:
+            return await asyncio.wait_for(self._handlers[state](), hal.clock.timeout(STATE_TIMEOUTS[state]))
+        except asyncio.TimeoutError:
+            return TIMEOUT_STATES[state]
+
+    async def vend_loop_async(self):
+        while True:
+            self.state_history.append((hal.clock.monotonic(), self.state))
+            self.state = await self.run_state(self.state)
+
+    def vend_loop(self):
+        asyncio.run(self.vend_loop_async())
+
+
+if __name__ == '__main__':
+    _vending_machine = Async_Vending_Machine()
+    _vending_machine.vend_loop()
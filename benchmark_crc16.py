@@ -0,0 +1,45 @@
+import os
+import timeit
+from crc16 import crc16, crc16_update
+
+# Per-frame CRC cost of the old bit-loop implementation (as it was in
+# Roboclaw.crc_update), a byte-at-a-time table lookup and the whole-buffer
+# crc16() call.
+
+iterations = 20000
+
+frames = {
+            'ReadEncM1 request + reply (7 bytes)': bytes([0x80, 16]) + os.urandom(5),
+            'SpeedDistanceM1 (11 bytes)': bytes([0x80, 41]) + os.urandom(9),
+            'SpeedAccelDistanceM1M2 (23 bytes)': bytes([0x80, 46]) + os.urandom(21),
+            'ePort AUTH_REQ (8 bytes)': b'21\x1e1000'
+         }
+
+def crc_bitwise(data, crc=0):
+    for byte in data:
+        crc = crc ^ (byte << 8)
+        for bit in range(0, 8):
+            if (crc&0x8000) == 0x8000:
+                crc = ((crc << 1) ^ 0x1021)
+            else:
+                crc = crc << 1
+    return crc & 0xFFFF
+
+def crc_table_per_byte(data, crc=0):
+    for byte in data:
+        crc = crc16_update(crc, byte)
+    return crc
+
+def benchmark(function, data):
+    return timeit.timeit(lambda: function(data), number=iterations) / iterations * 1e6
+
+if __name__ == '__main__':
+    for name, data in frames.items():
+        assert crc_bitwise(data) == crc_table_per_byte(data) == crc16(data)
+        bitwise = benchmark(crc_bitwise, data)
+        per_byte = benchmark(crc_table_per_byte, data)
+        whole = benchmark(crc16, data)
+        print(name)
+        print(f"  bit loop       : {bitwise:8.2f} us/frame")
+        print(f"  table per byte : {per_byte:8.2f} us/frame ({bitwise/per_byte:5.1f}x)")
+        print(f"  crc16 buffer   : {whole:8.2f} us/frame ({bitwise/whole:5.1f}x)")
@@ -0,0 +1,64 @@
+import statistics
+import threading
+import time
+from gpio_backend import FakeGPIO
+from keypad import keypad, POLL, INTERRUPT
+from lcd_framebuffer import LcdFramebuffer
+from lcd_renderer import LcdRenderer
+from benchmark_lcd import fake_lcd
+
+# Idle CPU use and key-to-screen latency of the polling and edge-interrupt
+# keypad modes, on FakeGPIO with the LCD renderer drawing to the fake bus.
+# Latency runs from the switch closing until the screen naming the key is
+# on the (fake) glass.
+
+idle_seconds = 2
+presses = 50
+hold_time = .05
+gap_time = .05
+
+def press(gpio, pad, key, press_times):
+    row, col = [(row, col) for row in range(4) for col in range(3) if pad.keys[row][col] == key][0]
+    press_times.append(time.monotonic())
+    gpio.connect(pad.rows[row], pad.columns[col])
+    time.sleep(hold_time)
+    gpio.disconnect(pad.rows[row], pad.columns[col])
+    time.sleep(gap_time)
+
+def benchmark(mode):
+    gpio = FakeGPIO()
+    pad = keypad(mode = mode, gpio = gpio)
+    renderer = LcdRenderer(LcdFramebuffer(fake_lcd()))
+    renderer.start()
+    pad.start()
+
+    calls = dict(gpio.calls)
+    cpu_time = time.process_time()
+    time.sleep(idle_seconds)
+    cpu_time = time.process_time() - cpu_time
+    idle_calls = {name: gpio.calls[name] - calls[name] for name in calls}
+
+    keys = '123456789*0#'
+    press_times = []
+    presser = threading.Thread(target=lambda: [press(gpio, pad, keys[index % len(keys)], press_times) for index in range(presses)])
+    presser.start()
+    latencies = []
+    for index in range(presses):
+        key = pad.get_key(timeout = 1)
+        renderer.show((f"Key {key}", 2, 0))
+        renderer.flush()
+        latencies.append(time.monotonic() - press_times[index])
+    presser.join()
+    pad.stop()
+    renderer.stop()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(mode)
+    print(f"  idle CPU          : {cpu_time / idle_seconds * 100:6.2f} % of one core")
+    print(f"  idle GPIO calls   : {sum(idle_calls.values()) / idle_seconds:8.0f} per second")
+    print(f"  key-to-screen p50 : {quantiles[49] * 1e3:6.2f} ms")
+    print(f"  key-to-screen p99 : {quantiles[98] * 1e3:6.2f} ms")
+
+if __name__ == '__main__':
+    benchmark(POLL)
+    benchmark(INTERRUPT)
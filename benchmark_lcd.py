@@ -0,0 +1,72 @@
+import time
+from I2C_LCD_driver import lcd, i2c_device, ADDRESS, Rs
+from lcd_framebuffer import LcdFramebuffer
+from hal_fakes import FakeSMBus
+
+# Full-screen redraw cost of the old per-nibble write path (three write_byte
+# calls and two sleeps per nibble), the batched lcd_display_string and the
+# diffing framebuffer, against a fake bus that decodes what the HD44780
+# would see. Bus time is modelled from the bits clocked at I2C_CLOCK plus
+# the clear/home execution time the controller needs.
+
+I2C_CLOCK = 100000
+iterations = 20
+
+screens = [
+            [("Please select", 2, 5), ("product", 3, 6)],
+            [("1: 1/2 cup", 1, 4), ("2: 1 cup", 2, 4), ("3: 1 1/2 cup", 3, 4), ("4: 2 cups", 4, 4)],
+            [("1 cup of ", 1, 0), ("Lucky Charms", 2, 0), ("$2.00", 3, 0), ("1-confirm 2-cancel", 4, 0)],
+            [("Thank you for ", 2, 3), ("your purchase!", 3, 3)]
+          ]
+
+def fake_lcd():
+    device = i2c_device.__new__(i2c_device)
+    device.addr = ADDRESS
+    device.bus = FakeSMBus()
+    display = lcd.__new__(lcd)
+    display.lcd_device = device
+    return display
+
+def expected_screen(lines):
+    rows = [[' '] * 20 for row in range(4)]
+    for string, line, pos in lines:
+        rows[line - 1][pos:pos + len(string)] = string
+    return [''.join(row) for row in rows]
+
+# lcd_display_string as it was before the batched write path
+def draw_per_nibble(display, lines):
+    display.lcd_clear()
+    for string, line, pos in lines:
+        display.lcd_write(0x80 + (0x00, 0x40, 0x14, 0x54)[line - 1] + pos)
+        for char in string:
+            display.lcd_write(ord(char), Rs)
+
+def draw_batched(display, lines):
+    display.lcd_clear()
+    for line in lines:
+        display.lcd_display_string(*line)
+
+def benchmark(name, draw):
+    display = fake_lcd()
+    bus = display.lcd_device.bus
+    begin_time = time.perf_counter()
+    for iteration in range(iterations):
+        for lines in screens:
+            draw(display, lines)
+            assert bus.screen() == expected_screen(lines), bus.screen()
+    redraws = iterations * len(screens)
+    wall = (time.perf_counter() - begin_time) / redraws * 1e3
+    print(name)
+    print(f"  I2C transactions : {bus.transactions / redraws:8.1f} per screen")
+    print(f"  I2C bytes        : {bus.bytes / redraws:8.1f} per screen")
+    print(f"  bus time         : {(bus.bits / I2C_CLOCK + bus.execution_time) / redraws * 1e3:8.2f} ms per screen at {I2C_CLOCK // 1000} kHz")
+    print(f"  python time      : {wall:8.2f} ms per screen (with driver sleeps)")
+
+if __name__ == '__main__':
+    benchmark('per-nibble write_byte (old lcd_display_string)', draw_per_nibble)
+    benchmark('batched lcd_display_string', draw_batched)
+    framebuffer_displays = {}
+    def draw_framebuffer(display, lines):
+        framebuffer = framebuffer_displays.setdefault(id(display), LcdFramebuffer(display))
+        framebuffer.show(*lines)
+    benchmark('LcdFramebuffer.show', draw_framebuffer)
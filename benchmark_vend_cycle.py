@@ -0,0 +1,169 @@
+import argparse
+import collections
+import datetime
+import json
+import os
+import subprocess
+import time
+import numpy
+import hal
+from kiosk_simulation import SimulatedKiosk, BUY, default_mix
+from transaction_journal import REFUND_DUE, SETTLED
+from vending_machine import Vending_Machine
+
+# Where a customer's time goes: runs simulated customers through the real
+# Vending_Machine.vend_loop (kiosk_simulation, scaled clock) and reports
+# p50/p95/p99 per phase plus transactions per hour. Results are written as
+# JSON; pass an earlier result as --baseline to see what a change did.
+#
+# Phases, in simulated seconds:
+#   selection  product screen shown until the product key
+#   amount     amount screen shown until the amount key
+#   confirm    confirmation screen shown until the confirm key
+#   authorize  AUTH_REQ preparation until the card is approved
+#   dispense   dispense screen until the motor has stopped
+#   settle     dispense commands accepted until the ePort reports the
+#              transaction ID
+#   reset      transaction ID until the reader is re-armed for the next sale
+#   cycle      product key until the machine can take the next customer
+# Only phases that succeed are timed, so declines and walk-aways show up in
+# transactions per hour instead of skewing the phase times.
+
+PHASES = ('selection', 'amount', 'confirm', 'authorize', 'dispense', 'settle', 'reset', 'cycle')
+PERCENTILES = (50, 95, 99)
+
+class TimedVending_Machine(Vending_Machine):
+    def __init__(self, log_directory):
+        self.phase_times = collections.defaultdict(list)
+        self._commands_sent_times = collections.deque()
+        self._settled_time = None
+        Vending_Machine.__init__(self, log_directory)
+        self.ePort_watcher.subscribe(self._on_ePort_status)
+
+    def _timed(self, phase, method, *args, succeeded = bool):
+        begin_time = hal.clock.monotonic()
+        result = method(self, *args)
+        if succeeded(result):
+            self.phase_times[phase].append(hal.clock.monotonic() - begin_time)
+        return result
+
+    def _get_product_selection(self, wait_time = 30):
+        return self._timed('selection', Vending_Machine._get_product_selection, wait_time)
+
+    def _get_amount_selection(self, wait_time = 30):
+        return self._timed('amount', Vending_Machine._get_amount_selection, wait_time)
+
+    def _get_selection_confirmation(self, wait_time = 30):
+        return self._timed('confirm', Vending_Machine._get_selection_confirmation, wait_time, succeeded = lambda key: key == '1')
+
+    def _authorize_payment(self, wait_time = 30):
+        return self._timed('authorize', Vending_Machine._authorize_payment, wait_time)
+
+    def _dispense_product(self, sale_id):
+        return self._timed('dispense', Vending_Machine._dispense_product, sale_id)
+
+    def _settle_sale(self, sale_id):
+        self._commands_sent_times.append(hal.clock.monotonic())
+        Vending_Machine._settle_sale(self, sale_id)
+
+    def _on_ePort_status(self, event):
+        if event.code == '17' and self._commands_sent_times:
+            self.phase_times['settle'].append(event.time - self._commands_sent_times.popleft())
+            self._settled_time = event.time
+
+    def _rearm_ePort(self):
+        Vending_Machine._rearm_ePort(self)
+        # A re-arm that gave up on settlement is retried, keep the settle time
+        if self.ePort_ready.is_set() and self._settled_time is not None:
+            self.phase_times['reset'].append(self.ePort_ready_time - self._settled_time)
+            self._settled_time = None
+
+def summarize(seconds):
+    if not seconds:
+        return {'count': 0}
+    summary = {'count': len(seconds), 'mean': float(numpy.mean(seconds))}
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}'] = float(numpy.percentile(seconds, percentile))
+    return summary
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(customers, speed, seed, mix):
+    kiosk = SimulatedKiosk(speed, seed, machine_class = TimedVending_Machine)
+    machine = kiosk.machine
+    real_time = time.monotonic()
+    simulated_time = hal.clock.monotonic()
+    kiosk.run(customers, mix)
+    simulated_time = hal.clock.monotonic() - simulated_time
+    real_time = time.monotonic() - real_time
+    # A cycle is recorded once the reader is re-armed after its dispense
+    deadline = hal.clock.monotonic() + 60
+    while len(machine.cycle_times) < len(machine.phase_times['dispense']) and hal.clock.monotonic() < deadline:
+        hal.clock.sleep(.05)
+    sales = machine.journal.state_counts()
+    phase_times = dict(machine.phase_times, cycle = list(machine.cycle_times))
+    kiosk.close()
+
+    return {
+                'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                'revision': revision(),
+                'settings': {'customers': customers, 'speed': speed, 'seed': seed, 'mix': mix},
+                'phases': {phase: summarize(phase_times.get(phase, [])) for phase in PHASES},
+                'sales': sales,
+                'transactions_per_hour': (sales.get(SETTLED, 0) + sales.get(REFUND_DUE, 0)) * 3600 / simulated_time,
+                'simulated_seconds': simulated_time,
+                'real_seconds': real_time
+           }
+
+def change(value, baseline_value):
+    if baseline_value is None or value is None:
+        return ''
+    if baseline_value == 0:
+        return f"{'':>8}"
+    return f" {(value - baseline_value) / baseline_value * 100:+6.1f}%"
+
+def report(result, baseline = None):
+    print(f"revision {result['revision']}, {result['settings']['customers']} customers at {result['settings']['speed']:g}x")
+    if baseline is not None:
+        print(f"baseline {baseline['revision']} from {baseline['time']}, changes in %")
+    print(f"{'phase':10} {'count':>6}" + ''.join(f"{'p' + str(percentile) + ' (s)':>10}" + (' ' * 8 if baseline else '') for percentile in PERCENTILES))
+    for phase in PHASES:
+        summary = result['phases'][phase]
+        baseline_summary = baseline['phases'].get(phase, {}) if baseline is not None else {}
+        line = f"{phase:10} {summary['count']:6}"
+        for percentile in PERCENTILES:
+            key = f'p{percentile}'
+            line += f"{summary[key]:10.2f}" if key in summary else f"{'-':>10}"
+            if baseline is not None:
+                line += change(summary.get(key), baseline_summary.get(key)) or f"{'':>8}"
+        print(line)
+    line = f"transactions per hour {result['transactions_per_hour']:.1f}"
+    if baseline is not None:
+        line += change(result['transactions_per_hour'], baseline['transactions_per_hour'])
+    print(line)
+    print(f"sales {result['sales']}")
+    print(f"simulated {result['simulated_seconds']:.0f} s in {result['real_seconds']:.1f} s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-phase vend cycle timings on the simulated kiosk')
+    parser.add_argument('--customers', type=int, default=200)
+    parser.add_argument('--speed', type=float, default=100, help='simulated seconds per real second')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mixed', action='store_true', help=f'customers from kiosk_simulation.default_mix instead of only {BUY}')
+    parser.add_argument('--output', default='vend_cycle_benchmark.json', help='JSON results file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    result = benchmark(args.customers, args.speed, args.seed, default_mix if args.mixed else {BUY: 1.0})
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    report(result, baseline)
+    with open(args.output, 'w') as file:
+        json.dump(result, file, indent=4)
@@ -0,0 +1,239 @@
+import argparse
+import collections
+import itertools
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+import hal
+from crc16 import crc16
+from ePort import ePort
+from hal_fakes import FakeSerial
+
+ACK = b'\x06'
+NAK = b'\x15'
+
+COMMANDS = {command[0]: command for command in (
+                ePort.STATUS, ePort.REBOOT, ePort.RESET, ePort.PROCESS_UPDATE, ePort.ENABLE, ePort.DISABLE,
+                ePort.BEGIN_FILE_DOWNLOAD, ePort.TERMINATE_FILE_TRANSFER, ePort.ACQUIRE_SIGNAL_QUALITY,
+                ePort.ACQUIRE_TIME_AND_DATE, ePort.EVENT_LOG, ePort.ACQUIRE_EPORT_CONFIG_DATA,
+                ePort.ACQUIRE_TRANSACTION_ID, ePort.CONFIG, ePort.AUTH_REQ, ePort.TRANSACTION_RESULT,
+                ePort.CASHREPORT, ePort.FILE_READY_FOR_UPLOAD, ePort.FILE_RECORD, ePort.DISP_MESSAGE
+            )}
+
+# Authorization outcomes a script can ask for
+APPROVE = 'approve'
+DECLINE = 'decline'
+NO_SWIPE = 'no_swipe'
+
+class ePortSimulator:
+    # outcomes: sequence of APPROVE/DECLINE/NO_SWIPE used by successive
+    # AUTH_REQs, repeated once exhausted
+    # busy_probability: chance that a STATUS poll starts a storm of
+    # busy_storm_length BUSY replies
+    # drop_cr_probability: chance that a reply goes out without its CR
+    # settle_delay: time from ACQUIRE_TRANSACTION_ID until the ID is reported
+    # use_pty: serve a pseudo-terminal, otherwise only in-process through
+    # open_serial()/install()
+    def __init__(self, swipe_delay=1.0, auth_delay=0.5, settle_delay=0.2, outcomes=(APPROVE,),
+                 busy_probability=0.0, busy_storm_length=5, drop_cr_probability=0.0, latency=0.0, seed=None, use_pty=True):
+        self.swipe_delay = swipe_delay
+        self.auth_delay = auth_delay
+        self.settle_delay = settle_delay
+        self.outcomes = itertools.cycle(outcomes)
+        self.busy_probability = busy_probability
+        self.busy_storm_length = busy_storm_length
+        self.drop_cr_probability = drop_cr_probability
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.state = '6'
+        self.idle_state = '6'
+        self.auth_amount = None
+        self.auth_outcome = None
+        self.swipe_time = None
+        self.transaction_count = 0
+        self.transaction_id_time = None
+        self.pending = collections.deque()
+        self.busy_remaining = 0
+        self.commands = []
+        self.crc_errors = 0
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._serial = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._master = self._slave = self.port_name = None
+        if use_pty:
+            self._master, self._slave = pty.openpty()
+            tty.setraw(self._slave)
+            self.port_name = os.ttyname(self._slave)
+
+    # In-process port: bytes written to it are handled on the writer's thread
+    def open_serial(self, baudrate=None, timeout=None):
+        self._serial = FakeSerial(self.receive, baudrate, timeout)
+        return self._serial
+
+    # Makes hal.open_serial(port_name) connect to this simulator
+    def install(self, port_name):
+        self.port_name = port_name
+        hal.serial_ports[port_name] = self.open_serial
+
+    def start(self):
+        if self._master is None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.serve_forever, name='ePortSimulator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        if self._master is not None:
+            os.close(self._master)
+            os.close(self._slave)
+
+    def serve_forever(self):
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.01)
+            if readable:
+                self.receive(os.read(self._master, 4096))
+
+    def receive(self, data):
+        with self._lock:
+            self._buffer += data
+            self._process_buffer()
+
+    def _process_buffer(self):
+        search_from = 0
+        while True:
+            end = self._buffer.find(b'\r', search_from)
+            if end < 0:
+                return
+            frame = bytes(self._buffer[:end])
+            identifier = frame.split(b'\x1e')[0]
+            command = COMMANDS.get(identifier[:2].decode('ASCII', 'replace')) or COMMANDS.get(identifier[:1].decode('ASCII', 'replace'))
+            if command is not None and command[2]:
+                # A CR inside the binary CRC does not end the frame
+                if len(frame) < 3 or crc16(frame[:-2], 0xFFFF) != int.from_bytes(frame[-2:], 'big'):
+                    if end + 1 < len(self._buffer):
+                        search_from = end + 1
+                        continue
+                    self.crc_errors += 1
+                    frame = None
+                else:
+                    frame = frame[:-2]
+            del self._buffer[:end + 1]
+            search_from = 0
+            if frame is None or command is None:
+                self._respond(NAK)
+                continue
+            fields = frame.decode('ASCII').split('\x1e')
+            if fields[0] != command[0]:
+                self._respond(NAK)
+                continue
+            self.commands.append((hal.clock.monotonic(), command[0]))
+            self._respond(self._handle_command(command, fields[1:]))
+
+    def _respond(self, response):
+        if self.latency:
+            hal.clock.sleep(self.latency)
+        if response.endswith(b'\r') and self.random.random() < self.drop_cr_probability:
+            response = response[:-1]
+        if self._serial is not None:
+            self._serial.feed(response)
+        else:
+            os.write(self._master, response)
+
+    def _frame(self, code, values=()):
+        message = code.encode('ASCII')
+        if values:
+            message += b'\x1e' + '\x1e'.join(values).encode('ASCII')
+        if ePort.RESPONSES[code][-1]:
+            message += crc16(message, 0xFFFF).to_bytes(2, 'big')
+        return message + b'\r'
+
+    def _handle_command(self, command, values):
+        if command == ePort.STATUS:
+            return self._status()
+        if command == ePort.AUTH_REQ:
+            if self.state in ('8', '9'):
+                return self._frame('10', [command[0], 'Not ready for authorization'])
+            if self.state != '7':
+                self.idle_state = self.state
+            self.auth_amount = values[0] if values else '0'
+            self.auth_outcome = next(self.outcomes)
+            self.swipe_time = hal.clock.monotonic()
+            self.state = '7'
+        elif command == ePort.TRANSACTION_RESULT:
+            self.transaction_count += 1
+            self.state = '0'
+        elif command == ePort.ACQUIRE_TRANSACTION_ID:
+            self.transaction_id_time = hal.clock.monotonic() + self.settle_delay
+        elif command == ePort.ENABLE or command == ePort.RESET or command == ePort.REBOOT:
+            self.state = '0'
+            self.auth_outcome = None
+        elif command == ePort.DISABLE:
+            self.state = '6'
+            self.auth_outcome = None
+        elif command == ePort.ACQUIRE_SIGNAL_QUALITY:
+            self.pending.append(('14', ['25', '0']))
+        elif command == ePort.ACQUIRE_TIME_AND_DATE:
+            now = time.gmtime(hal.clock.time())
+            self.pending.append(('15', [time.strftime('%H%M%S', now), time.strftime('%m%d%Y', now), '0', time.strftime('%H%M%S', now), time.strftime('%m%d%Y', now)]))
+        elif command == ePort.ACQUIRE_EPORT_CONFIG_DATA:
+            self.pending.append(('16', ['K3SIM000001', '1.0.0-sim']))
+        return ACK
+
+    def _status(self):
+        if self.busy_remaining == 0 and self.random.random() < self.busy_probability:
+            self.busy_remaining = self.busy_storm_length
+        if self.busy_remaining > 0:
+            self.busy_remaining -= 1
+            return self._frame('1')
+        if self.transaction_id_time is not None and hal.clock.monotonic() >= self.transaction_id_time:
+            self.transaction_id_time = None
+            return self._frame('17', [f'{self.transaction_count:010d}'])
+        if self.pending:
+            return self._frame(*self.pending.popleft())
+        if self.state in ('7', '8'):
+            elapsed = hal.clock.monotonic() - self.swipe_time
+            if self.auth_outcome == NO_SWIPE or elapsed < self.swipe_delay:
+                return self._frame('7')
+            if elapsed < self.swipe_delay + self.auth_delay:
+                self.state = '8'
+                return self._frame('8')
+            if self.auth_outcome == APPROVE:
+                self.state = '9'
+                return self._frame('2', [self.auth_amount, '************1111'])
+            self.state = self.idle_state
+            return self._frame('3', ['05', 'Do not honor'])
+        return self._frame(self.state)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ePort card reader simulator on a pseudo-terminal')
+    parser.add_argument('--swipe-delay', type=float, default=1.0)
+    parser.add_argument('--auth-delay', type=float, default=0.5)
+    parser.add_argument('--settle-delay', type=float, default=0.2)
+    parser.add_argument('--outcomes', default=APPROVE, help=f'comma separated {APPROVE}/{DECLINE}/{NO_SWIPE} script')
+    parser.add_argument('--busy-probability', type=float, default=0.0)
+    parser.add_argument('--busy-storm-length', type=int, default=5)
+    parser.add_argument('--drop-cr-probability', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    simulator = ePortSimulator(args.swipe_delay, args.auth_delay, args.settle_delay, args.outcomes.split(','),
+                               args.busy_probability, args.busy_storm_length, args.drop_cr_probability, args.latency, args.seed)
+    print(f"Simulated ePort on {simulator.port_name}", flush=True)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,162 @@
+import threading
+import traceback
+import hal
+from ePort import ePort, ePortCRCError, ePortTimeoutError
+
+# Status codes during which the reader is expected to change state soon
+FAST_POLL_CODES = {'1', '5', '7', '8'}
+# ACK and NAK, replies that are not a reader status
+NON_STATUS_CODES = {'\x06', '\x15'}
+
+class ePortStatusEvent:
+    def __init__(self, response, previous_code, timestamp):
+        self.code, self.name, self.description, self.fields, self.crc = response
+        self.values = dict(self.fields)
+        self.previous_code = previous_code
+        self.time = timestamp
+
+    def __repr__(self):
+        return f"ePortStatusEvent({self.code} {self.name} {self.fields})"
+
+class ePortStatusWaiter:
+    def __init__(self, codes):
+        self.codes = set(codes)
+        self.event = None
+        self._ready = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def _deliver(self, event):
+        with self._lock:
+            if self.event is not None:
+                return
+            self.event = event
+            self._ready.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(event)
+
+    # callback(event) runs on the watcher thread, or right away if the event
+    # has already arrived
+    def add_done_callback(self, callback):
+        with self._lock:
+            if self.event is None:
+                self._callbacks.append(callback)
+                return
+        callback(self.event)
+
+    # Returns the first matching event, or None if timeout (seconds) passes first
+    def wait(self, timeout=None):
+        hal.clock.wait(self._ready, timeout)
+        return self.event
+
+# Polls ePort.STATUS on its own thread, quickly while a swipe or authorization
+# is in progress or while someone waits for a status, slowly otherwise, and
+# publishes an ePortStatusEvent whenever the status code changes or the reader
+# reports values (AUTH_OK, TRANSACTION_ID, ...).
+class ePortStatusWatcher:
+    def __init__(self, eport, fast_interval=0.05, slow_interval=1.0):
+        self.ePort = eport
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.last_event = None
+        self.status = None
+        self.errors = 0
+        self._subscribers = []
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    # Register before sending the command that leads to the status, so an
+    # answer arriving right after the command is not missed
+    def expect(self, codes):
+        waiter = ePortStatusWaiter(codes)
+        with self._lock:
+            self._waiters.append(waiter)
+        self.poke()
+        return waiter
+
+    def cancel(self, waiter):
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    # Polls again right away instead of at the end of the current interval
+    def poke(self):
+        self._wake_event.set()
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='ePortStatusWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def poll(self):
+        try:
+            response = self.ePort.send_command(ePort.STATUS)
+        except (ePortTimeoutError, ePortCRCError):
+            self.errors += 1
+            return None
+        except Exception:
+            # Garbled or unknown replies must not end the watcher thread
+            self.errors += 1
+            traceback.print_exc()
+            return None
+        # A NAK'd STATUS carries no status
+        if response[0] in NON_STATUS_CODES:
+            self.errors += 1
+            return None
+        previous_code = self.status
+        if response[0] == previous_code and not response[3]:
+            return None
+        event = ePortStatusEvent(response, previous_code, hal.clock.monotonic())
+        self.last_event = event
+        self.status = event.code
+        self._publish(event)
+        return event
+
+    def _publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            waiters = [waiter for waiter in self._waiters if event.code in waiter.codes]
+            for waiter in waiters:
+                self._waiters.remove(waiter)
+        for waiter in waiters:
+            waiter._deliver(event)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                traceback.print_exc()
+
+    def _interval(self):
+        if self._waiters or self.status in FAST_POLL_CODES:
+            return self.fast_interval
+        return self.slow_interval
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.clear()
+            try:
+                self.poll()
+            except Exception:
+                # e.g. a failing waiter callback
+                self.errors += 1
+                traceback.print_exc()
+            hal.clock.wait(self._wake_event, self._interval())
@@ -0,0 +1,109 @@
+import threading
+
+# The GPIO interface used by keypad is the RPi.GPIO module itself; FakeGPIO
+# implements the same calls in memory so the keypad can run off the Pi.
+
+def rpi_gpio():
+    import RPi.GPIO
+    return RPi.GPIO
+
+# In-memory RPi.GPIO. Switches connect pairs of pins (a key joins its row
+# and column). An input reads LOW when it is connected to an output driven
+# LOW, otherwise its pull-up makes it HIGH. Edge callbacks run on the
+# thread that caused the edge, not on a separate thread as in RPi.GPIO.
+class FakeGPIO:
+    BOARD = 10
+    BCM = 11
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.directions = {}
+        self.outputs = {}
+        self.switches = set()
+        self.calls = {'setup': 0, 'output': 0, 'input': 0}
+        self._levels = {}
+        self._event_callbacks = {}
+        self._lock = threading.RLock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down = None, initial = None):
+        with self._lock:
+            self.calls['setup'] += 1
+            self.directions[pin] = direction
+            if direction == FakeGPIO.OUT:
+                self.outputs[pin] = initial if initial is not None else FakeGPIO.LOW
+            self._update_levels()
+
+    def output(self, pin, value):
+        with self._lock:
+            self.calls['output'] += 1
+            self.outputs[pin] = value
+            self._update_levels()
+
+    def input(self, pin):
+        with self._lock:
+            self.calls['input'] += 1
+            return self._level(pin)
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = None):
+        with self._lock:
+            self._event_callbacks[pin] = (edge, callback)
+            self._levels[pin] = self._level(pin)
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._event_callbacks.pop(pin, None)
+
+    def cleanup(self, pins = None):
+        with self._lock:
+            for pin in (pins if pins is not None else list(self.directions)):
+                self.directions.pop(pin, None)
+                self.outputs.pop(pin, None)
+                self._event_callbacks.pop(pin, None)
+
+    # Test side: close or open the switch between two pins
+    def connect(self, pin_a, pin_b):
+        with self._lock:
+            self.switches.add(frozenset((pin_a, pin_b)))
+            self._update_levels()
+
+    def disconnect(self, pin_a, pin_b):
+        with self._lock:
+            self.switches.discard(frozenset((pin_a, pin_b)))
+            self._update_levels()
+
+    def _level(self, pin):
+        if self.directions.get(pin) == FakeGPIO.OUT:
+            return self.outputs[pin]
+        for switch in self.switches:
+            if pin in switch:
+                other, = switch - {pin}
+                if self.directions.get(other) == FakeGPIO.OUT and self.outputs[other] == FakeGPIO.LOW:
+                    return FakeGPIO.LOW
+        return FakeGPIO.HIGH
+
+    def _update_levels(self):
+        fired = []
+        for pin, (edge, callback) in self._event_callbacks.items():
+            level = self._level(pin)
+            previous, self._levels[pin] = self._levels.get(pin), level
+            if previous is None or previous == level or callback is None:
+                continue
+            if edge == FakeGPIO.BOTH or (edge == FakeGPIO.FALLING) == (level == FakeGPIO.LOW):
+                fired.append((callback, pin))
+        for callback, pin in fired:
+            callback(pin)
@@ -0,0 +1,82 @@
+import time
+
+# Hardware abstraction layer: the clock every module takes its time from and
+# the registries that let fakes stand in for the serial ports, the I2C bus
+# and RPi.GPIO. Production code never touches the registries, so everything
+# opens the real hardware on the real clock.
+
+class SystemClock:
+    def monotonic(self):
+        return time.monotonic()
+
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(max(0, seconds))
+
+    # Real seconds to block for a clock timeout (None blocks forever)
+    def timeout(self, seconds):
+        return None if seconds is None else max(0, seconds)
+
+    # threading.Event.wait with the timeout in clock seconds
+    def wait(self, event, timeout = None):
+        return event.wait(self.timeout(timeout))
+
+# Scaled wall time, not discrete-event time: the clock is real time.monotonic()
+# multiplied by speed, and every sleep, wait and timeout is shortened by the
+# same factor. Threads keep their relative timing while a 20 s vend cycle
+# takes a fraction of a second, but nothing waits for idle threads to catch
+# up: real work and thread switches are stretched by speed too, so results
+# carry scheduling noise. Around 100x vend timings stay within a few percent
+# of 1x, by 500x they are visibly inflated.
+class ScaledClock(SystemClock):
+    def __init__(self, speed = 100.0, start_time = None):
+        self.speed = speed
+        self._real_start = time.monotonic()
+        self._start_time = time.time() if start_time is None else start_time
+
+    def monotonic(self):
+        return (time.monotonic() - self._real_start) * self.speed
+
+    def monotonic_ns(self):
+        return int(self.monotonic() * 1e9)
+
+    def time(self):
+        return self._start_time + self.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(max(0, seconds) / self.speed)
+
+    def timeout(self, seconds):
+        return None if seconds is None else max(0, seconds) / self.speed
+
+clock = SystemClock()
+
+def set_clock(new_clock):
+    global clock
+    clock = new_clock
+
+# port name -> callable(baudrate, timeout) returning a pyserial-like object
+serial_ports = {}
+# I2C bus number -> smbus-like object
+i2c_buses = {}
+# RPi.GPIO-like object used instead of RPi.GPIO, or None
+gpio = None
+
+def open_serial(port, baudrate, timeout = None, interCharTimeout = None):
+    if port in serial_ports:
+        return serial_ports[port](baudrate = baudrate, timeout = timeout)
+    import serial
+    return serial.Serial(port=port, baudrate=baudrate, timeout=timeout, interCharTimeout=interCharTimeout)
+
+# Drops every registered fake and goes back to the system clock
+def reset():
+    global gpio
+    serial_ports.clear()
+    i2c_buses.clear()
+    gpio = None
+    set_clock(SystemClock())
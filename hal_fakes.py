@@ -0,0 +1,128 @@
+import threading
+import hal
+from I2C_LCD_driver import En, Rs, LCD_CLEARDISPLAY, LCD_RETURNHOME, LCD_ROW_OFFSETS
+
+# HD44780 clear and return home execution time
+CLEAR_HOME_EXECUTION_TIME = 1.52e-3
+
+# smbus stand-in for the PCF8574 + HD44780 lcd in 4-bit mode: a nibble is
+# latched on each EN falling edge and written to a DDRAM copy. Counts
+# transactions and clocked bits for benchmarks.
+class FakeSMBus:
+    def __init__(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.bits = 0
+        self.execution_time = 0
+        self.ddram = bytearray(b' ' * 0x80)
+        self.address = 0
+        self._port = 0
+        self._nibble = None
+        self._lock = threading.Lock()
+
+    def _transaction(self, data):
+        with self._lock:
+            self.transactions += 1
+            self.bytes += len(data)
+            # start, address byte + ack, data bytes + acks, stop
+            self.bits += 2 + 9 * (1 + len(data))
+            for byte in data:
+                if self._port & En and not byte & En:
+                    self._latch(self._port)
+                self._port = byte
+
+    def _latch(self, port):
+        if self._nibble is None:
+            self._nibble = port & 0xF0
+            return
+        value, self._nibble = self._nibble | (port >> 4), None
+        if port & Rs:
+            self.ddram[self.address] = value
+            self.address = {0x28: 0x40, 0x68: 0x00}.get(self.address + 1, self.address + 1)
+        elif value & 0x80:
+            self.address = value & 0x7F
+        elif value in (LCD_CLEARDISPLAY, LCD_RETURNHOME):
+            self.execution_time += CLEAR_HOME_EXECUTION_TIME
+            if value == LCD_CLEARDISPLAY:
+                self.ddram[:] = b' ' * 0x80
+            self.address = 0
+
+    def write_byte(self, addr, value):
+        self._transaction([value])
+
+    def write_byte_data(self, addr, cmd, value):
+        self._transaction([cmd, value])
+
+    def write_i2c_block_data(self, addr, cmd, data):
+        self._transaction([cmd] + list(data))
+
+    def i2c_rdwr(self, *messages):
+        for message in messages:
+            self._transaction(list(message))
+
+    def screen(self):
+        with self._lock:
+            return [self.ddram[offset:offset + 20].decode('ASCII') for offset in LCD_ROW_OFFSETS]
+
+# pyserial stand-in wired straight to an in-process device: writes go to
+# handler(data) and the device answers with feed(data). Read timeouts run on
+# hal.clock.
+class FakeSerial:
+    def __init__(self, handler, baudrate = None, timeout = None):
+        self.handler = handler
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self._received = bytearray()
+        self._condition = threading.Condition()
+
+    def feed(self, data):
+        with self._condition:
+            self._received += data
+            self._condition.notify_all()
+
+    def write(self, data):
+        self.handler(bytes(data))
+        return len(data)
+
+    def _wait_for(self, ready):
+        deadline = None if self.timeout is None else hal.clock.monotonic() + self.timeout
+        while not ready():
+            if deadline is None:
+                self._condition.wait()
+                continue
+            remaining = deadline - hal.clock.monotonic()
+            if remaining <= 0:
+                return
+            self._condition.wait(hal.clock.timeout(remaining))
+
+    def read(self, size = 1):
+        with self._condition:
+            self._wait_for(lambda: len(self._received) >= size)
+            data = bytes(self._received[:size])
+            del self._received[:size]
+            return data
+
+    def read_until(self, expected = b'\n', size = None):
+        with self._condition:
+            self._wait_for(lambda: expected in self._received or (size is not None and len(self._received) >= size))
+            end = self._received.find(expected)
+            end = len(self._received) if end < 0 else end + len(expected)
+            if size is not None:
+                end = min(end, size)
+            data = bytes(self._received[:end])
+            del self._received[:end]
+            return data
+
+    @property
+    def in_waiting(self):
+        with self._condition:
+            return len(self._received)
+
+    def flushInput(self):
+        with self._condition:
+            self._received.clear()
+
+    reset_input_buffer = flushInput
+
+    def close(self):
+        pass
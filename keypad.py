@@ -1,9 +1,26 @@
-import RPi.GPIO as GPIO
+import collections
+import queue
+import threading
+import hal
+from gpio_backend import rpi_gpio
+
+PRESS = 'press'
+RELEASE = 'release'
+
+# Scan modes: POLL scans every scan_interval, INTERRUPT sleeps until a column
+# edge and scans only while a key is down or changing
+POLL = 'poll'
+INTERRUPT = 'interrupt'
+
+# time is hal.clock.monotonic() when the change was first seen, before debouncing
+KeyEvent = collections.namedtuple('KeyEvent', ['key', 'kind', 'time'])
 
 class keypad:
-    def __init__(self):
-        GPIO.setmode(GPIO.BOARD)
-        
+    # gpio: an RPi.GPIO compatible object, hal.gpio or RPi.GPIO itself by default
+    def __init__(self, debounce_time = .02, scan_interval = .005, mode = POLL, gpio = None):
+        self.gpio = gpio if gpio is not None else hal.gpio if hal.gpio is not None else rpi_gpio()
+        self.gpio.setmode(self.gpio.BOARD)
+
         self.pins = [29, 31, 33, 35, 37, 38, 40]
         self.columns = self.pins[0:3]
         self.rows = self.pins[3:7]
@@ -13,21 +30,126 @@ class keypad:
                         ['7','8','9'],
                         ['*','0','#']
                     ]
-        
+        self.debounce_time = debounce_time
+        self.scan_interval = scan_interval
+        self.mode = mode
+        self.wakeups = 0
+        # Key events in order, kept until read so presses made before a
+        # screen asks for them are not lost
+        self.events = queue.Queue()
+        self.stable_keys = set()
+        self._changing = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._edge_event = threading.Event()
+
         self.__set_all_pins_to_input__()
-        
+        self.__drive_all_rows_low__()
+
     def __set_all_pins_to_input__(self):
         for pin in self.pins:
-            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    
-    def pressed_keys(self):
+            self.gpio.setup(pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+
+    # Idle state: any pressed key pulls its column low. All rows are at the
+    # same level, so two keys in one column cannot short two outputs.
+    def __drive_all_rows_low__(self):
+        for row_pin in self.rows:
+            self.gpio.setup(row_pin, self.gpio.OUT)
+            self.gpio.output(row_pin, self.gpio.LOW)
+
+    def __release_all_rows__(self):
+        for row_pin in self.rows:
+            self.gpio.setup(row_pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+
+    def _scan(self):
+        if all(self.gpio.input(col_pin) for col_pin in self.columns):
+            return []
         pressed = []
-        self.__set_all_pins_to_input__()
+        self.__release_all_rows__()
         for row, row_pin in enumerate(self.rows):
-            GPIO.setup(row_pin, GPIO.OUT)
-            GPIO.output(row_pin, GPIO.LOW)
+            self.gpio.setup(row_pin, self.gpio.OUT)
+            self.gpio.output(row_pin, self.gpio.LOW)
             for col, col_pin in enumerate(self.columns):
-                if not GPIO.input(col_pin):
+                if not self.gpio.input(col_pin):
                     pressed.append(self.keys[row][col])
-            GPIO.setup(row_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            self.gpio.setup(row_pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.__drive_all_rows_low__()
         return pressed
+
+    def pressed_keys(self):
+        if self._thread is not None:
+            return sorted(self.stable_keys)
+        return self._scan()
+
+    # Accepts a key state change once it has held for debounce_time
+    def _update(self, pressed, now):
+        pressed = set(pressed)
+        for key in list(self._changing):
+            if (key in pressed) == (key in self.stable_keys):
+                del self._changing[key]
+        for key in pressed ^ self.stable_keys:
+            first_seen = self._changing.setdefault(key, now)
+            if now - first_seen < self.debounce_time:
+                continue
+            del self._changing[key]
+            if key in pressed:
+                self.stable_keys.add(key)
+                self.events.put(KeyEvent(key, PRESS, first_seen))
+            else:
+                self.stable_keys.discard(key)
+                self.events.put(KeyEvent(key, RELEASE, first_seen))
+
+    def start(self):
+        self._stop_event.clear()
+        if self.mode == INTERRUPT:
+            for col_pin in self.columns:
+                self.gpio.add_event_detect(col_pin, self.gpio.FALLING, callback=self._on_edge)
+        self._thread = threading.Thread(target=self._run, name='keypad', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._edge_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.mode == INTERRUPT:
+            for col_pin in self.columns:
+                self.gpio.remove_event_detect(col_pin)
+
+    # Runs on the GPIO callback thread; the row scan itself also makes edges
+    def _on_edge(self, pin):
+        self._edge_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            if self.mode == INTERRUPT and not self.stable_keys and not self._changing:
+                self._edge_event.wait()
+                self.wakeups += 1
+            elif hal.clock.wait(self._stop_event, self.scan_interval):
+                break
+            self._edge_event.clear()
+            self._update(self._scan(), hal.clock.monotonic())
+
+    # Next KeyEvent, or None if timeout (seconds) passes first
+    def get_event(self, timeout = None):
+        try:
+            return self.events.get(timeout = hal.clock.timeout(timeout))
+        except queue.Empty:
+            return None
+
+    # Next pressed key in valid_keys (any key if None), skipping other
+    # events; None if timeout passes first
+    def get_key(self, valid_keys = None, timeout = None):
+        deadline = None if timeout is None else hal.clock.monotonic() + timeout
+        while True:
+            event = self.get_event(None if deadline is None else max(0, deadline - hal.clock.monotonic()))
+            if event is None:
+                return None
+            if event.kind == PRESS and (valid_keys is None or event.key in valid_keys):
+                return event.key
+
+    # Drops queued events, e.g. presses made while nothing was asking
+    def clear_events(self):
+        while self.get_event(0) is not None:
+            pass
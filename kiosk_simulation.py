@@ -0,0 +1,160 @@
+import argparse
+import collections
+import itertools
+import random
+import shutil
+import tempfile
+import threading
+import time
+import hal
+import vending_machine
+from I2C_LCD_driver import I2CBUS
+from gpio_backend import FakeGPIO
+from hal_fakes import FakeSMBus
+from ePort_simulator import ePortSimulator, APPROVE, DECLINE, NO_SWIPE
+from roboclaw_simulator import RoboclawSimulator
+from vending_machine import Vending_Machine
+
+# Whole kiosk in one process: Vending_Machine runs its real vend_loop against
+# FakeGPIO, FakeSMBus and the ePort and Roboclaw simulators, all on a
+# ScaledClock, while simulated customers press keys and read the LCD.
+
+# Customer behaviours
+BUY = 'buy'                     # card approved, product dispensed
+DECLINED = 'declined'           # card declined
+NO_CARD = 'no_card'             # confirms, never swipes, authorization times out
+WALK_AWAY = 'walk_away'         # picks a product, leaves before the amount
+CANCEL = 'cancel'               # cancels at the confirmation screen
+JAM = 'jam'                     # card approved, auger jams during the dispense
+
+default_mix = {BUY: .70, DECLINED: .08, NO_CARD: .05, WALK_AWAY: .05, CANCEL: .07, JAM: .05}
+
+# Screen text each step waits for
+SELECT_PRODUCT_TEXT = 'Please select'
+SELECT_AMOUNT_TEXT = '1: 1/2 cup'
+CONFIRM_TEXT = '1-confirm 2-cancel'
+SWIPE_CARD_TEXT = 'Please swipe card'
+DISPENSING_TEXT = 'Dispensing'
+THANK_YOU_TEXT = 'Thank you'
+FAILED_TEXT = 'Something went wrong'
+
+class SimulatedKiosk:
+    # speed: simulated seconds per real second
+    # think_time: (min, max) seconds a customer takes before each key
+    # machine_class: Vending_Machine or a subclass taking log_directory
+    def __init__(self, speed = 100, seed = None, think_time = (.5, 2), log_directory = None, machine_class = Vending_Machine):
+        self.random = random.Random(seed)
+        self.think_time = think_time
+        self.clock = hal.ScaledClock(speed)
+        hal.set_clock(self.clock)
+
+        self.gpio = FakeGPIO()
+        hal.gpio = self.gpio
+        self.bus = FakeSMBus()
+        hal.i2c_buses[I2CBUS] = self.bus
+        self.ePort = ePortSimulator(seed = seed, use_pty = False)
+        self.ePort.install(vending_machine.ePort_serial_port)
+        self.roboclaw = RoboclawSimulator(seed = seed, use_pty = False)
+        self.roboclaw.install(vending_machine.roboclaw_serial_port)
+
+        self._temporary_directory = None
+        if log_directory is None:
+            log_directory = self._temporary_directory = tempfile.mkdtemp(prefix='kiosk_simulation_')
+        self.machine = machine_class(log_directory)
+        self._vend_thread = threading.Thread(target=self.machine.vend_loop, name='vend_loop', daemon=True)
+        self._vend_thread.start()
+
+    def close(self):
+        self.machine.keypad.stop()
+        self.machine.settlement_worker.stop()
+        self.machine.ePort_watcher.stop()
+        self.machine.display.stop()
+        hal.reset()
+        if self._temporary_directory is not None:
+            shutil.rmtree(self._temporary_directory, ignore_errors=True)
+
+    def screen_shows(self, text):
+        return any(text in row for row in self.bus.screen())
+
+    # Waits until the LCD shows text, raising if timeout (seconds) passes first
+    def wait_for_screen(self, text, timeout = 60):
+        deadline = hal.clock.monotonic() + timeout
+        while not self.screen_shows(text):
+            if hal.clock.monotonic() >= deadline:
+                raise Exception(f"Screen never showed {text!r}, showing {self.bus.screen()}")
+            hal.clock.sleep(.02)
+
+    # Holds the key at least hold_time and until the keypad has debounced the
+    # press and then the release. At high speed a real thread switch spans
+    # a long simulated time, and a fixed hold could end before the scan.
+    def press(self, key, hold_time = .1):
+        keypad = self.machine.keypad
+        row, col = [(row, col) for row in range(4) for col in range(3) if keypad.keys[row][col] == key][0]
+        hal.clock.sleep(self.random.uniform(*self.think_time))
+        self.gpio.connect(keypad.rows[row], keypad.columns[col])
+        hal.clock.sleep(hold_time)
+        while key not in keypad.stable_keys:
+            hal.clock.sleep(.01)
+        self.gpio.disconnect(keypad.rows[row], keypad.columns[col])
+        while key in keypad.stable_keys:
+            hal.clock.sleep(.01)
+
+    # One customer from the product screen until it is back; returns the
+    # simulated seconds they took
+    def serve(self, behaviour):
+        self.wait_for_screen(SELECT_PRODUCT_TEXT)
+        begin_time = hal.clock.monotonic()
+        self.ePort.outcomes = itertools.repeat({DECLINED: DECLINE, NO_CARD: NO_SWIPE}.get(behaviour, APPROVE))
+        self.roboclaw.jam_probability = 1.0 if behaviour == JAM else 0.0
+
+        self.press(self.random.choice(list(vending_machine.products)))
+        self.wait_for_screen(SELECT_AMOUNT_TEXT)
+        if behaviour == WALK_AWAY:
+            self.wait_for_screen(SELECT_PRODUCT_TEXT)
+            return hal.clock.monotonic() - begin_time
+        self.press(self.random.choice(list(vending_machine.amounts)))
+        self.wait_for_screen(CONFIRM_TEXT)
+        if behaviour == CANCEL:
+            self.press('2')
+            self.wait_for_screen(SELECT_PRODUCT_TEXT)
+            return hal.clock.monotonic() - begin_time
+        self.press('1')
+        self.wait_for_screen(SWIPE_CARD_TEXT)
+        if behaviour in (BUY, JAM):
+            self.wait_for_screen(DISPENSING_TEXT)
+            self.wait_for_screen(THANK_YOU_TEXT if behaviour == BUY else FAILED_TEXT)
+        self.wait_for_screen(SELECT_PRODUCT_TEXT)
+        return hal.clock.monotonic() - begin_time
+
+    # Serves customers customers drawn from mix ({behaviour: weight}); returns
+    # {behaviour: [simulated seconds, ...]}
+    def run(self, customers, mix = default_mix):
+        behaviours = self.random.choices(list(mix), list(mix.values()), k=customers)
+        durations = collections.defaultdict(list)
+        for behaviour in behaviours:
+            durations[behaviour].append(self.serve(behaviour))
+        self.machine.settlement_worker.wait_drained(120)
+        return durations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run simulated customers through the vend loop on a scaled clock')
+    parser.add_argument('--customers', type=int, default=100)
+    parser.add_argument('--speed', type=float, default=100, help='simulated seconds per real second')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    kiosk = SimulatedKiosk(args.speed, args.seed)
+    real_time = time.monotonic()
+    simulated_time = hal.clock.monotonic()
+    durations = kiosk.run(args.customers)
+    real_time = time.monotonic() - real_time
+    simulated_time = hal.clock.monotonic() - simulated_time
+    sales = kiosk.machine.journal.state_counts()
+    jams = len(kiosk.machine.journal.dispense_errors())
+    kiosk.close()
+
+    for behaviour, seconds in sorted(durations.items()):
+        print(f"{behaviour:10} {len(seconds):6} customers, {sum(seconds) / len(seconds):6.1f} s average")
+    print(f"sales      {sales}")
+    print(f"jams       {jams}")
+    print(f"simulated  {simulated_time:.0f} s in {real_time:.1f} s ({simulated_time / real_time:.0f}x real time)")
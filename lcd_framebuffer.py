@@ -0,0 +1,99 @@
+from I2C_LCD_driver import Rs, LCD_SETDDRAMADDR, LCD_ROW_OFFSETS, LCD_WRITE_SEQUENCES
+
+# Shadow copy of a 20x4 lcd. A new screen is diffed against what is on the
+# glass and only the changed runs are written, so LCD_CLEARDISPLAY (and its
+# slow clear/home cycle) is never needed.
+class LcdFramebuffer:
+    # Unchanged cells between two runs are rewritten instead of moving the
+    # cursor when that costs no more writes than a DDRAM address command
+    MERGE_GAP = 1
+
+    def __init__(self, lcd, columns = 20, rows = 4):
+        self.lcd = lcd
+        self.columns = columns
+        self.rows = rows
+        # None marks cells whose contents are unknown, e.g. at boot
+        self.shown = [[None] * columns for row in range(rows)]
+        self.cursor = None
+        self.writes = 0
+
+    def _blank_frame(self):
+        return [[' '] * self.columns for row in range(self.rows)]
+
+    def _place(self, frame, string, line = 1, pos = 0):
+        cells = frame[line - 1]
+        for column, char in enumerate(string[:max(0, self.columns - pos)], pos):
+            cells[column] = char
+
+    # lines: (string, line, pos) tuples, as taken by lcd.lcd_display_string,
+    # placed on a copy of base (a blank screen by default)
+    def compose(self, *lines, base = None):
+        frame = [list(row) for row in base] if base is not None else self._blank_frame()
+        for line in lines:
+            self._place(frame, *line)
+        return frame
+
+    # every cell not covered by lines is blank
+    def show(self, *lines):
+        self.draw(self.compose(*lines))
+
+    # screen: (frame, burst) from ScreenRegistry.render
+    def show_screen(self, screen):
+        self.draw(*screen)
+
+    # Rows go out in DDRAM address order so a full redraw needs one cursor move
+    # and all changed runs are sent as one I2C byte sequence. burst, the
+    # precompiled full-screen sequence of frame (see ScreenRegistry), is sent
+    # instead when it is no longer than the diff.
+    def draw(self, frame, burst = None):
+        sequence = bytearray()
+        for row in sorted(range(self.rows), key=lambda row: LCD_ROW_OFFSETS[row]):
+            for start, end in self._runs(self.shown[row], frame[row]):
+                self._encode_run(sequence, row, start, frame[row][start:end])
+        if burst is not None and len(burst) <= len(sequence):
+            sequence = burst
+            # The last cell of a full screen is 0x67, which wraps to 0x00
+            self.cursor = 0x00
+        if sequence:
+            self.lcd.lcd_write_sequence(bytes(sequence))
+            self.writes += len(sequence) // len(LCD_WRITE_SEQUENCES[0][0])
+
+    # Changed [start, end) column ranges of a row, merged across small gaps
+    def _runs(self, shown, wanted):
+        runs = []
+        for column in range(self.columns):
+            if shown[column] == wanted[column]:
+                continue
+            if runs and column - runs[-1][1] <= LcdFramebuffer.MERGE_GAP:
+                runs[-1][1] = column + 1
+            else:
+                runs.append([column, column + 1])
+        return runs
+
+    def _encode_run(self, sequence, row, start, chars):
+        address = LCD_ROW_OFFSETS[row] + start
+        if address != self.cursor:
+            sequence += LCD_WRITE_SEQUENCES[0][LCD_SETDDRAMADDR + address]
+        characters = LCD_WRITE_SEQUENCES[Rs]
+        for char in chars:
+            sequence += characters[ord(char) & 0xFF]
+        self.shown[row][start:start + len(chars)] = chars
+        # The address counter runs on across rows in DDRAM order and wraps
+        # from the end of each 40 cell DDRAM line to the start of the other
+        self.cursor = {0x28: 0x40, 0x68: 0x00}.get(address + len(chars), address + len(chars))
+
+    # Drop-in replacements for the lcd methods of the same name
+    def lcd_clear(self):
+        self.draw(self._blank_frame())
+
+    def lcd_display_string(self, string, line = 1, pos = 0):
+        self.draw(self.compose((string, line, pos), base = self.current_frame()))
+
+    # What is on the glass, unknown cells read as blank
+    def current_frame(self):
+        return [[char if char is not None else ' ' for char in row] for row in self.shown]
+
+    # Forgets the shadow copy, e.g. after something else wrote to the lcd
+    def invalidate(self):
+        self.shown = [[None] * self.columns for row in range(self.rows)]
+        self.cursor = None
@@ -0,0 +1,79 @@
+import threading
+import traceback
+
+# Owns an LcdFramebuffer on its own thread. Callers hand over screens and
+# return at once; screens submitted while one is being drawn replace each
+# other, so only the most recent is drawn next.
+class LcdRenderer:
+    def __init__(self, framebuffer):
+        self.framebuffer = framebuffer
+        self.requested = 0
+        self.drawn = 0
+        self.errors = 0
+        self._frame = framebuffer.compose()
+        self._burst = None
+        self._pending = False
+        self._drawing = False
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='LcdRenderer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, frame, burst = None):
+        with self._condition:
+            self._frame = frame
+            self._burst = burst
+            self._pending = True
+            self.requested += 1
+            self._condition.notify_all()
+
+    # Same calls as LcdFramebuffer, queued instead of drawn
+    def show(self, *lines):
+        self.submit(self.framebuffer.compose(*lines))
+
+    def show_screen(self, screen):
+        self.submit(*screen)
+
+    def lcd_clear(self):
+        self.submit(self.framebuffer.compose())
+
+    def lcd_display_string(self, string, line = 1, pos = 0):
+        with self._condition:
+            self.submit(self.framebuffer.compose((string, line, pos), base = self._frame))
+
+    # Waits until the latest screen is on the glass; False on timeout
+    def flush(self, timeout = None):
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._drawing, timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._stopping)
+                if self._stopping:
+                    return
+                frame, burst = self._frame, self._burst
+                self._pending = False
+                self._drawing = True
+            try:
+                self.framebuffer.draw(frame, burst)
+            except Exception:
+                self.errors += 1
+                self.framebuffer.invalidate()
+                traceback.print_exc()
+            with self._condition:
+                self._drawing = False
+                self.drawn += 1
+                self._condition.notify_all()
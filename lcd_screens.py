@@ -0,0 +1,60 @@
+from I2C_LCD_driver import Rs, LCD_SETDDRAMADDR, LCD_ROW_OFFSETS, LCD_WRITE_SEQUENCES
+
+# Display rows in DDRAM address order, the order a full-screen burst writes them
+BURST_ROW_ORDER = sorted(range(len(LCD_ROW_OFFSETS)), key=lambda row: LCD_ROW_OFFSETS[row])
+CELL_SEQUENCE_LENGTH = len(LCD_WRITE_SEQUENCES[Rs][0])
+
+# A screen compiled once into its 20x4 frame and the I2C byte sequence that
+# writes it whole. Fields are (line, pos, width) regions patched in render().
+class CompiledScreen:
+    def __init__(self, name, lines, fields = {}, columns = 20, rows = 4):
+        self.name = name
+        self.columns = columns
+        self.fields = dict(fields)
+        frame = [[' '] * columns for row in range(rows)]
+        for string, line, pos in lines:
+            frame[line - 1][pos:pos + len(string)] = string[:max(0, columns - pos)]
+        self.frame = [''.join(row) for row in frame]
+        burst = bytearray(LCD_WRITE_SEQUENCES[0][LCD_SETDDRAMADDR + LCD_ROW_OFFSETS[BURST_ROW_ORDER[0]]])
+        for row in BURST_ROW_ORDER:
+            burst += self._encode(self.frame[row])
+        self.burst = bytes(burst)
+
+    def _encode(self, string):
+        characters = LCD_WRITE_SEQUENCES[Rs]
+        return b''.join(characters[ord(char) & 0xFF] for char in string)
+
+    # Offset of a cell's sequence in burst
+    def _offset(self, row, column):
+        return CELL_SEQUENCE_LENGTH * (1 + BURST_ROW_ORDER.index(row) * self.columns + column)
+
+    # Returns (frame, burst) with each field's value left aligned, blank
+    # padded and cut to the field width
+    def render(self, **values):
+        if not values:
+            return self.frame, self.burst
+        frame = list(self.frame)
+        burst = bytearray(self.burst)
+        for name, value in values.items():
+            line, pos, width = self.fields[name]
+            text = str(value)[:width].ljust(width)
+            row = line - 1
+            frame[row] = frame[row][:pos] + text + frame[row][pos + width:]
+            offset = self._offset(row, pos)
+            burst[offset:offset + CELL_SEQUENCE_LENGTH * width] = self._encode(text)
+        return frame, bytes(burst)
+
+# Named kiosk screens, compiled at boot and again whenever the catalog changes
+class ScreenRegistry:
+    def __init__(self, columns = 20, rows = 4):
+        self.columns = columns
+        self.rows = rows
+        self.screens = {}
+
+    # lines: static (string, line, pos) tuples; fields: name -> (line, pos, width)
+    def register(self, name, lines, fields = {}):
+        self.screens[name] = CompiledScreen(name, lines, fields, self.columns, self.rows)
+        return self.screens[name]
+
+    def render(self, name, **values):
+        return self.screens[name].render(**values)
@@ -1,7 +1,37 @@
 import random
-import serial
 import struct
-import time
+import hal
+from crc16 import crc16, crc16_update
+
+_FIELDS = {'1': ('B',0xFF), '2': ('H',0xFFFF), '4': ('I',0xFFFFFFFF)}
+
+#Write payload layouts, named by field width in bytes (S marks a signed field)
+_WRITELAYOUTS = (
+	'0', '1', '11', '111', '2', 'S2',
+	'22', 'S22', 'S2S2', 'S24', 'S24S24', '4',
+	'S4', '44', '4S4', 'S4S4', '441', 'S441',
+	'4S4S4', '4S441', '4444', '4S44S4', '44441', 'S44S441',
+	'4S44S441', '4S444S441', '4444444', '444444441',
+)
+
+def _compilelayout(layout):
+	widths = layout.replace('S','').replace('0','')
+	frame = struct.Struct('>BB' + ''.join(_FIELDS[width][0] for width in widths))
+	return (frame,tuple(_FIELDS[width][1] for width in widths))
+
+_WRITEFORMATS = {layout: _compilelayout(layout) for layout in _WRITELAYOUTS}
+
+#Fixed length replies: payload followed by the CRC word
+_READ1 = struct.Struct('>BH')
+_READ2 = struct.Struct('>HH')
+_READ4 = struct.Struct('>IH')
+_READ4_1 = struct.Struct('>iBH')
+_READ111 = struct.Struct('>BBBH')
+_READ11 = struct.Struct('>BBH')
+_READ22 = struct.Struct('>HHH')
+_READS2S2 = struct.Struct('>hhH')
+#_read_n replies by count of unsigned longs
+_READNFORMATS = {count: struct.Struct('>%dIH' % count) for count in (2,4,7)}
 
 class Roboclaw:
 	'Roboclaw Interface Class'
@@ -12,6 +42,7 @@ class Roboclaw:
 		self.timeout = timeout;
 		self._trystimeout = retries
 		self._crc = 0;
+		self.pipeline_fallbacks = 0
 
 	#Command Enums
 	class Cmd():
@@ -107,6 +138,30 @@ class Roboclaw:
 		READEEPROM = 252
 		WRITEEEPROM = 253
 		FLAGBOOTLOADER = 255
+
+	#Reply layouts of the fixed length read commands that can be pipelined
+	_readreplies = {
+		Cmd.GETM1ENC: _READ4_1,
+		Cmd.GETM2ENC: _READ4_1,
+		Cmd.GETM1SPEED: _READ4_1,
+		Cmd.GETM2SPEED: _READ4_1,
+		Cmd.GETMBATT: _READ2,
+		Cmd.GETLBATT: _READ2,
+		Cmd.GETM1ISPEED: _READ4_1,
+		Cmd.GETM2ISPEED: _READ4_1,
+		Cmd.GETBUFFERS: _READ11,
+		Cmd.GETPWMS: _READS2S2,
+		Cmd.GETCURRENTS: _READS2S2,
+		Cmd.GETMINMAXMAINVOLTAGES: _READ22,
+		Cmd.GETMINMAXLOGICVOLTAGES: _READ22,
+		Cmd.GETDEADBAND: _READ11,
+		Cmd.GETTEMP: _READ2,
+		Cmd.GETTEMP2: _READ2,
+		Cmd.GETERROR: _READ4,
+		Cmd.GETENCODERMODE: _READ11,
+		Cmd.GETCONFIG: _READ2,
+		Cmd.GETPWMMODE: _READ1,
+	}
 			
 	#Private Functions
 	def crc_clear(self):
@@ -114,22 +169,13 @@ class Roboclaw:
 		return
 		
 	def crc_update(self,data):
-		self._crc = self._crc ^ (data << 8)
-		for bit in range(0, 8):
-			if (self._crc&0x8000)  == 0x8000:
-				self._crc = ((self._crc << 1) ^ 0x1021)
-			else:
-				self._crc = self._crc << 1
+		self._crc = crc16_update(self._crc,data)
 		return
 
 	def _sendcommand(self,address,command):
-		self.crc_clear()
-		self.crc_update(address)
-#		self._port.write(chr(address))
-		self._port.write(address.to_bytes(1, 'big'))
-		self.crc_update(command)
-#		self._port.write(chr(command))
-		self._port.write(command.to_bytes(1, 'big'))
+		request = bytes((address,command))
+		self._crc = crc16(request)
+		self._port.write(request)
 		return
 
 	def _readchecksumword(self):
@@ -140,504 +186,88 @@ class Roboclaw:
 			return (1,crc)	
 		return (0,0)
 		
-	def _readbyte(self):
-		data = self._port.read(1)
-		if len(data):
-			val = ord(data)
-			self.crc_update(val)
-			return (1,val)	
-		return (0,0)
-		
-	def _readword(self):
-		val1 = self._readbyte()
-		if val1[0]:
-			val2 = self._readbyte()
-			if val2[0]:
-				return (1,val1[1]<<8|val2[1])
-		return (0,0)
-
-	def _readlong(self):
-		val1 = self._readbyte()
-		if val1[0]:
-			val2 = self._readbyte()
-			if val2[0]:
-				val3 = self._readbyte()
-				if val3[0]:
-					val4 = self._readbyte()
-					if val4[0]:
-						return (1,val1[1]<<24|val2[1]<<16|val3[1]<<8|val4[1])
-		return (0,0)	
-
-	def _readslong(self):
-		val = self._readlong()
-		if val[0]:
-			if val[1]&0x80000000:
-				return (val[0],val[1]-0x100000000)
-			return (val[0],val[1])
-		return (0,0)
-
-	def _writebyte(self,val):
-		self.crc_update(val&0xFF)
-#		self._port.write(chr(val&0xFF))
-		self._port.write(val.to_bytes(1, 'big'))
-
-	def _writesbyte(self,val):
-		self._writebyte(val)
-
-	def _writeword(self,val):
-		self._writebyte((val>>8)&0xFF)
-		self._writebyte(val&0xFF)
-		
-	def _writesword(self,val):
-		self._writeword(val)
-
-	def _writelong(self,val):
-		self._writebyte((val>>24)&0xFF)
-		self._writebyte((val>>16)&0xFF)
-		self._writebyte((val>>8)&0xFF)
-		self._writebyte(val&0xFF)
-
-	def _writeslong(self,val):
-		self._writelong(val)
-
-	def _read1(self,address,cmd):
+	def _readreply(self,address,cmd,reply,args=b''):
+		request = bytes((address,cmd)) + args
+		requestcrc = crc16(request)
 		trys = self._trystimeout
 		while 1:
 			self._port.flushInput()
-			self._sendcommand(address,cmd)
-			val1 = self._readbyte()
-			if val1[0]:
-				crc = self._readchecksumword()
-				if crc[0]:
-					if self._crc&0xFFFF!=crc[1]&0xFFFF:
-						return (0,0)
-					return (1,val1[1])
+			self._port.write(request)
+			data = self._port.read(reply.size)
+			if len(data)==reply.size:
+				view = memoryview(data)
+				vals = reply.unpack_from(view)
+				if crc16(view[:-2],requestcrc)!=vals[-1]:
+					return None
+				return vals[:-1]
 			trys-=1
 			if trys==0:
 				break
+		return None
+
+	def _readpipelined(self,address,cmds):
+		replies = [self._readreplies[cmd] for cmd in cmds]
+		size = sum(reply.size for reply in replies)
+		self._port.flushInput()
+		self._port.write(b''.join(bytes((address,cmd)) for cmd in cmds))
+		data = self._port.read(size)
+		if len(data)==size:
+			view = memoryview(data)
+			offset = 0
+			results = []
+			for cmd,reply in zip(cmds,replies):
+				vals = reply.unpack_from(view,offset)
+				if crc16(view[offset:offset+reply.size-2],crc16(bytes((address,cmd))))!=vals[-1]:
+					break
+				results.append(vals[:-1])
+				offset += reply.size
+			else:
+				return results
+		#Short read or CRC error, fall back to one round trip per command
+		self.pipeline_fallbacks += 1
+		return [self._readreply(address,cmd,reply) for cmd,reply in zip(cmds,replies)]
+
+	def _read1(self,address,cmd):
+		vals = self._readreply(address,cmd,_READ1)
+		if vals:
+			return (1,vals[0])
 		return (0,0)
 
 	def _read2(self,address,cmd):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,cmd)
-			val1 = self._readword()
-			if val1[0]:
-				crc = self._readchecksumword()
-				if crc[0]:
-					if self._crc&0xFFFF!=crc[1]&0xFFFF:
-						return (0,0)
-					return (1,val1[1])
-			trys-=1
-			if trys==0:
-				break
+		vals = self._readreply(address,cmd,_READ2)
+		if vals:
+			return (1,vals[0])
 		return (0,0)
 
 	def _read4(self,address,cmd):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,cmd)
-			val1 = self._readlong()
-			if val1[0]:
-				crc = self._readchecksumword()
-				if crc[0]:
-					if self._crc&0xFFFF!=crc[1]&0xFFFF:
-						return (0,0)
-					return (1,val1[1])
-			trys-=1
-			if trys==0:
-				break
+		vals = self._readreply(address,cmd,_READ4)
+		if vals:
+			return (1,vals[0])
 		return (0,0)
 
 	def _read4_1(self,address,cmd):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,cmd)
-			val1 = self._readslong()
-			if val1[0]:
-				val2 = self._readbyte()
-				if val2[0]:
-					crc = self._readchecksumword()
-					if crc[0]:
-						if self._crc&0xFFFF!=crc[1]&0xFFFF:
-							return (0,0)
-						return (1,val1[1],val2[1])
-			trys-=1
-			if trys==0:
-				break
+		vals = self._readreply(address,cmd,_READ4_1)
+		if vals:
+			return (1,vals[0],vals[1])
 		return (0,0)
 
 	def _read_n(self,address,cmd,args):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			trys-=1
-			if trys==0:
-				break
-			failed=False
-			self._sendcommand(address,cmd)
-			data = [1,]
-			for i in range(0,args):
-				val = self._readlong()
-				if val[0]==0:
-					failed=True
-					break
-				data.append(val[1])
-			if failed:
-				continue
-			crc = self._readchecksumword()
-			if crc[0]:
-				if self._crc&0xFFFF==crc[1]&0xFFFF:
-					return (data);
+		vals = self._readreply(address,cmd,_READNFORMATS[args])
+		if vals:
+			return [1,*vals]
 		return (0,0,0,0,0)
 
-	def _writechecksum(self):
-		self._writeword(self._crc&0xFFFF)
-		val = self._readbyte()
-		if(len(val)>0):
-			if val[0]:
-				return True
-		return False
-
-	def _write0(self,address,cmd):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write1(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writebyte(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write11(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writebyte(val1)
-			self._writebyte(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write111(self,address,cmd,val1,val2,val3):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writebyte(val1)
-			self._writebyte(val2)
-			self._writebyte(val3)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write2(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeword(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _writeS2(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write22(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeword(val1)
-			self._writeword(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+	def _encodeframe(self,address,cmd,layout,vals):
+		frame,masks = _WRITEFORMATS[layout]
+		body = frame.pack(address,cmd,*[val&mask for val,mask in zip(vals,masks)])
+		return body + crc16(body).to_bytes(2, 'big')
 
-	def _writeS22(self,address,cmd,val1,val2):
+	def _write(self,address,cmd,layout,*vals):
+		frame = self._encodeframe(address,cmd,layout,vals)
 		trys=self._trystimeout
 		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val1)
-			self._writeword(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _writeS2S2(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val1)
-			self._writesword(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _writeS24(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val1)
-			self._writelong(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _writeS24S24(self,address,cmd,val1,val2,val3,val4):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val1)
-			self._writelong(val2)
-			self._writesword(val3)
-			self._writelong(val4)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _writeS4(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeslong(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write44(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4S4(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _writeS4S4(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeslong(val1)
-			self._writeslong(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write441(self,address,cmd,val1,val2,val3):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writebyte(val3)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _writeS441(self,address,cmd,val1,val2,val3):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeslong(val1)
-			self._writelong(val2)
-			self._writebyte(val3)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4S4S4(self,address,cmd,val1,val2,val3):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writeslong(val3)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4S441(self,address,cmd,val1,val2,val3,val4):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writelong(val3)
-			self._writebyte(val4)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4444(self,address,cmd,val1,val2,val3,val4):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4S44S4(self,address,cmd,val1,val2,val3,val4):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writelong(val3)
-			self._writeslong(val4)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write44441(self,address,cmd,val1,val2,val3,val4,val5):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			self._writebyte(val5)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _writeS44S441(self,address,cmd,val1,val2,val3,val4,val5):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeslong(val1)
-			self._writelong(val2)
-			self._writeslong(val3)
-			self._writelong(val4)
-			self._writebyte(val5)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4S44S441(self,address,cmd,val1,val2,val3,val4,val5,val6):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writelong(val3)
-			self._writeslong(val4)
-			self._writelong(val5)
-			self._writebyte(val6)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4S444S441(self,address,cmd,val1,val2,val3,val4,val5,val6,val7):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(self,address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			self._writeslong(val5)
-			self._writelong(val6)
-			self._writebyte(val7)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write4444444(self,address,cmd,val1,val2,val3,val4,val5,val6,val7):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			self._writelong(val5)
-			self._writelong(val6)
-			self._writelong(val7)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
-
-	def _write444444441(self,address,cmd,val1,val2,val3,val4,val5,val6,val7,val8,val9):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			self._writelong(val5)
-			self._writelong(val6)
-			self._writelong(val7)
-			self._writelong(val8)
-			self._writebyte(val9)
-			if self._writechecksum():
+			self._port.write(frame)
+			if len(self._port.read(1)):
 				return True
 			trys=trys-1
 		return False
@@ -651,46 +281,61 @@ class Roboclaw:
 		return
 
 	def ForwardM1(self,address,val):
-		return self._write1(address,self.Cmd.M1FORWARD,val)
+		return self._write(address,self.Cmd.M1FORWARD,'1',val)
 
 	def BackwardM1(self,address,val):
-		return self._write1(address,self.Cmd.M1BACKWARD,val)
+		return self._write(address,self.Cmd.M1BACKWARD,'1',val)
 
 	def SetMinVoltageMainBattery(self,address,val):
-		return self._write1(address,self.Cmd.SETMINMB,val)
+		return self._write(address,self.Cmd.SETMINMB,'1',val)
 
 	def SetMaxVoltageMainBattery(self,address,val):
-		return self._write1(address,self.Cmd.SETMAXMB,val)
+		return self._write(address,self.Cmd.SETMAXMB,'1',val)
 
 	def ForwardM2(self,address,val):
-		return self._write1(address,self.Cmd.M2FORWARD,val)
+		return self._write(address,self.Cmd.M2FORWARD,'1',val)
 
 	def BackwardM2(self,address,val):
-		return self._write1(address,self.Cmd.M2BACKWARD,val)
+		return self._write(address,self.Cmd.M2BACKWARD,'1',val)
 
 	def ForwardBackwardM1(self,address,val):
-		return self._write1(address,self.Cmd.M17BIT,val)
+		return self._write(address,self.Cmd.M17BIT,'1',val)
 
 	def ForwardBackwardM2(self,address,val):
-		return self._write1(address,self.Cmd.M27BIT,val)
+		return self._write(address,self.Cmd.M27BIT,'1',val)
 
 	def ForwardMixed(self,address,val):
-		return self._write1(address,self.Cmd.MIXEDFORWARD,val)
+		return self._write(address,self.Cmd.MIXEDFORWARD,'1',val)
 
 	def BackwardMixed(self,address,val):
-		return self._write1(address,self.Cmd.MIXEDBACKWARD,val)
+		return self._write(address,self.Cmd.MIXEDBACKWARD,'1',val)
 
 	def TurnRightMixed(self,address,val):
-		return self._write1(address,self.Cmd.MIXEDRIGHT,val)
+		return self._write(address,self.Cmd.MIXEDRIGHT,'1',val)
 
 	def TurnLeftMixed(self,address,val):
-		return self._write1(address,self.Cmd.MIXEDLEFT,val)
+		return self._write(address,self.Cmd.MIXEDLEFT,'1',val)
 
 	def ForwardBackwardMixed(self,address,val):
-		return self._write1(address,self.Cmd.MIXEDFB,val)
+		return self._write(address,self.Cmd.MIXEDFB,'1',val)
 
 	def LeftRightMixed(self,address,val):
-		return self._write1(address,self.Cmd.MIXEDLR,val)
+		return self._write(address,self.Cmd.MIXEDLR,'1',val)
+
+	#Sends all read commands back to back and returns one result per command,
+	#each shaped like the matching single read function's return value
+	def ReadPipelined(self,address,cmds):
+		results = []
+		for cmd,vals in zip(cmds,self._readpipelined(address,cmds)):
+			if vals:
+				results.append((1,*vals))
+			else:
+				#Same shape as the single read functions: a status and one zero per
+				#payload field, i.e. len(format) less '>' and the CRC 'H', plus one.
+				#_read4_1 (encoders, speeds) fails as (0,0) instead of (0,0,0)
+				reply = self._readreplies[cmd]
+				results.append((0,0) if reply is _READ4_1 else (0,)*(len(reply.format)-1))
+		return results
 
 	def ReadEncM1(self,address):
 		return self._read4_1(address,self.Cmd.GETM1ENC)
@@ -705,7 +350,7 @@ class Roboclaw:
 		return self._read4_1(address,self.Cmd.GETM2SPEED)
 
 	def ResetEncoders(self,address):
-		return self._write0(address,self.Cmd.RESETENC)
+		return self._write(address,self.Cmd.RESETENC,'0')
 
 	def ReadVersion(self,address):
 		trys=self._trystimeout
@@ -732,17 +377,17 @@ class Roboclaw:
 					if self._crc&0xFFFF==crc[1]&0xFFFF:
 						return (1,str)
 					else:
-						time.sleep(0.01)
+						hal.clock.sleep(0.01)
 			trys-=1
 			if trys==0:
 				break
 		return (0,0)
 
 	def SetEncM1(self,address,cnt):
-		return self._write4(address,self.Cmd.SETM1ENCCOUNT,cnt)
+		return self._write(address,self.Cmd.SETM1ENCCOUNT,'4',cnt)
 
 	def SetEncM2(self,address,cnt):
-		return self._write4(address,self.Cmd.SETM2ENCCOUNT,cnt)
+		return self._write(address,self.Cmd.SETM2ENCCOUNT,'4',cnt)
 
 	def ReadMainBatteryVoltage(self,address):
 		return self._read2(address,self.Cmd.GETMBATT)
@@ -751,18 +396,16 @@ class Roboclaw:
 		return self._read2(address,self.Cmd.GETLBATT)
 
 	def SetMinVoltageLogicBattery(self,address,val):
-		return self._write1(address,self.Cmd.SETMINLB,val)
+		return self._write(address,self.Cmd.SETMINLB,'1',val)
 
 	def SetMaxVoltageLogicBattery(self,address,val):
-		return self._write1(address,self.Cmd.SETMAXLB,val)
+		return self._write(address,self.Cmd.SETMAXLB,'1',val)
 
 	def SetM1VelocityPID(self,address,p,i,d,qpps):
-#		return self._write4444(address,self.Cmd.SETM1PID,long(d*65536),long(p*65536),long(i*65536),qpps)
-		return self._write4444(address,self.Cmd.SETM1PID,d*65536,p*65536,i*65536,qpps)
+		return self._write(address,self.Cmd.SETM1PID,'4444',int(d*65536),int(p*65536),int(i*65536),qpps)
 
 	def SetM2VelocityPID(self,address,p,i,d,qpps):
-#		return self._write4444(address,self.Cmd.SETM2PID,long(d*65536),long(p*65536),long(i*65536),qpps)
-		return self._write4444(address,self.Cmd.SETM2PID,d*65536,p*65536,i*65536,qpps)
+		return self._write(address,self.Cmd.SETM2PID,'4444',int(d*65536),int(p*65536),int(i*65536),qpps)
 
 	def ReadISpeedM1(self,address):
 		return self._read4_1(address,self.Cmd.GETM1ISPEED)
@@ -771,49 +414,49 @@ class Roboclaw:
 		return self._read4_1(address,self.Cmd.GETM2ISPEED)
 
 	def DutyM1(self,address,val):
-		return self._writeS2(address,self.Cmd.M1DUTY,val)
+		return self._write(address,self.Cmd.M1DUTY,'S2',val)
 
 	def DutyM2(self,address,val):
-		return self._writeS2(address,self.Cmd.M2DUTY,val)
+		return self._write(address,self.Cmd.M2DUTY,'S2',val)
 
 	def DutyM1M2(self,address,m1,m2):
-		return self._writeS2S2(address,self.Cmd.MIXEDDUTY,m1,m2)
+		return self._write(address,self.Cmd.MIXEDDUTY,'S2S2',m1,m2)
 
 	def SpeedM1(self,address,val):
-		return self._writeS4(address,self.Cmd.M1SPEED,val)
+		return self._write(address,self.Cmd.M1SPEED,'S4',val)
 
 	def SpeedM2(self,address,val):
-		return self._writeS4(address,self.Cmd.M2SPEED,val)
+		return self._write(address,self.Cmd.M2SPEED,'S4',val)
 
 	def SpeedM1M2(self,address,m1,m2):
-		return self._writeS4S4(address,self.Cmd.MIXEDSPEED,m1,m2)
+		return self._write(address,self.Cmd.MIXEDSPEED,'S4S4',m1,m2)
 
 	def SpeedAccelM1(self,address,accel,speed):
-		return self._write4S4(address,self.Cmd.M1SPEEDACCEL,accel,speed)
+		return self._write(address,self.Cmd.M1SPEEDACCEL,'4S4',accel,speed)
 
 	def SpeedAccelM2(self,address,accel,speed):
-		return self._write4S4(address,self.Cmd.M2SPEEDACCEL,accel,speed)
+		return self._write(address,self.Cmd.M2SPEEDACCEL,'4S4',accel,speed)
 
 	def SpeedAccelM1M2(self,address,accel,speed1,speed2):
-		return self._write4S4S4(address,self.Cmd.MIXEDSPEEDACCEL,accel,speed1,speed2)
+		return self._write(address,self.Cmd.MIXEDSPEEDACCEL,'4S4S4',accel,speed1,speed2)
 
 	def SpeedDistanceM1(self,address,speed,distance,buffer):
-		return self._writeS441(address,self.Cmd.M1SPEEDDIST,speed,distance,buffer)
+		return self._write(address,self.Cmd.M1SPEEDDIST,'S441',speed,distance,buffer)
 
 	def SpeedDistanceM2(self,address,speed,distance,buffer):
-		return self._writeS441(address,self.Cmd.M2SPEEDDIST,speed,distance,buffer)
+		return self._write(address,self.Cmd.M2SPEEDDIST,'S441',speed,distance,buffer)
 
 	def SpeedDistanceM1M2(self,address,speed1,distance1,speed2,distance2,buffer):
-		return self._writeS44S441(address,self.Cmd.MIXEDSPEEDDIST,speed1,distance1,speed2,distance2,buffer)
+		return self._write(address,self.Cmd.MIXEDSPEEDDIST,'S44S441',speed1,distance1,speed2,distance2,buffer)
 
 	def SpeedAccelDistanceM1(self,address,accel,speed,distance,buffer):
-		return self._write4S441(address,self.Cmd.M1SPEEDACCELDIST,accel,speed,distance,buffer)
+		return self._write(address,self.Cmd.M1SPEEDACCELDIST,'4S441',accel,speed,distance,buffer)
 
 	def SpeedAccelDistanceM2(self,address,accel,speed,distance,buffer):
-		return self._write4S441(address,self.Cmd.M2SPEEDACCELDIST,accel,speed,distance,buffer)
+		return self._write(address,self.Cmd.M2SPEEDACCELDIST,'4S441',accel,speed,distance,buffer)
 
 	def SpeedAccelDistanceM1M2(self,address,accel,speed1,distance1,speed2,distance2,buffer):
-		return self._write4S44S441(address,self.Cmd.MIXEDSPEEDACCELDIST,accel,speed1,distance1,speed2,distance2,buffer)
+		return self._write(address,self.Cmd.MIXEDSPEEDACCELDIST,'4S44S441',accel,speed1,distance1,speed2,distance2,buffer)
 
 	def ReadBuffers(self,address):
 		val = self._read2(address,self.Cmd.GETBUFFERS)
@@ -846,19 +489,19 @@ class Roboclaw:
 		return (0,0,0)
 
 	def SpeedAccelM1M2_2(self,address,accel1,speed1,accel2,speed2):
-		return self._write4S44S4(address,self.Cmd.MIXEDSPEED2ACCEL,accel,speed1,accel2,speed2)
+		return self._write(address,self.Cmd.MIXEDSPEED2ACCEL,'4S44S4',accel1,speed1,accel2,speed2)
 
 	def SpeedAccelDistanceM1M2_2(self,address,accel1,speed1,distance1,accel2,speed2,distance2,buffer):
-		return self._write4S444S441(address,self.Cmd.MIXEDSPEED2ACCELDIST,accel1,speed1,distance1,accel2,speed2,distance2,buffer)
+		return self._write(address,self.Cmd.MIXEDSPEED2ACCELDIST,'4S444S441',accel1,speed1,distance1,accel2,speed2,distance2,buffer)
 
 	def DutyAccelM1(self,address,accel,duty):
-		return self._writeS24(address,self.Cmd.M1DUTYACCEL,duty,accel)
+		return self._write(address,self.Cmd.M1DUTYACCEL,'S24',duty,accel)
 
 	def DutyAccelM2(self,address,accel,duty):
-		return self._writeS24(address,self.Cmd.M2DUTYACCEL,duty,accel)
+		return self._write(address,self.Cmd.M2DUTYACCEL,'S24',duty,accel)
 
 	def DutyAccelM1M2(self,address,accel1,duty1,accel2,duty2):
-		return self._writeS24S24(address,self.Cmd.MIXEDDUTYACCEL,duty1,accel1,duty2,accel2)
+		return self._write(address,self.Cmd.MIXEDDUTYACCEL,'S24S24',duty1,accel1,duty2,accel2)
 		
 	def ReadM1VelocityPID(self,address):
 		data = self._read_n(address,self.Cmd.READM1PID,4)
@@ -879,10 +522,10 @@ class Roboclaw:
 		return (0,0,0,0,0)
 
 	def SetMainVoltages(self,address,min, max):
-		return self._write22(address,self.Cmd.SETMAINVOLTAGES,min,max)
+		return self._write(address,self.Cmd.SETMAINVOLTAGES,'22',min,max)
 		
 	def SetLogicVoltages(self,address,min, max):
-		return self._write22(address,self.Cmd.SETLOGICVOLTAGES,min,max)
+		return self._write(address,self.Cmd.SETLOGICVOLTAGES,'22',min,max)
 		
 	def ReadMinMaxMainVoltages(self,address):
 		val = self._read4(address,self.Cmd.GETMINMAXMAINVOLTAGES)
@@ -901,12 +544,10 @@ class Roboclaw:
 		return (0,0,0)
 
 	def SetM1PositionPID(self,address,kp,ki,kd,kimax,deadzone,min,max):
-#		return self._write4444444(address,self.Cmd.SETM1POSPID,long(kd*1024),long(kp*1024),long(ki*1024),kimax,deadzone,min,max)
-		return self._write4444444(address,self.Cmd.SETM1POSPID,kd*1024,kp*1024,ki*1024,kimax,deadzone,min,max)
+		return self._write(address,self.Cmd.SETM1POSPID,'4444444',int(kd*1024),int(kp*1024),int(ki*1024),kimax,deadzone,min,max)
 
 	def SetM2PositionPID(self,address,kp,ki,kd,kimax,deadzone,min,max):
-#		return self._write4444444(address,self.Cmd.SETM2POSPID,long(kd*1024),long(kp*1024),long(ki*1024),kimax,deadzone,min,max)
-		return self._write4444444(address,self.Cmd.SETM2POSPID,kd*1024,kp*1024,ki*1024,kimax,deadzone,min,max)
+		return self._write(address,self.Cmd.SETM2POSPID,'4444444',int(kd*1024),int(kp*1024),int(ki*1024),kimax,deadzone,min,max)
 
 	def ReadM1PositionPID(self,address):
 		data = self._read_n(address,self.Cmd.READM1POSPID,7)
@@ -927,45 +568,31 @@ class Roboclaw:
 		return (0,0,0,0,0,0,0,0)
 
 	def SpeedAccelDeccelPositionM1(self,address,accel,speed,deccel,position,buffer):
-		return self._write44441(address,self.Cmd.M1SPEEDACCELDECCELPOS,accel,speed,deccel,position,buffer)
+		return self._write(address,self.Cmd.M1SPEEDACCELDECCELPOS,'44441',accel,speed,deccel,position,buffer)
 
 	def SpeedAccelDeccelPositionM2(self,address,accel,speed,deccel,position,buffer):
-		return self._write44441(address,self.Cmd.M2SPEEDACCELDECCELPOS,accel,speed,deccel,position,buffer)
+		return self._write(address,self.Cmd.M2SPEEDACCELDECCELPOS,'44441',accel,speed,deccel,position,buffer)
 
 	def SpeedAccelDeccelPositionM1M2(self,address,accel1,speed1,deccel1,position1,accel2,speed2,deccel2,position2,buffer):
-		return self._write444444441(address,self.Cmd.MIXEDSPEEDACCELDECCELPOS,accel1,speed1,deccel1,position1,accel2,speed2,deccel2,position2,buffer)
+		return self._write(address,self.Cmd.MIXEDSPEEDACCELDECCELPOS,'444444441',accel1,speed1,deccel1,position1,accel2,speed2,deccel2,position2,buffer)
 
 	def SetM1DefaultAccel(self,address,accel):
-		return self._write4(address,self.Cmd.SETM1DEFAULTACCEL,accel)
+		return self._write(address,self.Cmd.SETM1DEFAULTACCEL,'4',accel)
 
 	def SetM2DefaultAccel(self,address,accel):
-		return self._write4(address,self.Cmd.SETM2DEFAULTACCEL,accel)
+		return self._write(address,self.Cmd.SETM2DEFAULTACCEL,'4',accel)
 
 	def SetPinFunctions(self,address,S3mode,S4mode,S5mode):
-		return self._write111(address,self.Cmd.SETPINFUNCTIONS,S3mode,S4mode,S5mode)
+		return self._write(address,self.Cmd.SETPINFUNCTIONS,'111',S3mode,S4mode,S5mode)
 
 	def ReadPinFunctions(self,address):
-		trys = self._trystimeout
-		while 1:
-			self._sendcommand(address,self.Cmd.GETPINFUNCTIONS)
-			val1 = self._readbyte()
-			if val1[0]:
-				val2 = self._readbyte()
-				if val1[0]:
-					val3 = self._readbyte()
-					if val1[0]:
-						crc = self._readchecksumword()
-						if crc[0]:
-							if self._crc&0xFFFF!=crc[1]&0xFFFF:
-								return (0,0)
-							return (1,val1[1],val2[1],val3[1])
-			trys-=1
-			if trys==0:
-				break
+		vals = self._readreply(address,self.Cmd.GETPINFUNCTIONS,_READ111)
+		if vals:
+			return (1,vals[0],vals[1],vals[2])
 		return (0,0)
 
 	def SetDeadBand(self,address,min,max):
-		return self._write11(address,self.Cmd.SETDEADBAND,min,max)
+		return self._write(address,self.Cmd.SETDEADBAND,'11',min,max)
 
 	def GetDeadBand(self,address):
 		val = self._read2(address,self.Cmd.GETDEADBAND)
@@ -975,7 +602,7 @@ class Roboclaw:
 		
 	#Warning(TTL Serial): Baudrate will change if not already set to 38400.  Communications will be lost
 	def RestoreDefaults(self,address):
-		return self._write0(address,self.Cmd.RESTOREDEFAULTS)
+		return self._write(address,self.Cmd.RESTOREDEFAULTS,'0')
 
 	def ReadTemp(self,address):
 		return self._read2(address,self.Cmd.GETTEMP)
@@ -993,33 +620,33 @@ class Roboclaw:
 		return (0,0,0)
 		
 	def SetM1EncoderMode(self,address,mode):
-		return self._write1(address,self.Cmd.SETM1ENCODERMODE,mode)
+		return self._write(address,self.Cmd.SETM1ENCODERMODE,'1',mode)
 
 	def SetM2EncoderMode(self,address,mode):
-		return self._write1(address,self.Cmd.SETM2ENCODERMODE,mode)
+		return self._write(address,self.Cmd.SETM2ENCODERMODE,'1',mode)
 
 	#saves active settings to NVM
 	def WriteNVM(self,address):
-		return self._write4(address,self.Cmd.WRITENVM,0xE22EAB7A)
+		return self._write(address,self.Cmd.WRITENVM,'4',0xE22EAB7A)
 
 	#restores settings from NVM
 	#Warning(TTL Serial): If baudrate changes or the control mode changes communications will be lost
 	def ReadNVM(self,address):
-		return self._write0(address,self.Cmd.READNVM)
+		return self._write(address,self.Cmd.READNVM,'0')
 
 	#Warning(TTL Serial): If control mode is changed from packet serial mode when setting config communications will be lost!
 	#Warning(TTL Serial): If baudrate of packet serial mode is changed communications will be lost!
 	def SetConfig(self,address,config):
-		return self._write2(address,self.Cmd.SETCONFIG,config)
+		return self._write(address,self.Cmd.SETCONFIG,'2',config)
 
 	def GetConfig(self,address):
 		return self._read2(address,self.Cmd.GETCONFIG)
 
 	def SetM1MaxCurrent(self,address,max):
-		return self._write44(address,self.Cmd.SETM1MAXCURRENT,max,0)
+		return self._write(address,self.Cmd.SETM1MAXCURRENT,'44',max,0)
 
 	def SetM2MaxCurrent(self,address,max):
-		return self._write44(address,self.Cmd.SETM2MAXCURRENT,max,0)
+		return self._write(address,self.Cmd.SETM2MAXCURRENT,'44',max,0)
 
 	def ReadM1MaxCurrent(self,address):
 		data = self._read_n(address,self.Cmd.GETM1MAXCURRENT,2)
@@ -1034,39 +661,26 @@ class Roboclaw:
 		return (0,0)
 
 	def SetPWMMode(self,address,mode):
-		return self._write1(address,self.Cmd.SETPWMMODE,mode)
+		return self._write(address,self.Cmd.SETPWMMODE,'1',mode)
 
 	def ReadPWMMode(self,address):
 		return self._read1(address,self.Cmd.GETPWMMODE)
 
 	def ReadEeprom(self,address,ee_address):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,self.Cmd.READEEPROM)
-			self.crc_update(ee_address)
-			self._port.write(chr(ee_address))
-			val1 = self._readword()
-			if val1[0]:
-				crc = self._readchecksumword()
-				if crc[0]:
-					if self._crc&0xFFFF!=crc[1]&0xFFFF:
-						return (0,0)
-					return (1,val1[1])
-			trys-=1
-			if trys==0:
-				break
+		vals = self._readreply(address,self.Cmd.READEEPROM,_READ2,bytes((ee_address,)))
+		if vals:
+			return (1,vals[0])
 		return (0,0)
 
 	def WriteEeprom(self,address,ee_address,ee_word):
-		retval = self._write111(address,self.Cmd.WRITEEEPROM,ee_address,ee_word>>8,ee_word&0xFF)
+		retval = self._write(address,self.Cmd.WRITEEEPROM,'111',ee_address,ee_word>>8,ee_word&0xFF)
 		if retval==True:
 			trys = self._trystimeout
 			while 1:
 				self._port.flushInput()
-				val1 = self._readbyte()
-				if val1[0]:
-					if val1[1]==0xaa:
+				data = self._port.read(1)
+				if len(data):
+					if data[0]==0xaa:
 						return True
 				trys-=1
 				if trys==0:
@@ -1075,7 +689,7 @@ class Roboclaw:
 		
 	def Open(self):
 		try:
-			self._port = serial.Serial(port=self.comport, baudrate=self.rate, timeout=1, interCharTimeout=self.timeout)
+			self._port = hal.open_serial(self.comport, self.rate, timeout=1, interCharTimeout=self.timeout)
 		except:
 			return 0
 		return 1
@@ -0,0 +1,421 @@
+import argparse
+import collections
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import tty
+import hal
+from crc16 import crc16
+from hal_fakes import FakeSerial
+from roboclaw_3 import Roboclaw
+
+Cmd = Roboclaw.Cmd
+
+ACK = b'\xff'
+VERSION = b'USB Roboclaw 2x7a v4.1.34 (simulated)\n\x00'
+
+# Payload formats of the write commands the simulator understands
+WRITE_FORMATS = {
+                    Cmd.M1FORWARD: '>B', Cmd.M1BACKWARD: '>B', Cmd.M2FORWARD: '>B', Cmd.M2BACKWARD: '>B',
+                    Cmd.M17BIT: '>B', Cmd.M27BIT: '>B',
+                    Cmd.SETMINMB: '>B', Cmd.SETMAXMB: '>B', Cmd.SETMINLB: '>B', Cmd.SETMAXLB: '>B',
+                    Cmd.MIXEDFORWARD: '>B', Cmd.MIXEDBACKWARD: '>B', Cmd.MIXEDRIGHT: '>B', Cmd.MIXEDLEFT: '>B',
+                    Cmd.MIXEDFB: '>B', Cmd.MIXEDLR: '>B',
+                    Cmd.RESETENC: '>',
+                    Cmd.SETM1ENCCOUNT: '>i', Cmd.SETM2ENCCOUNT: '>i',
+                    Cmd.SETM1PID: '>IIII', Cmd.SETM2PID: '>IIII',
+                    Cmd.M1DUTY: '>h', Cmd.M2DUTY: '>h', Cmd.MIXEDDUTY: '>hh',
+                    Cmd.M1SPEED: '>i', Cmd.M2SPEED: '>i', Cmd.MIXEDSPEED: '>ii',
+                    Cmd.M1SPEEDACCEL: '>Ii', Cmd.M2SPEEDACCEL: '>Ii', Cmd.MIXEDSPEEDACCEL: '>Iii',
+                    Cmd.M1SPEEDDIST: '>iIB', Cmd.M2SPEEDDIST: '>iIB', Cmd.MIXEDSPEEDDIST: '>iIiIB',
+                    Cmd.M1SPEEDACCELDIST: '>IiIB', Cmd.M2SPEEDACCELDIST: '>IiIB', Cmd.MIXEDSPEEDACCELDIST: '>IiIiIB',
+                    Cmd.MIXEDSPEED2ACCEL: '>IiIi', Cmd.MIXEDSPEED2ACCELDIST: '>IiIIiIB',
+                    Cmd.M1DUTYACCEL: '>hI', Cmd.M2DUTYACCEL: '>hI', Cmd.MIXEDDUTYACCEL: '>hIhI',
+                    Cmd.SETMAINVOLTAGES: '>HH', Cmd.SETLOGICVOLTAGES: '>HH',
+                    Cmd.SETM1POSPID: '>7I', Cmd.SETM2POSPID: '>7I',
+                    Cmd.M1SPEEDACCELDECCELPOS: '>IiIiB', Cmd.M2SPEEDACCELDECCELPOS: '>IiIiB',
+                    Cmd.MIXEDSPEEDACCELDECCELPOS: '>IiIiIiIiB',
+                    Cmd.SETM1DEFAULTACCEL: '>I', Cmd.SETM2DEFAULTACCEL: '>I',
+                    Cmd.SETPINFUNCTIONS: '>BBB', Cmd.SETDEADBAND: '>BB',
+                    Cmd.RESTOREDEFAULTS: '>', Cmd.WRITENVM: '>I', Cmd.READNVM: '>',
+                    Cmd.SETM1ENCODERMODE: '>B', Cmd.SETM2ENCODERMODE: '>B',
+                    Cmd.SETCONFIG: '>H', Cmd.SETM1MAXCURRENT: '>II', Cmd.SETM2MAXCURRENT: '>II',
+                    Cmd.SETPWMMODE: '>B', Cmd.WRITEEEPROM: '>BBB'
+                }
+WRITE_FORMATS = {cmd: struct.Struct(payload_format) for cmd, payload_format in WRITE_FORMATS.items()}
+
+# Read commands carrying a payload in the request
+READ_ARGUMENTS = {Cmd.READEEPROM: 1}
+
+# Commands that start a move over a distance, the only ones that can jam
+DISTANCE_COMMANDS = {
+                        Cmd.M1SPEEDDIST, Cmd.M2SPEEDDIST, Cmd.MIXEDSPEEDDIST,
+                        Cmd.M1SPEEDACCELDIST, Cmd.M2SPEEDACCELDIST, Cmd.MIXEDSPEEDACCELDIST, Cmd.MIXEDSPEED2ACCELDIST,
+                        Cmd.M1SPEEDACCELDECCELPOS, Cmd.M2SPEEDACCELDECCELPOS, Cmd.MIXEDSPEEDACCELDECCELPOS
+                    }
+
+class SimulatedMotor:
+    def __init__(self, qpps=3000, default_accel=20000):
+        self.qpps = qpps
+        self.default_accel = default_accel
+        self.position = 0.0
+        self.speed = 0.0
+        self.accel = 0.0
+        self.target_speed = 0.0
+        self.command_accel = default_accel
+        self.remaining = None
+        self.buffer = collections.deque()
+        self.max_current = 1000
+        self.pid = (0, 0, 0, qpps)
+        self.position_pid = (0, 0, 0, 0, 0, 0, 0)
+        self.encoder_mode = 0
+        # A jammed motor stands still at max current with its buffer held
+        # until a new unbuffered command replaces the move
+        self.jammed = False
+
+    def drive(self, speed, accel=None, distance=None, buffered=False):
+        command = (speed, accel if accel else self.default_accel, distance)
+        if buffered and (self.remaining is not None or self.buffer):
+            self.buffer.append(command)
+        else:
+            self.buffer.clear()
+            self.jammed = False
+            self._begin(command)
+
+    def duty(self, duty, accel=None):
+        self.drive(round(self.qpps * duty / 32767), accel)
+
+    def _begin(self, command):
+        self.target_speed, self.command_accel, self.remaining = command
+
+    def update(self, dt):
+        if self.jammed:
+            self.speed = self.accel = 0.0
+            return
+        previous_speed = self.speed
+        step = self.command_accel * dt
+        if self.target_speed > self.speed:
+            self.speed = min(self.target_speed, self.speed + step)
+        else:
+            self.speed = max(self.target_speed, self.speed - step)
+        moved = self.speed * dt
+        self.position += moved
+        self.accel = (self.speed - previous_speed) / dt if dt > 0 else 0.0
+        if self.remaining is not None:
+            self.remaining -= abs(moved)
+            if self.remaining <= 0:
+                if self.buffer:
+                    self._begin(self.buffer.popleft())
+                else:
+                    self.target_speed = 0.0
+                    self.speed = 0.0
+                    self.remaining = None
+
+    # Buffer status as reported by GETBUFFERS: 0x80 idle, otherwise commands queued
+    def buffer_status(self):
+        if self.remaining is None and not self.buffer:
+            return 0x80
+        return len(self.buffer)
+
+    # 10 mA units: idle draw plus terms for speed and acceleration
+    def current(self):
+        if self.jammed:
+            return self.max_current
+        return int(min(self.max_current, 5 + abs(self.speed) * 0.02 + abs(self.accel) * 0.002))
+
+    def pwm(self):
+        return int(max(-32767, min(32767, 32767 * self.speed / self.qpps)))
+
+class RoboclawSimulator:
+    # jam_probability: chance that a distance command jams the moving motors
+    # use_pty: serve a pseudo-terminal, otherwise only in-process through
+    # open_serial()/install()
+    def __init__(self, address=0x80, latency=0.0, bit_error_rate=0.0, seed=None, jam_probability=0.0, use_pty=True):
+        self.address = address
+        self.latency = latency
+        self.bit_error_rate = bit_error_rate
+        self.jam_probability = jam_probability
+        self.random = random.Random(seed)
+        self.motors = (SimulatedMotor(), SimulatedMotor())
+        self.main_voltages = (60, 340)
+        self.logic_voltages = (60, 340)
+        self.pin_functions = (0, 0, 0)
+        self.deadband = (0, 0)
+        self.config = 0x8063
+        self.pwm_mode = 1
+        self.eeprom = {}
+        self.frames = 0
+        self.crc_errors = 0
+        self.jams = 0
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._serial = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_update = hal.clock.monotonic()
+        self._master = self._slave = self.port_name = None
+        if use_pty:
+            self._master, self._slave = pty.openpty()
+            tty.setraw(self._slave)
+            self.port_name = os.ttyname(self._slave)
+
+    # In-process port: bytes written to it are handled on the writer's thread
+    # and the motors advance to the current clock time first
+    def open_serial(self, baudrate=None, timeout=None):
+        self._serial = FakeSerial(self.receive, baudrate, timeout)
+        return self._serial
+
+    # Makes hal.open_serial(port_name) connect to this simulator
+    def install(self, port_name):
+        self.port_name = port_name
+        hal.serial_ports[port_name] = self.open_serial
+
+    def start(self):
+        if self._master is None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.serve_forever, name='RoboclawSimulator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        if self._master is not None:
+            os.close(self._master)
+            os.close(self._slave)
+
+    def serve_forever(self):
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.01)
+            if readable:
+                self.receive(os.read(self._master, 4096))
+            else:
+                with self._lock:
+                    self._update_motors()
+
+    def receive(self, data):
+        with self._lock:
+            self._update_motors()
+            self._buffer += data
+            self._process_buffer()
+
+    def _update_motors(self):
+        now = hal.clock.monotonic()
+        dt = now - self._last_update
+        self._last_update = now
+        for motor in self.motors:
+            motor.update(dt)
+
+    def _process_buffer(self):
+        while len(self._buffer) >= 2:
+            address, cmd = self._buffer[0], self._buffer[1]
+            if address != self.address:
+                del self._buffer[0]
+                continue
+            if cmd in WRITE_FORMATS:
+                length = 2 + WRITE_FORMATS[cmd].size + 2
+            else:
+                length = 2 + READ_ARGUMENTS.get(cmd, 0)
+            if len(self._buffer) < length:
+                return
+            frame = bytes(self._buffer[:length])
+            del self._buffer[:length]
+            self.frames += 1
+            if cmd in WRITE_FORMATS:
+                response = self._handle_write(cmd, frame)
+            else:
+                response = self._handle_read(cmd, frame)
+            if response:
+                self._respond(response)
+
+    def _respond(self, response):
+        if self.latency:
+            hal.clock.sleep(self.latency)
+        if self.bit_error_rate:
+            response = bytearray(response)
+            for index in range(len(response)):
+                for bit in range(8):
+                    if self.random.random() < self.bit_error_rate:
+                        response[index] ^= 1 << bit
+        if self._serial is not None:
+            self._serial.feed(bytes(response))
+        else:
+            os.write(self._master, bytes(response))
+
+    def _reply(self, frame, payload):
+        return payload + crc16(frame[:2] + payload).to_bytes(2, 'big')
+
+    def _handle_write(self, cmd, frame):
+        if crc16(frame[:-2]) != int.from_bytes(frame[-2:], 'big'):
+            self.crc_errors += 1
+            return None
+        vals = WRITE_FORMATS[cmd].unpack(frame[2:-2])
+        m1, m2 = self.motors
+        if cmd in (Cmd.M1FORWARD, Cmd.M1BACKWARD, Cmd.M2FORWARD, Cmd.M2BACKWARD):
+            motor = m1 if cmd in (Cmd.M1FORWARD, Cmd.M1BACKWARD) else m2
+            sign = 1 if cmd in (Cmd.M1FORWARD, Cmd.M2FORWARD) else -1
+            motor.duty(sign * vals[0] * 32767 // 127)
+        elif cmd in (Cmd.M17BIT, Cmd.M27BIT):
+            (m1 if cmd == Cmd.M17BIT else m2).duty((vals[0] - 64) * 32767 // 64)
+        elif cmd == Cmd.RESETENC:
+            m1.position = m2.position = 0.0
+        elif cmd in (Cmd.SETM1ENCCOUNT, Cmd.SETM2ENCCOUNT):
+            (m1 if cmd == Cmd.SETM1ENCCOUNT else m2).position = float(vals[0])
+        elif cmd in (Cmd.SETM1PID, Cmd.SETM2PID):
+            (m1 if cmd == Cmd.SETM1PID else m2).pid = vals
+        elif cmd in (Cmd.M1DUTY, Cmd.M2DUTY):
+            (m1 if cmd == Cmd.M1DUTY else m2).duty(vals[0])
+        elif cmd == Cmd.MIXEDDUTY:
+            m1.duty(vals[0])
+            m2.duty(vals[1])
+        elif cmd in (Cmd.M1SPEED, Cmd.M2SPEED):
+            (m1 if cmd == Cmd.M1SPEED else m2).drive(vals[0])
+        elif cmd == Cmd.MIXEDSPEED:
+            m1.drive(vals[0])
+            m2.drive(vals[1])
+        elif cmd in (Cmd.M1SPEEDACCEL, Cmd.M2SPEEDACCEL):
+            (m1 if cmd == Cmd.M1SPEEDACCEL else m2).drive(vals[1], vals[0])
+        elif cmd == Cmd.MIXEDSPEEDACCEL:
+            m1.drive(vals[1], vals[0])
+            m2.drive(vals[2], vals[0])
+        elif cmd in (Cmd.M1SPEEDDIST, Cmd.M2SPEEDDIST):
+            speed, distance, buffered = vals
+            (m1 if cmd == Cmd.M1SPEEDDIST else m2).drive(speed, None, distance, buffered == 0)
+        elif cmd == Cmd.MIXEDSPEEDDIST:
+            speed1, distance1, speed2, distance2, buffered = vals
+            m1.drive(speed1, None, distance1, buffered == 0)
+            m2.drive(speed2, None, distance2, buffered == 0)
+        elif cmd in (Cmd.M1SPEEDACCELDIST, Cmd.M2SPEEDACCELDIST):
+            accel, speed, distance, buffered = vals
+            (m1 if cmd == Cmd.M1SPEEDACCELDIST else m2).drive(speed, accel, distance, buffered == 0)
+        elif cmd == Cmd.MIXEDSPEEDACCELDIST:
+            accel, speed1, distance1, speed2, distance2, buffered = vals
+            m1.drive(speed1, accel, distance1, buffered == 0)
+            m2.drive(speed2, accel, distance2, buffered == 0)
+        elif cmd == Cmd.MIXEDSPEED2ACCEL:
+            m1.drive(vals[1], vals[0])
+            m2.drive(vals[3], vals[2])
+        elif cmd == Cmd.MIXEDSPEED2ACCELDIST:
+            accel1, speed1, distance1, accel2, speed2, distance2, buffered = vals
+            m1.drive(speed1, accel1, distance1, buffered == 0)
+            m2.drive(speed2, accel2, distance2, buffered == 0)
+        elif cmd in (Cmd.M1DUTYACCEL, Cmd.M2DUTYACCEL):
+            (m1 if cmd == Cmd.M1DUTYACCEL else m2).duty(vals[0], vals[1])
+        elif cmd == Cmd.MIXEDDUTYACCEL:
+            m1.duty(vals[0], vals[1])
+            m2.duty(vals[2], vals[3])
+        elif cmd in (Cmd.M1SPEEDACCELDECCELPOS, Cmd.M2SPEEDACCELDECCELPOS):
+            motor = m1 if cmd == Cmd.M1SPEEDACCELDECCELPOS else m2
+            self._drive_to_position(motor, vals[0], vals[1], vals[3], vals[4])
+        elif cmd == Cmd.MIXEDSPEEDACCELDECCELPOS:
+            self._drive_to_position(m1, vals[0], vals[1], vals[3], vals[8])
+            self._drive_to_position(m2, vals[4], vals[5], vals[7], vals[8])
+        elif cmd in (Cmd.SETM1DEFAULTACCEL, Cmd.SETM2DEFAULTACCEL):
+            (m1 if cmd == Cmd.SETM1DEFAULTACCEL else m2).default_accel = vals[0]
+        elif cmd in (Cmd.SETM1POSPID, Cmd.SETM2POSPID):
+            (m1 if cmd == Cmd.SETM1POSPID else m2).position_pid = vals
+        elif cmd in (Cmd.SETM1MAXCURRENT, Cmd.SETM2MAXCURRENT):
+            (m1 if cmd == Cmd.SETM1MAXCURRENT else m2).max_current = vals[0]
+        elif cmd in (Cmd.SETM1ENCODERMODE, Cmd.SETM2ENCODERMODE):
+            (m1 if cmd == Cmd.SETM1ENCODERMODE else m2).encoder_mode = vals[0]
+        elif cmd == Cmd.SETMAINVOLTAGES:
+            self.main_voltages = vals
+        elif cmd == Cmd.SETLOGICVOLTAGES:
+            self.logic_voltages = vals
+        elif cmd == Cmd.SETPINFUNCTIONS:
+            self.pin_functions = vals
+        elif cmd == Cmd.SETDEADBAND:
+            self.deadband = vals
+        elif cmd == Cmd.SETCONFIG:
+            self.config = vals[0]
+        elif cmd == Cmd.SETPWMMODE:
+            self.pwm_mode = vals[0]
+        elif cmd == Cmd.WRITEEEPROM:
+            self.eeprom[vals[0]] = vals[1] << 8 | vals[2]
+            return ACK + b'\xaa'
+        if cmd in DISTANCE_COMMANDS and self.random.random() < self.jam_probability:
+            self.jams += 1
+            for motor in self.motors:
+                if motor.remaining is not None:
+                    motor.jammed = True
+        return ACK
+
+    def _drive_to_position(self, motor, accel, speed, position, buffered):
+        distance = abs(position - motor.position)
+        direction = 1 if position >= motor.position else -1
+        motor.drive(direction * speed, accel, distance, buffered == 0)
+
+    def _handle_read(self, cmd, frame):
+        m1, m2 = self.motors
+        if cmd in (Cmd.GETM1ENC, Cmd.GETM2ENC):
+            motor = m1 if cmd == Cmd.GETM1ENC else m2
+            payload = struct.pack('>iB', int(motor.position), 0x02 if motor.speed < 0 else 0)
+        elif cmd in (Cmd.GETM1SPEED, Cmd.GETM2SPEED, Cmd.GETM1ISPEED, Cmd.GETM2ISPEED):
+            motor = m1 if cmd in (Cmd.GETM1SPEED, Cmd.GETM1ISPEED) else m2
+            payload = struct.pack('>iB', int(motor.speed), 1 if motor.speed < 0 else 0)
+        elif cmd == Cmd.GETVERSION:
+            payload = VERSION
+        elif cmd == Cmd.GETMBATT:
+            payload = struct.pack('>H', 120)
+        elif cmd == Cmd.GETLBATT:
+            payload = struct.pack('>H', 50)
+        elif cmd == Cmd.GETBUFFERS:
+            payload = struct.pack('>BB', m1.buffer_status(), m2.buffer_status())
+        elif cmd == Cmd.GETPWMS:
+            payload = struct.pack('>hh', m1.pwm(), m2.pwm())
+        elif cmd == Cmd.GETCURRENTS:
+            payload = struct.pack('>hh', m1.current(), m2.current())
+        elif cmd in (Cmd.READM1PID, Cmd.READM2PID):
+            payload = struct.pack('>IIII', *(m1 if cmd == Cmd.READM1PID else m2).pid)
+        elif cmd == Cmd.GETMINMAXMAINVOLTAGES:
+            payload = struct.pack('>HH', *self.main_voltages)
+        elif cmd == Cmd.GETMINMAXLOGICVOLTAGES:
+            payload = struct.pack('>HH', *self.logic_voltages)
+        elif cmd in (Cmd.READM1POSPID, Cmd.READM2POSPID):
+            payload = struct.pack('>7I', *(m1 if cmd == Cmd.READM1POSPID else m2).position_pid)
+        elif cmd == Cmd.GETPINFUNCTIONS:
+            payload = struct.pack('>BBB', *self.pin_functions)
+        elif cmd == Cmd.GETDEADBAND:
+            payload = struct.pack('>BB', *self.deadband)
+        elif cmd in (Cmd.GETTEMP, Cmd.GETTEMP2):
+            payload = struct.pack('>H', 250)
+        elif cmd == Cmd.GETERROR:
+            payload = struct.pack('>I', 0)
+        elif cmd == Cmd.GETENCODERMODE:
+            payload = struct.pack('>BB', m1.encoder_mode, m2.encoder_mode)
+        elif cmd == Cmd.GETCONFIG:
+            payload = struct.pack('>H', self.config)
+        elif cmd in (Cmd.GETM1MAXCURRENT, Cmd.GETM2MAXCURRENT):
+            payload = struct.pack('>II', (m1 if cmd == Cmd.GETM1MAXCURRENT else m2).max_current, 0)
+        elif cmd == Cmd.GETPWMMODE:
+            payload = struct.pack('>B', self.pwm_mode)
+        elif cmd == Cmd.READEEPROM:
+            payload = struct.pack('>H', self.eeprom.get(frame[2], 0))
+            return payload + crc16(frame + payload).to_bytes(2, 'big')
+        else:
+            return None
+        return self._reply(frame, payload)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Roboclaw packet serial simulator on a pseudo-terminal')
+    parser.add_argument('--address', type=lambda value: int(value, 0), default=0x80)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each reply')
+    parser.add_argument('--bit-error-rate', type=float, default=0.0, help='probability of flipping each reply bit')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--jam-probability', type=float, default=0.0, help='probability that a distance command jams the motor')
+    args = parser.parse_args()
+    simulator = RoboclawSimulator(args.address, args.latency, args.bit_error_rate, args.seed, args.jam_probability)
+    print(f"Simulated Roboclaw at address 0x{args.address:02x} on {simulator.port_name}", flush=True)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,35 +1,44 @@
 import os
-import time
+import threading
 from datetime import datetime
+import hal
 from roboclaw_3 import Roboclaw
+from telemetry import TELEMETRY_LOG_EXTENSION, TelemetryLogWriter, TelemetrySampler, downsample, is_telemetry_log, load_metric_columns, read_csv_log, read_telemetry_log
 import numpy
 import matplotlib.pyplot as plt
 
+# The buffer did not empty within the motion timeout, e.g. a jammed auger
+class RoboclawMotionTimeoutError(Exception):
+    def __init__(self, motion_timeout, buffers):
+        Exception.__init__(self, f"Motion not finished after {motion_timeout} s, buffers {buffers}")
+        self.buffers = buffers
+
+# A buffered command was not acknowledged, so the motion is not the one asked for
+class RoboclawCommandError(Exception):
+    def __init__(self, index):
+        Exception.__init__(self, f"Buffered command {index} not acknowledged")
+        self.index = index
+
 class Roboclaw_zwv(Roboclaw):
     def __init__(self, comport, rate, timeout=0.01, retries=3, log_file_dir = "../../Logs"):
         Roboclaw.__init__(self, comport, rate, timeout=0.01, retries=3)
         self.log_file_dir = log_file_dir
+        # Serializes port access between the sampler thread and command callers
+        self.port_lock = threading.Lock()
         
     def read_metrics(self, address):
-        read_1_time = time.time()
-        _,M1Position,_ = self.ReadEncM1(address)
-        read_2_time = time.time()
-        _,M1Speed,_ = self.ReadSpeedM1(address)
-        read_3_time = time.time()
-        _,M1Current,_ = self.ReadCurrents(address)
-        read_4_time = time.time()
+        # Position, speed and current are requested in one pipelined transaction,
+        # so all three share the transaction start time
+        read_1_time = hal.clock.time()
+        encoder, speed, currents = self.ReadPipelined(address, [self.Cmd.GETM1ENC, self.Cmd.GETM1SPEED, self.Cmd.GETCURRENTS])
+        read_4_time = hal.clock.time()
         
-        return read_1_time,M1Position,read_2_time,M1Speed,read_3_time,M1Current,read_4_time
+        return read_1_time,encoder[1],read_1_time,speed[1],read_1_time,currents[1],read_4_time
 
     def create_log_file(self):
-        log_file_name = str(datetime.now()).replace('-', '').replace(':', '').replace('.', '') + '.csv'
+        log_file_name = str(datetime.fromtimestamp(hal.clock.time())).replace('-', '').replace(':', '').replace('.', '') + TELEMETRY_LOG_EXTENSION
         log_file_path = os.path.join(self.log_file_dir, log_file_name)
-        self.log_file = open(log_file_path, 'w')
-
-    def output_metrics_to_file(self, address, file):
-        metrics = self.read_metrics(address)
-        metrics_as_string = ','.join(list(map(lambda metric: str(metric), metrics)))
-        file.write(metrics_as_string + '\n')
+        self.log_file = TelemetryLogWriter(log_file_path)
 
     def output_metrics_to_screen(self, address):
         read_start,position,_,speed,_,current,read_end = self.read_metrics(address)
@@ -40,56 +49,67 @@ class Roboclaw_zwv(Roboclaw):
         print(f"Current : {current}")
         print(f"Read End : {read_end}")
         
+    # Returns TELEMETRY_DTYPE records from a binary log (memory-mapped) or a legacy CSV log
     def get_metrics_from_log(self, log_file_path):
-        with open(log_file_path, 'r') as log_file:
-            log_file_lines = log_file.readlines()
-            metrics = list(map(lambda line: [float(field) for field in line.split(',')], log_file_lines))
-            return metrics
-        
-    def graph_metrics(self, log_file_path):
-        metrics = self.get_metrics_from_log(log_file_path)
+        if is_telemetry_log(log_file_path):
+            return read_telemetry_log(log_file_path)
+        return read_csv_log(log_file_path)
         
-        absolute_times = list(map(lambda metric: metric[0], metrics))
-        base_time = absolute_times[0]
-        relative_times = list(map(lambda absolute_time: (absolute_time - base_time) * 1000, absolute_times))
-        
-        absolute_positions = list(map(lambda metric: metric[1], metrics))
-        base_position = absolute_positions[0]
-        relative_positions = list(map(lambda absolute_position: absolute_position - base_position, absolute_positions))
-
-        speeds = list(map(lambda metric: metric[3], metrics))
-        currents = list(map(lambda metric: metric[5] * 10, metrics))
+    # max_points caps the samples plotted per axis (None plots every sample);
+    # downsample_mode is 'minmax' or 'lttb'
+    def graph_metrics(self, log_file_path, max_points = 5000, downsample_mode = 'minmax'):
+        relative_times, relative_positions, speeds, currents = load_metric_columns(log_file_path)
         
         figure, axis = plt.subplots(3,1)
         
-        axis[0].plot(relative_times, relative_positions)
+        axis[0].plot(*downsample(relative_times, relative_positions, max_points, downsample_mode))
         axis[0].set(ylabel='position (encoder count)')
         
-        axis[1].plot(relative_times, speeds)
+        axis[1].plot(*downsample(relative_times, speeds, max_points, downsample_mode))
         axis[1].set(ylabel='speed (encoder count/sec)')
         
-        axis[2].plot(relative_times, currents)
+        axis[2].plot(*downsample(relative_times, currents, max_points, downsample_mode))
         axis[2].set(xlabel='time (ms)', ylabel='current (mA)')
         
         plt.show()
         
-    def execute_buffered_commands_with_logging(self, address, commands, before_wait_time = .5, after_wait_time = .5):
+    # on_commands_sent is called once every command is in the Roboclaw buffer,
+    # while the motor is still running. If a command is not acknowledged M1 is
+    # stopped and RoboclawCommandError raised before on_commands_sent; if the
+    # buffer has not emptied motion_timeout seconds later M1 is stopped and
+    # RoboclawMotionTimeoutError raised. The log is written either way.
+    def execute_buffered_commands_with_logging(self, address, commands, before_wait_time = .5, after_wait_time = .5, sample_rate = 100, catch_up = False, on_commands_sent = None, motion_timeout = None):
         self.create_log_file()
+        # Streams to the log during the run, not only at the end
+        sampler = TelemetrySampler(self, address, sample_rate, catch_up=catch_up, writer=self.log_file)
+        sampler.start()
         
-        begin_time = time.time()
-        while (time.time() - begin_time) < before_wait_time:
-            self.output_metrics_to_file(address, self.log_file)
+        try:
+            hal.clock.sleep(before_wait_time)
+                
+            with self.port_lock:
+                for index, command in enumerate(commands):
+                    if not command():
+                        # Also stops whatever the earlier commands queued
+                        self.DutyM1(address, 0)
+                        raise RoboclawCommandError(index)
+            if on_commands_sent is not None:
+                on_commands_sent()
             
-        for command in commands:
-            command()
-        
-        buffers = (0,0,0)
-        while buffers[1]!=0x80:
-            self.output_metrics_to_file(address, self.log_file)
-            buffers = self.ReadBuffers(address)
-        
-        begin_time = time.time()
-        while (time.time() - begin_time) < after_wait_time:
-            self.output_metrics_to_file(address, self.log_file)
+            deadline = None if motion_timeout is None else hal.clock.monotonic() + motion_timeout
+            buffers = (0,0,0)
+            while buffers[1]!=0x80:
+                if deadline is not None and hal.clock.monotonic() >= deadline:
+                    with self.port_lock:
+                        self.DutyM1(address, 0)
+                    raise RoboclawMotionTimeoutError(motion_timeout, buffers)
+                hal.clock.sleep(1 / sample_rate)
+                with self.port_lock:
+                    buffers = self.ReadBuffers(address)
             
-        self.log_file.close()
\ No newline at end of file
+            hal.clock.sleep(after_wait_time)
+        finally:
+            sampler.stop()
+            self.log_file.close()
+            self.sampling_stats = sampler.stats()
+            sampler.write_stats(self.log_file.name)
\ No newline at end of file
@@ -0,0 +1,318 @@
+import itertools
+import json
+import os
+import struct
+import sys
+import threading
+import numpy
+import hal
+
+# One telemetry sample: host time (seconds since epoch), M1 encoder count,
+# M1 speed (encoder counts/sec) and M1 current (10 mA units)
+TELEMETRY_DTYPE = numpy.dtype([
+                                ('time', '<f8'),
+                                ('position', '<i4'),
+                                ('speed', '<i4'),
+                                ('current', '<i2')
+                              ])
+
+# Binary log: fixed header (magic, format version, header size, record size)
+# followed by TELEMETRY_DTYPE records
+TELEMETRY_LOG_MAGIC = b'ZWVTELEM'
+TELEMETRY_LOG_VERSION = 1
+TELEMETRY_LOG_HEADER = struct.Struct('<8sHHI')
+TELEMETRY_LOG_EXTENSION = '.tlm'
+
+# Samples at a fixed rate against deadlines on the monotonic clock. A sample that
+# starts late is kept; deadlines that passed entirely during a slow read are
+# either all sampled back to back (catch_up) or skipped and counted as missed.
+# Sample times are wall-clock at start() plus monotonic elapsed time, so a clock
+# step during a run cannot reorder or stretch them.
+# With a writer (TelemetryLogWriter) a second thread drains new samples from the
+# ring into the log every flush_interval seconds, so a run of any length is kept
+# whole and a crash loses at most the last interval. Samples overwritten before
+# they could be drained are counted in dropped_samples.
+class TelemetrySampler:
+    def __init__(self, roboclaw, address, rate=100, capacity=65536, catch_up=False, writer=None, flush_interval=1.0):
+        self.roboclaw = roboclaw
+        self.address = address
+        self.rate = rate
+        self.catch_up = catch_up
+        self.samples = numpy.zeros(capacity, dtype=TELEMETRY_DTYPE)
+        self.jitter_ns = numpy.zeros(capacity, dtype=numpy.int64)
+        self.count = 0
+        self.missed_deadlines = 0
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped_samples = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._writer_thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._base_time = hal.clock.time()
+        self._base_ns = hal.clock.monotonic_ns()
+        self._thread = threading.Thread(target=self._run, name='TelemetrySampler', daemon=True)
+        self._thread.start()
+        if self.writer is not None:
+            self._writer_thread = threading.Thread(target=self._write_run, name='TelemetryWriter', daemon=True)
+            self._writer_thread.start()
+
+    # Returns once every sample taken is in the log
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._writer_thread is not None:
+            self._writer_thread.join()
+            self._writer_thread = None
+            self._drain()
+
+    def _write_run(self):
+        while not hal.clock.wait(self._stop_event, self.flush_interval):
+            self._drain()
+
+    # Writes samples taken since the last drain, at most two chunks when the
+    # range crosses the end of the ring
+    def _drain(self):
+        count = self.count
+        capacity = len(self.samples)
+        if count - self.written > capacity:
+            self.dropped_samples += count - self.written - capacity
+            self.written = count - capacity
+        while self.written < count:
+            start = self.written % capacity
+            end = min(capacity, start + count - self.written)
+            self.writer.write(self.samples[start:end])
+            self.written += end - start
+        self.writer.flush()
+
+    def _run(self):
+        period_ns = round(1e9 / self.rate)
+        capacity = len(self.samples)
+        deadline_ns = self._base_ns
+        while not self._stop_event.is_set():
+            start_ns = hal.clock.monotonic_ns()
+            with self.roboclaw.port_lock:
+                _,position,_,speed,_,current,_ = self.roboclaw.read_metrics(self.address)
+            index = self.count % capacity
+            self.samples[index] = (self._base_time + (start_ns - self._base_ns) / 1e9, position, speed, current)
+            self.jitter_ns[index] = start_ns - deadline_ns
+            self.count += 1
+            deadline_ns += period_ns
+            now_ns = hal.clock.monotonic_ns()
+            if not self.catch_up and now_ns > deadline_ns + period_ns:
+                missed = (now_ns - deadline_ns) // period_ns
+                self.missed_deadlines += missed
+                deadline_ns += missed * period_ns
+            hal.clock.wait(self._stop_event, max(0, deadline_ns - now_ns) / 1e9)
+
+    def _ordered(self, ring):
+        capacity = len(ring)
+        if self.count <= capacity:
+            return ring[:self.count].copy()
+        start = self.count % capacity
+        return numpy.concatenate((ring[start:], ring[:start]))
+
+    # Samples in acquisition order; only the newest len(samples) survive a wrap
+    def snapshot(self):
+        return self._ordered(self.samples)
+
+    def stats(self):
+        jitter_us = self._ordered(self.jitter_ns) / 1000
+        stats = {
+                    'rate': self.rate,
+                    'samples': self.count,
+                    'missed_deadlines': int(self.missed_deadlines),
+                    'catch_up': self.catch_up
+                }
+        if self.writer is not None:
+            stats['dropped_samples'] = int(self.dropped_samples)
+        if len(jitter_us):
+            stats['jitter_mean_us'] = float(jitter_us.mean())
+            stats['jitter_p50_us'] = float(numpy.percentile(jitter_us, 50))
+            stats['jitter_p99_us'] = float(numpy.percentile(jitter_us, 99))
+            stats['jitter_max_us'] = float(jitter_us.max())
+        return stats
+
+    # Stores stats() next to a log as <log name>.stats.json
+    def write_stats(self, log_file_path):
+        stats_file_path = os.path.splitext(log_file_path)[0] + '.stats.json'
+        with open(stats_file_path, 'w') as stats_file:
+            json.dump(self.stats(), stats_file, indent=4)
+        return stats_file_path
+
+class TelemetryLogWriter:
+    def __init__(self, log_file_path):
+        self.name = log_file_path
+        self._file = open(log_file_path, 'wb')
+        self._file.write(TELEMETRY_LOG_HEADER.pack(TELEMETRY_LOG_MAGIC, TELEMETRY_LOG_VERSION, TELEMETRY_LOG_HEADER.size, TELEMETRY_DTYPE.itemsize))
+
+    def write(self, samples):
+        self._file.write(numpy.ascontiguousarray(samples, dtype=TELEMETRY_DTYPE).tobytes())
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def is_telemetry_log(log_file_path):
+    with open(log_file_path, 'rb') as log_file:
+        return log_file.read(len(TELEMETRY_LOG_MAGIC)) == TELEMETRY_LOG_MAGIC
+
+def read_telemetry_log(log_file_path):
+    with open(log_file_path, 'rb') as log_file:
+        header = log_file.read(TELEMETRY_LOG_HEADER.size)
+    if len(header) != TELEMETRY_LOG_HEADER.size:
+        raise Exception(f"{log_file_path} is too short to be a telemetry log")
+    magic, version, header_size, record_size = TELEMETRY_LOG_HEADER.unpack(header)
+    if magic != TELEMETRY_LOG_MAGIC:
+        raise Exception(f"{log_file_path} is not a telemetry log")
+    if version != TELEMETRY_LOG_VERSION or record_size != TELEMETRY_DTYPE.itemsize:
+        raise Exception(f"Unsupported telemetry log version {version} in {log_file_path}")
+    # A record cut short by a crash or power loss is ignored
+    records = (os.path.getsize(log_file_path) - header_size) // record_size
+    if records == 0:
+        return numpy.zeros(0, dtype=TELEMETRY_DTYPE)
+    return numpy.memmap(log_file_path, dtype=TELEMETRY_DTYPE, mode='r', offset=header_size, shape=(records,))
+
+# Comments and blank lines are not records
+def _is_csv_record(line):
+    return bool(line.split('#', 1)[0].strip())
+
+def _csv_log_to_records(lines):
+    columns = numpy.loadtxt(lines, delimiter=',', ndmin=2)
+    samples = numpy.zeros(len(columns), dtype=TELEMETRY_DTYPE)
+    samples['time'] = columns[:, 0]
+    samples['position'] = columns[:, 1]
+    samples['speed'] = columns[:, 3]
+    samples['current'] = columns[:, 5]
+    return samples
+
+# Reads a legacy CSV log, one read_metrics() tuple per line:
+# time,position,time,speed,time,current,time
+def read_csv_log(log_file_path):
+    with open(log_file_path, 'r') as log_file:
+        return _csv_log_to_records(filter(_is_csv_record, log_file))
+
+# Yields TELEMETRY_DTYPE chunks of at most chunk_size records from either log format
+def iter_log_chunks(log_file_path, chunk_size=65536):
+    if is_telemetry_log(log_file_path):
+        samples = read_telemetry_log(log_file_path)
+        for start in range(0, len(samples), chunk_size):
+            yield samples[start:start + chunk_size]
+        return
+    with open(log_file_path, 'r') as log_file:
+        while True:
+            lines = list(itertools.islice(filter(_is_csv_record, log_file), chunk_size))
+            if not lines:
+                return
+            yield _csv_log_to_records(lines)
+
+def count_log_records(log_file_path):
+    if is_telemetry_log(log_file_path):
+        return len(read_telemetry_log(log_file_path))
+    with open(log_file_path, 'r') as log_file:
+        return sum(1 for line in log_file if _is_csv_record(line))
+
+# Returns (relative time in ms, relative position in encoder counts, speed in
+# encoder counts/sec, current in mA) as preallocated column arrays, filled one
+# chunk at a time so peak memory stays at the columns plus a single chunk
+def load_metric_columns(log_file_path, chunk_size=65536):
+    records = count_log_records(log_file_path)
+    relative_times = numpy.empty(records, dtype=numpy.float64)
+    relative_positions = numpy.empty(records, dtype=numpy.int64)
+    speeds = numpy.empty(records, dtype=numpy.int32)
+    currents = numpy.empty(records, dtype=numpy.int32)
+    base_time = base_position = None
+    offset = 0
+    for chunk in iter_log_chunks(log_file_path, chunk_size):
+        if base_time is None:
+            base_time = chunk['time'][0]
+            base_position = int(chunk['position'][0])
+        end = offset + len(chunk)
+        numpy.subtract(chunk['time'], base_time, out=relative_times[offset:end])
+        relative_times[offset:end] *= 1000
+        numpy.subtract(chunk['position'], base_position, out=relative_positions[offset:end], dtype=numpy.int64)
+        speeds[offset:end] = chunk['speed']
+        numpy.multiply(chunk['current'], 10, out=currents[offset:end], dtype=numpy.int32)
+        offset = end
+    return relative_times, relative_positions, speeds, currents
+
+# Largest-triangle-three-buckets: keeps the first and last sample and, from each
+# bucket in between, the sample forming the largest triangle with the previously
+# kept sample and the mean of the next bucket
+def lttb_indices(x, y, threshold):
+    length = len(y)
+    if threshold >= length or threshold < 3:
+        return numpy.arange(length)
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    edges = numpy.linspace(1, length - 1, threshold - 1).astype(numpy.int64)
+    edges = numpy.append(edges, length)
+    indices = numpy.empty(threshold, dtype=numpy.int64)
+    indices[0] = 0
+    indices[-1] = length - 1
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+        next_x = x[next_start:next_end].mean()
+        next_y = y[next_start:next_end].mean()
+        areas = numpy.abs((x[selected] - next_x) * (y[start:end] - y[selected]) - (x[selected] - x[start:end]) * (next_y - y[selected]))
+        selected = start + int(numpy.argmax(areas))
+        indices[bucket + 1] = selected
+    return indices
+
+# Min/max envelope: keeps the first and last sample and the lowest and highest
+# sample of each bucket, so spikes and steps survive regardless of how short
+# they are. At most threshold samples are kept.
+def minmax_indices(y, threshold):
+    length = len(y)
+    if threshold >= length or threshold < 2:
+        return numpy.arange(length)
+    y = numpy.asarray(y)
+    edges = numpy.linspace(0, length, (threshold - 2) // 2 + 1).astype(numpy.int64)
+    indices = [0, length - 1]
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            indices.append(start + int(numpy.argmin(y[start:end])))
+            indices.append(start + int(numpy.argmax(y[start:end])))
+    return numpy.unique(indices)
+
+DOWNSAMPLE_MODES = ('lttb', 'minmax')
+
+# Reduces a series to about max_points samples for plotting
+def downsample(x, y, max_points, mode='minmax'):
+    if max_points is None or len(y) <= max_points:
+        return x, y
+    if mode == 'lttb':
+        indices = lttb_indices(x, y, max_points)
+    elif mode == 'minmax':
+        indices = minmax_indices(y, max_points)
+    else:
+        raise Exception(f"Unknown downsample mode {mode}, expected one of {DOWNSAMPLE_MODES}")
+    return x[indices], y[indices]
+
+def convert_csv_log(csv_file_path, log_file_path=None):
+    if log_file_path is None:
+        log_file_path = os.path.splitext(csv_file_path)[0] + TELEMETRY_LOG_EXTENSION
+    with TelemetryLogWriter(log_file_path) as writer:
+        for chunk in iter_log_chunks(csv_file_path):
+            writer.write(chunk)
+    return log_file_path
+
+
+if __name__ == '__main__':
+    for csv_file_path in sys.argv[1:]:
+        print(f"{csv_file_path} -> {convert_csv_log(csv_file_path)}")
@@ -0,0 +1,80 @@
+import pytest
+from ePort import ePort, ePortCRCError
+from hal_fakes import FakeSerial
+
+# Bit by bit CRC16-CCITT (0x1021, initial 0xFFFF) over the frame
+def reference_crc(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc.to_bytes(2, 'big')
+
+def frame(code, values = (), crc = False, corrupt = False):
+    message = '\x1e'.join((code,) + tuple(values)).encode('ASCII')
+    if crc:
+        checksum = bytearray(reference_crc(message))
+        if corrupt:
+            checksum[-1] ^= 1
+        message += bytes(checksum)
+    return message + b'\r'
+
+@pytest.fixture
+def eport():
+    return ePort('/dev/null', 9600)
+
+@pytest.mark.parametrize('reply, name', [(b'\x06', 'ACK'), (b'\x15', 'NAK')])
+def test_ack_nak_parse_like_a_frame(eport, reply, name):
+    code, short_description, long_description, fields, crc = eport.parse_response(reply)
+    assert (code, short_description, fields, crc) == (reply.decode('ASCII'), name, [], None)
+
+def test_status_without_fields(eport):
+    assert eport.parse_response(frame('6')) == ('6', 'DISABLED', 'ePort is in disabled state', [], None)
+
+def test_fields_without_crc(eport):
+    code, name, description, fields, crc = eport.parse_response(frame('17', ['0000000042']))
+    assert (code, name, fields, crc) == ('17', 'TRANSACTION_ID', [('transaction_id', '0000000042')], None)
+
+def test_fields_with_crc(eport):
+    response = frame('2', ['175', '************1111'], crc = True)
+    code, name, description, fields, crc = eport.parse_response(response)
+    assert (code, name) == ('2', 'AUTH_OK')
+    assert fields == [('auth_amt', '175'), ('masked_card_data', '************1111')]
+    assert crc == response[-3:-1]
+
+def test_crc_mismatch(eport):
+    with pytest.raises(ePortCRCError):
+        eport.parse_response(frame('3', ['05', 'Do not honor'], crc = True, corrupt = True))
+
+def test_unknown_code(eport):
+    with pytest.raises(Exception, match = 'Unknown response code'):
+        eport.parse_response(frame('99'))
+
+def test_unterminated_frame(eport):
+    with pytest.raises(Exception, match = 'carriage return'):
+        eport.parse_response(b'17\x1e0000000042')
+
+def test_fixed_commands_are_encoded_once(eport):
+    status = eport.encode_command(ePort.STATUS)
+    assert status == b'1\r'
+    assert eport.encode_command(ePort.STATUS) is status
+
+def test_command_with_fields_and_crc(eport):
+    message = b'21\x1e175'
+    assert eport.encode_command(ePort.AUTH_REQ, ['175']) == message + reference_crc(message) + b'\r'
+
+# Reads what the reader answers to a command through FakeSerial
+def exchange(eport, reply):
+    eport._port = FakeSerial(lambda data: eport._port.feed(reply), timeout = eport.poll_interval)
+    return eport.send_command(ePort.STATUS)
+
+def test_cr_inside_the_crc_does_not_end_the_frame(eport):
+    # AUTH_OK for $2.48 has 0x0D in its CRC
+    reply = frame('2', ['248', '************1111'], crc = True)
+    assert b'\r' in reply[-3:-1]
+    assert exchange(eport, reply)[3] == [('auth_amt', '248'), ('masked_card_data', '************1111')]
+
+def test_corrupt_crc_is_reported_without_waiting_for_the_deadline(eport):
+    with pytest.raises(ePortCRCError):
+        exchange(eport, frame('2', ['175', '************1111'], crc = True, corrupt = True))
@@ -0,0 +1,135 @@
+import time
+import pytest
+from ePort import ePort, ePortTimeoutError
+from ePort_watcher import ePortStatusWatcher
+
+NAK = ('\x15', 'NAK', 'command not acknowleged', [], None)
+
+def status(code, *values):
+    name, description, fields, crc_present = ePort.RESPONSES[code]
+    return (code, name, description, list(zip(fields, values)), None)
+
+# Answers STATUS with replies in turn, then keeps repeating the last one; an
+# exception instance is raised instead
+class FakeePort:
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.polls = 0
+
+    def send_command(self, command, data = []):
+        assert command == ePort.STATUS
+        self.polls += 1
+        reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+def watcher(*replies, fast_interval = 0.05, slow_interval = 1.0):
+    return ePortStatusWatcher(FakeePort(*replies), fast_interval, slow_interval)
+
+def wait_until(condition, timeout = 2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(.01)
+    return True
+
+def test_publishes_on_change_only():
+    watch = watcher(status('6'), status('6'), status('7'), status('7'), status('8'))
+    events = []
+    watch.subscribe(events.append)
+    for poll in range(5):
+        watch.poll()
+    assert [(event.code, event.previous_code) for event in events] == [('6', None), ('7', '6'), ('8', '7')]
+    assert watch.status == '8' and watch.last_event is events[-1]
+
+def test_values_are_published_even_without_a_change():
+    watch = watcher(status('2', '200', 'XXXX1234'), status('2', '200', 'XXXX1234'))
+    events = []
+    watch.subscribe(events.append)
+    watch.poll()
+    watch.poll()
+    assert len(events) == 2
+    assert events[0].values == {'auth_amt': '200', 'masked_card_data': 'XXXX1234'}
+
+def test_failed_polls_are_counted_and_keep_the_status():
+    watch = watcher(status('6'), NAK, ePortTimeoutError(ePort.STATUS, b''), Exception('garbled'), status('6'))
+    events = []
+    watch.subscribe(events.append)
+    for poll in range(5):
+        watch.poll()
+    assert watch.errors == 3
+    assert watch.status == '6' and len(events) == 1
+
+def test_failing_subscriber_does_not_stop_the_others():
+    watch = watcher(status('6'))
+    events = []
+    def fail(event):
+        raise Exception('subscriber failed')
+    watch.subscribe(fail)
+    watch.subscribe(events.append)
+    watch.poll()
+    assert len(events) == 1
+
+def test_expect_delivers_the_first_matching_status():
+    watch = watcher(status('7'), status('8'), status('2', '200', 'XXXX1234'), status('9'))
+    waiter = watch.expect(('2', '3'))
+    delivered = []
+    waiter.add_done_callback(delivered.append)
+    watch.poll()
+    watch.poll()
+    assert waiter.wait(0) is None
+    watch.poll()
+    assert waiter.wait(0).code == '2'
+    assert delivered == [waiter.event]
+    # Delivered once, later statuses are not for it
+    watch.poll()
+    assert waiter.event.code == '2' and watch._waiters == []
+    # A callback added after delivery runs right away
+    waiter.add_done_callback(delivered.append)
+    assert delivered == [waiter.event] * 2
+
+def test_cancelled_waiter_gets_nothing():
+    watch = watcher(status('6'))
+    waiter = watch.expect(('6',))
+    watch.cancel(waiter)
+    watch.poll()
+    assert waiter.wait(0) is None
+    # Cancelling twice, or after delivery, is harmless
+    watch.cancel(waiter)
+
+def test_fast_poll_while_busy_or_waited_on():
+    watch = watcher(status('6'), status('7'), status('9'), fast_interval = 0.05, slow_interval = 1.0)
+    watch.poll()
+    assert watch._interval() == 1.0
+    waiter = watch.expect(('0',))
+    assert watch._interval() == 0.05
+    watch.cancel(waiter)
+    assert watch._interval() == 1.0
+    watch.poll()
+    assert watch._interval() == 0.05
+    watch.poll()
+    assert watch._interval() == 1.0
+
+def test_poke_polls_right_away():
+    watch = watcher(status('6'), slow_interval = 60)
+    watch.start()
+    try:
+        assert wait_until(lambda: watch.ePort.polls == 1)
+        time.sleep(.1)
+        assert watch.ePort.polls == 1
+        watch.poke()
+        assert wait_until(lambda: watch.ePort.polls == 2)
+    finally:
+        watch.stop()
+
+def test_expect_wakes_the_slow_poll():
+    watch = watcher(status('6'), status('0'), slow_interval = 60)
+    watch.start()
+    try:
+        assert wait_until(lambda: watch.status == '6')
+        waiter = watch.expect(('0',))
+        assert waiter.wait(2).code == '0'
+    finally:
+        watch.stop()
@@ -0,0 +1,84 @@
+import time
+import pytest
+from gpio_backend import FakeGPIO
+from keypad import keypad, KeyEvent, PRESS, RELEASE, INTERRUPT
+
+@pytest.fixture
+def gpio():
+    return FakeGPIO()
+
+def switch(gpio, pad, key):
+    row, col = [(row, col) for row in range(4) for col in range(3) if pad.keys[row][col] == key][0]
+    return pad.rows[row], pad.columns[col]
+
+def events(pad):
+    found = []
+    while True:
+        event = pad.get_event(0)
+        if event is None:
+            return found
+        found.append(event)
+
+# Scans at the given times with the key closed while closed(time) is true,
+# as the scan thread would
+def scan(gpio, pad, key, times, closed):
+    for now in times:
+        if closed(now):
+            gpio.connect(*switch(gpio, pad, key))
+        else:
+            gpio.disconnect(*switch(gpio, pad, key))
+        pad._update(pad._scan(), now)
+
+def test_scan_reads_the_key_matrix(gpio):
+    pad = keypad(gpio = gpio)
+    assert pad.pressed_keys() == []
+    gpio.connect(*switch(gpio, pad, '5'))
+    gpio.connect(*switch(gpio, pad, '#'))
+    assert sorted(pad.pressed_keys()) == ['#', '5']
+
+# Times in milliseconds keep the scan times exact
+def test_bounce_shorter_than_the_debounce_time_is_ignored(gpio):
+    pad = keypad(debounce_time = 20, gpio = gpio)
+    # Closed for 15 ms, then open
+    scan(gpio, pad, '5', range(0, 100, 5), lambda now: now < 15)
+    assert events(pad) == []
+    assert pad.stable_keys == set()
+
+def test_chattering_contact_gives_one_press_and_one_release(gpio):
+    pad = keypad(debounce_time = 20, gpio = gpio)
+    # Chatters for 10 ms on the way down and on the way up
+    scan(gpio, pad, '5', range(0, 200, 5), lambda now: now == 0 or 10 <= now < 100 or now == 110)
+    assert events(pad) == [KeyEvent('5', PRESS, 10), KeyEvent('5', RELEASE, 115)]
+
+def test_held_key_gives_one_press(gpio):
+    pad = keypad(debounce_time = 20, gpio = gpio)
+    scan(gpio, pad, '0', range(0, 2000, 5), lambda now: True)
+    assert events(pad) == [KeyEvent('0', PRESS, 0)]
+    assert pad.stable_keys == {'0'}
+
+def test_get_key_skips_releases_and_other_keys(gpio):
+    pad = keypad(gpio = gpio)
+    for event in [KeyEvent('5', PRESS, 0), KeyEvent('5', RELEASE, 1), KeyEvent('1', PRESS, 2), KeyEvent('2', PRESS, 3)]:
+        pad.events.put(event)
+    assert pad.get_key(['1', '2'], 0) == '1'
+    pad.clear_events()
+    assert pad.get_key(None, 0) is None
+
+def test_edge_wakes_the_interrupt_scan(gpio):
+    pad = keypad(mode = INTERRUPT, gpio = gpio)
+    pad.start()
+    try:
+        assert pad.get_event(.1) is None
+        assert pad.wakeups == 0
+        gpio.connect(*switch(gpio, pad, '7'))
+        assert pad.get_event(2)[:2] == ('7', PRESS)
+        assert pad.wakeups == 1
+        gpio.disconnect(*switch(gpio, pad, '7'))
+        assert pad.get_event(2)[:2] == ('7', RELEASE)
+        # Asleep again: nothing is scanned until the next edge
+        time.sleep(.05)
+        inputs = gpio.calls['input']
+        time.sleep(.1)
+        assert gpio.calls['input'] == inputs
+    finally:
+        pad.stop()
@@ -0,0 +1,68 @@
+import pytest
+import hal
+from hal_fakes import FakeSMBus
+from I2C_LCD_driver import I2CBUS, lcd
+from lcd_framebuffer import LcdFramebuffer
+
+@pytest.fixture
+def bus():
+    bus = FakeSMBus()
+    hal.i2c_buses[I2CBUS] = bus
+    yield bus
+    hal.reset()
+
+@pytest.fixture
+def framebuffer(bus):
+    return LcdFramebuffer(lcd())
+
+def rows(*lines):
+    return [line.ljust(20) for line in lines]
+
+def test_full_redraw_moves_the_cursor_once(framebuffer, bus):
+    framebuffer.show(('Please select', 1, 0), ('a product', 2, 0), ('1: Lucky Charms', 3, 0), ('2: Fruit Loops', 4, 0))
+    assert bus.screen() == rows('Please select', 'a product', '1: Lucky Charms', '2: Fruit Loops')
+    # One DDRAM address command, then all 80 cells in DDRAM order
+    assert framebuffer.writes == 1 + 80
+
+def test_partial_row_update(framebuffer, bus):
+    framebuffer.show(('Hello world', 1, 0), ('Row two', 2, 0))
+    writes = framebuffer.writes
+    framebuffer.show(('Hello there', 1, 0), ('Row two', 2, 0))
+    assert bus.screen() == rows('Hello there', 'Row two', '', '')
+    assert framebuffer.writes - writes == 1 + len('there')
+
+# Row 3 ends at DDRAM 0x27, the address counter wraps to 0x40, row 2
+def test_write_across_a_row_wrap(framebuffer, bus):
+    framebuffer.show()
+    writes = framebuffer.writes
+    framebuffer.show(('>', 2, 0), ('<', 3, 19))
+    assert bus.screen() == rows('', '>', ' ' * 19 + '<', '')
+    assert framebuffer.writes - writes == 1 + 2
+
+# The last cell, 0x67, wraps to 0x00: the next draw needs no cursor move
+def test_cursor_wraps_from_the_last_cell(framebuffer, bus):
+    framebuffer.show()
+    framebuffer.show(('!', 4, 19))
+    writes = framebuffer.writes
+    framebuffer.show(('#', 1, 0), ('!', 4, 19))
+    assert bus.screen() == rows('#', '', '', ' ' * 19 + '!')
+    assert framebuffer.writes - writes == 1
+
+def test_shorter_string_blanks_the_rest(framebuffer, bus):
+    framebuffer.show(('Lucky Charms', 1, 0))
+    framebuffer.show(('Fruit', 1, 0))
+    assert bus.screen() == rows('Fruit', '', '', '')
+
+def test_display_string_keeps_the_rest_of_the_screen(framebuffer, bus):
+    framebuffer.show(('Please wait', 1, 0), ('Dispensing', 2, 0))
+    framebuffer.lcd_display_string('$2.00', 2, 15)
+    assert bus.screen() == rows('Please wait', 'Dispensing     $2.00', '', '')
+
+def test_invalidate_redraws_everything(framebuffer, bus):
+    framebuffer.show(('Thank you', 1, 0))
+    bus.ddram[:] = b'x' * len(bus.ddram)
+    framebuffer.show(('Thank you', 1, 0))
+    assert bus.screen() == ['x' * 20] * 4
+    framebuffer.invalidate()
+    framebuffer.show(('Thank you', 1, 0))
+    assert bus.screen() == rows('Thank you', '', '', '')
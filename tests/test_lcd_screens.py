@@ -0,0 +1,63 @@
+import pytest
+import hal
+from hal_fakes import FakeSMBus
+from I2C_LCD_driver import I2CBUS, lcd
+from lcd_framebuffer import LcdFramebuffer
+from lcd_screens import ScreenRegistry
+
+@pytest.fixture
+def bus():
+    bus = FakeSMBus()
+    hal.i2c_buses[I2CBUS] = bus
+    yield bus
+    hal.reset()
+
+@pytest.fixture
+def framebuffer(bus):
+    return LcdFramebuffer(lcd())
+
+@pytest.fixture
+def screens():
+    screens = ScreenRegistry()
+    screens.register('confirm', [('Confirm', 1, 0), ('1-confirm 2-cancel', 4, 0)],
+                     {'product': (2, 0, 20), 'price': (3, 14, 6)})
+    screens.register('thank_you', [('Thank you', 2, 5)])
+    return screens
+
+def test_frame_and_burst_agree(bus, screens):
+    frame, burst = screens.render('confirm', product = 'Lucky Charms', price = '$2.00')
+    assert frame == ['Confirm'.ljust(20), 'Lucky Charms'.ljust(20), ' ' * 14 + '$2.00 ', '1-confirm 2-cancel'.ljust(20)]
+    lcd().lcd_write_sequence(burst)
+    assert bus.screen() == frame
+
+def test_field_is_cut_to_its_width(screens):
+    frame, burst = screens.render('confirm', product = 'Lucky Charms, the large bag', price = '$123.456')
+    assert frame[1] == 'Lucky Charms, the la'
+    assert frame[2] == ' ' * 14 + '$123.4'
+
+def test_unchanged_render_is_the_compiled_screen(screens):
+    assert screens.render('thank_you') == (screens.screens['thank_you'].frame, screens.screens['thank_you'].burst)
+
+# A fresh framebuffer knows nothing of the glass, the burst is no longer
+# than the diff and is sent as it is
+def test_full_redraw_uses_the_burst(framebuffer, bus, screens):
+    frame, burst = screens.render('thank_you')
+    framebuffer.show_screen((frame, burst))
+    assert bus.screen() == frame
+    assert framebuffer.writes == 1 + 80
+
+def test_field_shorter_than_the_previous_value(framebuffer, bus, screens):
+    framebuffer.show_screen(screens.render('confirm', product = 'Lucky Charms', price = '$12.00'))
+    writes = framebuffer.writes
+    frame, burst = screens.render('confirm', product = 'Fruit', price = '$2')
+    framebuffer.show_screen((frame, burst))
+    assert bus.screen() == frame
+    assert frame[1] == 'Fruit'.ljust(20)
+    # '12.00' over '2' ends row 3 at 0x27, which wraps on to 'Lucky Charms'
+    # over 'Fruit' at the start of row 2: one cursor move
+    assert framebuffer.writes - writes == 1 + 5 + 12
+
+def test_switching_screens_leaves_nothing_behind(framebuffer, bus, screens):
+    framebuffer.show_screen(screens.render('confirm', product = 'Lucky Charms', price = '$2.00'))
+    framebuffer.show_screen(screens.render('thank_you'))
+    assert bus.screen() == screens.render('thank_you')[0]
@@ -0,0 +1,121 @@
+import pytest
+from roboclaw_3 import Roboclaw
+
+ADDRESS = 0x80
+ACK = b'\xff'
+
+# Serial port stand-in: records writes, answers reads from replies
+class FakePort:
+    def __init__(self, replies = b''):
+        self.writes = []
+        self.replies = bytearray(replies)
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+        return len(data)
+
+    def read(self, size = 1):
+        data = bytes(self.replies[:size])
+        del self.replies[:size]
+        return data
+
+    def flushInput(self):
+        pass
+
+def roboclaw(replies = b''):
+    claw = Roboclaw('/dev/null', 38400)
+    claw._port = FakePort(replies)
+    return claw
+
+# Bit by bit CRC16-CCITT (0x1021, initial 0), as the Roboclaw manual gives it
+def reference_crc(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+# The frame the per-byte writers used to send: address, command, each value
+# masked and split big-endian, then the CRC word
+def reference_frame(cmd, *fields):
+    data = [ADDRESS, cmd]
+    for width, val in fields:
+        data += [(val >> shift) & 0xFF for shift in range(8 * (width - 1), -8, -8)]
+    crc = reference_crc(data)
+    return bytes(data + [crc >> 8, crc & 0xFF])
+
+WRITES = [
+    ('ForwardM1', (64,), (Roboclaw.Cmd.M1FORWARD, (1, 64))),
+    ('ResetEncoders', (), (Roboclaw.Cmd.RESETENC,)),
+    ('SetMainVoltages', (60, 340), (Roboclaw.Cmd.SETMAINVOLTAGES, (2, 60), (2, 340))),
+    ('DutyM1M2', (-16384, 32767), (Roboclaw.Cmd.MIXEDDUTY, (2, -16384), (2, 32767))),
+    ('SetEncM1', (-1, ), (Roboclaw.Cmd.SETM1ENCCOUNT, (4, -1))),
+    ('SpeedDistanceM1', (200, 1400, 0), (Roboclaw.Cmd.M1SPEEDDIST, (4, 200), (4, 1400), (1, 0))),
+    ('SpeedDistanceM1', (-100, 50, 1), (Roboclaw.Cmd.M1SPEEDDIST, (4, -100), (4, 50), (1, 1))),
+    ('SpeedAccelDistanceM1M2', (5000, -300, 2000, 300, 2000, 1),
+        (Roboclaw.Cmd.MIXEDSPEEDACCELDIST, (4, 5000), (4, -300), (4, 2000), (4, 300), (4, 2000), (1, 1))),
+    ('SpeedAccelDistanceM1M2_2', (1000, 200, 1400, 2000, -200, 1400, 0),
+        (Roboclaw.Cmd.MIXEDSPEED2ACCELDIST, (4, 1000), (4, 200), (4, 1400), (4, 2000), (4, -200), (4, 1400), (1, 0))),
+    ('SetM1VelocityPID', (1.5, .25, 0, 44000),
+        (Roboclaw.Cmd.SETM1PID, (4, 0), (4, int(1.5 * 65536)), (4, int(.25 * 65536)), (4, 44000))),
+]
+
+@pytest.mark.parametrize('method, args, frame', WRITES, ids = [write[0] for write in WRITES])
+def test_write_frame_matches_per_byte_encoding(method, args, frame):
+    claw = roboclaw(ACK)
+    assert getattr(claw, method)(ADDRESS, *args)
+    assert claw._port.writes == [reference_frame(*frame)]
+
+def test_write_retries_the_whole_frame_without_ack():
+    claw = roboclaw()
+    assert not claw.ForwardM1(ADDRESS, 64)
+    assert claw._port.writes == [reference_frame(Roboclaw.Cmd.M1FORWARD, (1, 64))] * claw._trystimeout
+
+# A reply as the Roboclaw sends it: payload, then the CRC word over the
+# request and the payload
+def reply(cmd, payload, corrupt = False):
+    crc = reference_crc(bytes((ADDRESS, cmd)) + payload) ^ (1 if corrupt else 0)
+    return payload + crc.to_bytes(2, 'big')
+
+ENCODER = (-1234).to_bytes(4, 'big', signed = True) + b'\x02'
+BATTERY = (242).to_bytes(2, 'big')
+
+def test_bulk_read_decodes_reply():
+    claw = roboclaw(reply(Roboclaw.Cmd.GETM1ENC, ENCODER))
+    assert claw.ReadEncM1(ADDRESS) == (1, -1234, 2)
+    assert claw._port.writes == [bytes((ADDRESS, Roboclaw.Cmd.GETM1ENC))]
+
+def test_bulk_read_crc_failure():
+    claw = roboclaw(reply(Roboclaw.Cmd.GETM1ENC, ENCODER, corrupt = True))
+    assert claw.ReadEncM1(ADDRESS) == (0, 0)
+    claw = roboclaw(reply(Roboclaw.Cmd.GETMBATT, BATTERY, corrupt = True))
+    assert claw.ReadMainBatteryVoltage(ADDRESS) == (0, 0)
+
+def test_bulk_read_short_reply_retries_then_fails():
+    claw = roboclaw(ENCODER)
+    assert claw.ReadEncM1(ADDRESS) == (0, 0)
+    assert len(claw._port.writes) == claw._trystimeout
+
+def test_read_n_decodes_reply():
+    pid = b''.join(value.to_bytes(4, 'big') for value in (98304, 16384, 0, 44000))
+    claw = roboclaw(reply(Roboclaw.Cmd.READM1PID, pid) + reply(Roboclaw.Cmd.GETM1MAXCURRENT, (2500).to_bytes(4, 'big') + bytes(4)))
+    assert claw.ReadM1VelocityPID(ADDRESS) == [1, 1.5, .25, 0, 44000]
+    assert claw.ReadM1MaxCurrent(ADDRESS) == (1, 2500)
+
+def test_pipelined_read():
+    cmds = [Roboclaw.Cmd.GETM1ENC, Roboclaw.Cmd.GETMBATT]
+    claw = roboclaw(reply(cmds[0], ENCODER) + reply(cmds[1], BATTERY))
+    assert claw.ReadPipelined(ADDRESS, cmds) == [(1, -1234, 2), (1, 242)]
+    assert claw._port.writes == [bytes((ADDRESS, cmds[0], ADDRESS, cmds[1]))]
+    assert claw.pipeline_fallbacks == 0
+
+def test_pipelined_read_crc_failure_falls_back_to_single_reads():
+    cmds = [Roboclaw.Cmd.GETM1ENC, Roboclaw.Cmd.GETMBATT, Roboclaw.Cmd.GETM2ENC]
+    pipelined = reply(cmds[0], ENCODER) + reply(cmds[1], BATTERY, corrupt = True) + reply(cmds[2], ENCODER)
+    single = reply(cmds[0], ENCODER) + reply(cmds[1], BATTERY, corrupt = True) + reply(cmds[2], ENCODER, corrupt = True)
+    claw = roboclaw(pipelined + single)
+    # Failed reads keep the single read functions' shapes
+    assert claw.ReadPipelined(ADDRESS, cmds) == [(1, -1234, 2), (0, 0), (0, 0)]
+    assert claw.pipeline_fallbacks == 1
+    assert claw._port.writes[1:] == [bytes((ADDRESS, cmd)) for cmd in cmds]
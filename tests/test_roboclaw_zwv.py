@@ -0,0 +1,40 @@
+import pytest
+import hal
+from roboclaw_simulator import RoboclawSimulator
+from roboclaw_zwv import RoboclawCommandError, Roboclaw_zwv
+
+ADDRESS = 0x80
+PORT = '/dev/fake-roboclaw'
+
+@pytest.fixture
+def roboclaw(tmp_path):
+    simulator = RoboclawSimulator(address = ADDRESS, use_pty = False)
+    simulator.install(PORT)
+    claw = Roboclaw_zwv(PORT, 38400, log_file_dir = str(tmp_path))
+    claw.Open()
+    yield claw, simulator
+    hal.reset()
+
+def test_unacknowledged_command_stops_before_commands_sent(roboclaw):
+    claw, simulator = roboclaw
+    sent = []
+    commands = [
+                    lambda : claw.SpeedDistanceM1(ADDRESS, 200, 1400, 0),
+                    lambda : False
+               ]
+    with pytest.raises(RoboclawCommandError) as error:
+        claw.execute_buffered_commands_with_logging(ADDRESS, commands, before_wait_time = 0, after_wait_time = 0,
+                                                    on_commands_sent = lambda : sent.append(True))
+    assert error.value.index == 1
+    assert sent == []
+    motor = simulator.motors[0]
+    assert motor.target_speed == 0 and motor.remaining is None
+
+def test_acknowledged_commands_run_to_completion(roboclaw):
+    claw, simulator = roboclaw
+    sent = []
+    commands = [lambda : claw.SpeedDistanceM1(ADDRESS, 3000, 300, 0)]
+    claw.execute_buffered_commands_with_logging(ADDRESS, commands, before_wait_time = 0, after_wait_time = 0,
+                                                on_commands_sent = lambda : sent.append(True), motion_timeout = 5)
+    assert sent == [True]
+    assert simulator.motors[0].buffer_status() == 0x80
@@ -0,0 +1,243 @@
+import json
+import threading
+import numpy
+import pytest
+import hal
+from roboclaw_simulator import RoboclawSimulator
+from roboclaw_zwv import Roboclaw_zwv
+from telemetry import (TELEMETRY_DTYPE, TELEMETRY_LOG_HEADER, TELEMETRY_LOG_MAGIC, TelemetryLogWriter, TelemetrySampler,
+                       count_log_records, downsample, is_telemetry_log, load_metric_columns, lttb_indices, minmax_indices,
+                       read_csv_log, read_telemetry_log)
+
+def series(length = 1000, seed = 1):
+    random = numpy.random.default_rng(seed)
+    x = numpy.arange(length, dtype = numpy.float64)
+    y = numpy.cumsum(random.normal(size = length))
+    return x, y
+
+@pytest.mark.parametrize('threshold', [3, 10, 101, 999])
+def test_lttb_keeps_threshold_points_with_both_ends(threshold):
+    x, y = series()
+    indices = lttb_indices(x, y, threshold)
+    assert len(indices) == threshold
+    assert indices[0] == 0 and indices[-1] == len(y) - 1
+    assert numpy.all(numpy.diff(indices) > 0)
+
+def test_short_input_keeps_every_index():
+    x, y = series(50)
+    assert list(lttb_indices(x, y, 80)) == list(range(50))
+    assert list(minmax_indices(y, 80)) == list(range(50))
+
+def test_lttb_keeps_a_spike():
+    x = numpy.arange(1000, dtype = numpy.float64)
+    y = numpy.zeros(1000)
+    y[567] = 100
+    assert 567 in lttb_indices(x, y, 20)
+
+@pytest.mark.parametrize('threshold', [2, 3, 10, 101, 999])
+def test_minmax_keeps_both_ends_within_threshold(threshold):
+    x, y = series()
+    indices = minmax_indices(y, threshold)
+    assert len(indices) <= threshold
+    assert indices[0] == 0 and indices[-1] == len(y) - 1
+    assert numpy.all(numpy.diff(indices) > 0)
+
+def test_minmax_keeps_the_extremes():
+    x, y = series()
+    indices = minmax_indices(y, 20)
+    assert numpy.argmin(y) in indices and numpy.argmax(y) in indices
+    y = numpy.zeros(1000)
+    y[567], y[568] = 100, -100
+    assert {567, 568} <= set(minmax_indices(y, 20))
+
+@pytest.mark.parametrize('mode', ['lttb', 'minmax'])
+def test_short_input_is_returned_unchanged(mode):
+    x, y = series(50)
+    for max_points in (50, 80, None):
+        sampled_x, sampled_y = downsample(x, y, max_points, mode)
+        assert sampled_x is x and sampled_y is y
+
+@pytest.mark.parametrize('mode', ['lttb', 'minmax'])
+def test_downsample_takes_x_and_y_at_the_same_indices(mode):
+    x, y = series()
+    sampled_x, sampled_y = downsample(x, y, 100, mode)
+    assert len(sampled_x) == len(sampled_y) <= 100
+    assert numpy.array_equal(sampled_y, y[sampled_x.astype(numpy.int64)])
+
+def test_unknown_mode():
+    x, y = series()
+    with pytest.raises(Exception, match = 'Unknown downsample mode'):
+        downsample(x, y, 100, 'median')
+
+@pytest.fixture
+def clock():
+    hal.set_clock(hal.ScaledClock(10))
+    yield hal.clock
+    hal.reset()
+
+# read_metrics takes read_time seconds, the first read first_read_time; the
+# position counts the reads
+class SlowRoboclaw:
+    def __init__(self, read_time = 0, first_read_time = None):
+        self.port_lock = threading.Lock()
+        self.read_time = read_time
+        self.first_read_time = first_read_time
+        self.reads = 0
+
+    def read_metrics(self, address):
+        first = self.reads == 0 and self.first_read_time is not None
+        self.reads += 1
+        hal.clock.sleep(self.first_read_time if first else self.read_time)
+        now = hal.clock.time()
+        return now, self.reads, now, 100, now, 5, now
+
+def run(sampler, seconds):
+    sampler.start()
+    hal.clock.sleep(seconds)
+    sampler.stop()
+    return sampler.snapshot()
+
+def test_samples_the_motor_through_the_serial_port(clock, tmp_path):
+    simulator = RoboclawSimulator(use_pty = False)
+    simulator.install('/dev/fake-roboclaw')
+    roboclaw = Roboclaw_zwv('/dev/fake-roboclaw', 38400, log_file_dir = str(tmp_path))
+    roboclaw.Open()
+    roboclaw.SpeedM1(0x80, 1000)
+    samples = run(TelemetrySampler(roboclaw, 0x80, rate = 10), 3)
+    assert 25 <= len(samples) <= 33
+    assert numpy.all(numpy.diff(samples['position']) > 0)
+    assert samples['speed'][-1] == 1000
+
+def test_samples_on_deadlines(clock):
+    sampler = TelemetrySampler(SlowRoboclaw(), 0x80, rate = 10)
+    samples = run(sampler, 5)
+    assert 48 <= sampler.count <= 55
+    # Scaled time, a scheduler hiccup on a loaded host can cost a deadline
+    assert sampler.missed_deadlines <= 1
+    assert list(samples['position']) == list(range(1, sampler.count + 1))
+    assert numpy.diff(samples['time']).mean() == pytest.approx(.1, abs = .01)
+    assert 0 <= sampler.stats()['jitter_p50_us'] < 50000
+
+# Each read takes 2.5 periods: the deadlines it overran are skipped
+def test_slow_reads_miss_deadlines(clock):
+    sampler = TelemetrySampler(SlowRoboclaw(read_time = .25), 0x80, rate = 10)
+    run(sampler, 5)
+    assert 17 <= sampler.count <= 23
+    assert 47 <= sampler.count + sampler.missed_deadlines <= 55
+
+# The first read takes five periods; the deadlines it overran are either
+# skipped or sampled back to back
+@pytest.mark.parametrize('catch_up', [False, True])
+def test_late_start_is_skipped_or_caught_up(clock, catch_up):
+    sampler = TelemetrySampler(SlowRoboclaw(first_read_time = .5), 0x80, rate = 10, catch_up = catch_up)
+    run(sampler, 5)
+    stats = sampler.stats()
+    assert stats['samples'] == sampler.count
+    assert 47 <= sampler.count + sampler.missed_deadlines <= 55
+    if catch_up:
+        assert stats['missed_deadlines'] == 0
+        # The first caught up sample starts 0.4 s after its deadline
+        assert stats['jitter_max_us'] >= 400000
+    else:
+        assert 4 <= stats['missed_deadlines'] <= 6
+        assert stats['jitter_max_us'] < 200000
+
+def test_writer_keeps_every_sample_through_ring_wraps(clock, tmp_path):
+    log_file_path = str(tmp_path / 'run.tlm')
+    with TelemetryLogWriter(log_file_path) as writer:
+        sampler = TelemetrySampler(SlowRoboclaw(), 0x80, rate = 10, capacity = 8, writer = writer, flush_interval = .3)
+        samples = run(sampler, 5)
+    assert sampler.count > 8 and len(samples) == 8
+    log = read_telemetry_log(log_file_path)
+    assert list(log['position']) == list(range(1, sampler.count + 1))
+    assert sampler.stats()['dropped_samples'] == 0
+
+def test_writer_counts_samples_overwritten_before_the_drain(clock, tmp_path):
+    log_file_path = str(tmp_path / 'run.tlm')
+    with TelemetryLogWriter(log_file_path) as writer:
+        sampler = TelemetrySampler(SlowRoboclaw(), 0x80, rate = 10, capacity = 4, writer = writer, flush_interval = 60)
+        run(sampler, 2)
+    log = read_telemetry_log(log_file_path)
+    assert list(log['position']) == list(range(sampler.count - 3, sampler.count + 1))
+    assert sampler.dropped_samples == sampler.count - 4
+
+def test_stats_are_written_next_to_the_log(clock, tmp_path):
+    sampler = TelemetrySampler(SlowRoboclaw(), 0x80, rate = 10)
+    run(sampler, 1)
+    stats_file_path = sampler.write_stats(str(tmp_path / 'run.tlm'))
+    assert stats_file_path == str(tmp_path / 'run.stats.json')
+    with open(stats_file_path) as stats_file:
+        assert json.load(stats_file)['samples'] == sampler.count
+
+def records(count):
+    samples = numpy.zeros(count, dtype = TELEMETRY_DTYPE)
+    samples['time'] = 1.7e9 + numpy.arange(count) / 100
+    samples['position'] = numpy.arange(count) * 7 - 2**31
+    samples['speed'] = -numpy.arange(count)
+    samples['current'] = numpy.arange(count) % 2**15
+    return samples
+
+def test_log_round_trip(tmp_path):
+    log_file_path = str(tmp_path / 'run.tlm')
+    samples = records(1000)
+    with TelemetryLogWriter(log_file_path) as writer:
+        writer.write(samples[:10])
+        writer.write(samples[10:])
+    assert is_telemetry_log(log_file_path)
+    log = read_telemetry_log(log_file_path)
+    assert isinstance(log, numpy.memmap)
+    assert numpy.array_equal(log, samples)
+
+def test_empty_log(tmp_path):
+    log_file_path = str(tmp_path / 'run.tlm')
+    TelemetryLogWriter(log_file_path).close()
+    assert len(read_telemetry_log(log_file_path)) == 0
+
+def test_record_cut_short_is_ignored(tmp_path):
+    log_file_path = str(tmp_path / 'run.tlm')
+    with TelemetryLogWriter(log_file_path) as writer:
+        writer.write(records(3))
+    with open(log_file_path, 'ab') as log_file:
+        log_file.write(records(1).tobytes()[:5])
+    assert numpy.array_equal(read_telemetry_log(log_file_path), records(3))
+
+def test_csv_log_is_not_a_telemetry_log(tmp_path):
+    log_file_path = tmp_path / 'run.csv'
+    log_file_path.write_text('1.0,2,1.0,3,1.0,4,1.0\n')
+    assert not is_telemetry_log(str(log_file_path))
+    with pytest.raises(Exception, match = 'not a telemetry log'):
+        read_telemetry_log(str(log_file_path))
+
+def test_unsupported_version(tmp_path):
+    log_file_path = tmp_path / 'run.tlm'
+    log_file_path.write_bytes(TELEMETRY_LOG_HEADER.pack(TELEMETRY_LOG_MAGIC, 2, TELEMETRY_LOG_HEADER.size, TELEMETRY_DTYPE.itemsize))
+    with pytest.raises(Exception, match = 'Unsupported telemetry log version 2'):
+        read_telemetry_log(str(log_file_path))
+
+CSV_LOG = """# time,position,time,speed,time,current,time
+1000.000,500,1000.000,0,1000.000,3,1000.001
+
+1000.010,510,1000.010,1000,1000.010,40,1000.011
+   
+# stopped
+1000.020,530,1000.020,2000,1000.020,80,1000.021  # last
+"""
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 65536])
+def test_csv_comments_and_blank_lines_are_not_records(tmp_path, chunk_size):
+    log_file_path = tmp_path / 'run.csv'
+    log_file_path.write_text(CSV_LOG)
+    assert count_log_records(str(log_file_path)) == 3
+    relative_times, relative_positions, speeds, currents = load_metric_columns(str(log_file_path), chunk_size)
+    assert relative_times == pytest.approx([0, 10, 20])
+    assert list(relative_positions) == [0, 10, 30]
+    assert list(speeds) == [0, 1000, 2000]
+    assert list(currents) == [30, 400, 800]
+
+def test_binary_and_csv_logs_load_the_same(tmp_path):
+    log_file_path = tmp_path / 'run.csv'
+    log_file_path.write_text(CSV_LOG)
+    with TelemetryLogWriter(str(tmp_path / 'run.tlm')) as writer:
+        writer.write(read_csv_log(str(log_file_path)))
+    for csv_column, binary_column in zip(load_metric_columns(str(log_file_path)), load_metric_columns(str(tmp_path / 'run.tlm'))):
+        assert numpy.array_equal(csv_column, binary_column)
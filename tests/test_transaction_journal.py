@@ -0,0 +1,213 @@
+import threading
+import pytest
+from ePort import ePort, ePortTimeoutError
+from ePort_watcher import ePortStatusEvent, ePortStatusWaiter
+from transaction_journal import (TransactionJournal, SettlementWorker, AUTHORIZED, READY, SUBMITTED, SETTLED,
+                                 DISPENSE_FAILED, INTERRUPTED, ABANDONED, REFUND_DUE, REFUNDED)
+
+ACK = ('\x06', 'ACK', 'ePort has acknowledged a command', [], None)
+NAK = ('\x15', 'NAK', 'command not acknowleged', [], None)
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / 'transactions.sqlite3')
+
+@pytest.fixture
+def journal(journal_path):
+    journal = TransactionJournal(journal_path)
+    yield journal
+    journal.close()
+
+def state(journal, sale_id):
+    return journal.sale(sale_id)[4]
+
+def test_sale_settles(journal):
+    sale_id = journal.record_sale('Lucky Charms', '1 cup', 200)
+    assert state(journal, sale_id) == AUTHORIZED
+    assert journal.pending() == []
+    journal.mark_dispensed(sale_id)
+    assert journal.pending() == [(sale_id, 200, 0, READY)]
+    journal.mark_submitted(sale_id)
+    assert journal.pending() == [(sale_id, 200, 0, SUBMITTED)]
+    journal.mark_attempt_failed(sale_id, 'FAIL_NETWORK')
+    assert journal.pending() == [(sale_id, 200, 1, SUBMITTED)]
+    journal.mark_settled(sale_id, '0000000001')
+    assert journal.sale(sale_id)[4:8] == (SETTLED, 2, '0000000001', None)
+    assert journal.pending() == []
+    assert journal.state_counts() == {SETTLED: 1}
+
+def test_failed_dispense_is_not_settled(journal):
+    sale_id = journal.record_sale('Fruit Loops', '1/2 cup', 88)
+    journal.mark_dispensed(sale_id, False, 'Roboclaw not responding')
+    assert journal.sale(sale_id)[4:8] == (DISPENSE_FAILED, 0, None, 'Roboclaw not responding')
+    assert journal.pending() == []
+
+def test_retries_exhausted(journal):
+    sale_id = journal.record_sale('Fruit Loops', '1 cup', 175)
+    journal.mark_dispensed(sale_id)
+    journal.mark_attempt_failed(sale_id, 'FAIL_SERVER', abandon = True)
+    assert state(journal, sale_id) == ABANDONED
+    assert journal.pending() == []
+
+# The jam and the settlement race, either order leaves the sale to refund
+@pytest.mark.parametrize('jam_first', [True, False])
+def test_jam_is_kept_through_settlement(journal, jam_first):
+    sale_id = journal.record_sale('Lucky Charms', '2 cups', 400)
+    journal.mark_dispensed(sale_id)
+    if jam_first:
+        journal.mark_dispense_error(sale_id, 'Motion not complete within 20 s')
+        assert journal.pending() == [(sale_id, 400, 0, READY)]
+        journal.mark_settled(sale_id, '0000000002')
+    else:
+        journal.mark_settled(sale_id, '0000000002')
+        journal.mark_dispense_error(sale_id, 'Motion not complete within 20 s')
+    assert journal.dispense_errors() == [(sale_id, 'Lucky Charms', '2 cups', 400, REFUND_DUE, '0000000002', 'Motion not complete within 20 s')]
+    assert journal.state_counts() == {REFUND_DUE: 1}
+    assert journal.mark_refunded(sale_id)
+    assert state(journal, sale_id) == REFUNDED
+    assert not journal.mark_refunded(sale_id)
+
+def test_abandoned_jam_is_not_refunded(journal):
+    sale_id = journal.record_sale('Lucky Charms', '2 cups', 400)
+    journal.mark_dispensed(sale_id)
+    journal.mark_dispense_error(sale_id, 'Motion not complete within 20 s')
+    journal.mark_attempt_failed(sale_id, 'FAIL_SERVER', abandon = True)
+    assert state(journal, sale_id) == ABANDONED
+    assert not journal.mark_refunded(sale_id)
+
+# The machine stops after AUTH_OK but before the dispense result: the sale
+# is never settled, dispensed sales still are
+def test_crash_between_dispense_and_settle(journal_path):
+    journal = TransactionJournal(journal_path)
+    interrupted = journal.record_sale('Lucky Charms', '1 cup', 200)
+    ready = journal.record_sale('Fruit Loops', '1 cup', 175)
+    journal.mark_dispensed(ready)
+    submitted = journal.record_sale('Fruit Loops', '2 cups', 350)
+    journal.mark_dispensed(submitted)
+    journal.mark_submitted(submitted)
+    journal.close()
+
+    journal = TransactionJournal(journal_path)
+    assert state(journal, interrupted) == INTERRUPTED
+    assert journal.pending() == [(ready, 175, 0, READY), (submitted, 350, 0, SUBMITTED)]
+    journal.close()
+
+# Replies by command identifier; an exception instance is raised instead
+class FakeePort:
+    def __init__(self, replies):
+        self.replies = replies
+        self.commands = []
+
+    def send_command(self, command, data = []):
+        self.commands.append(command)
+        reply = self.replies.get(command, ACK)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+# Answers every expect with status, or never if status is None
+class FakeWatcher:
+    def __init__(self, status = None):
+        self.status = status
+        self.cancelled = 0
+
+    def expect(self, codes):
+        waiter = ePortStatusWaiter(codes)
+        if self.status is not None:
+            waiter._deliver(ePortStatusEvent(self.status, None, 0))
+        return waiter
+
+    def cancel(self, waiter):
+        self.cancelled += 1
+
+TRANSACTION_ID = ('17', 'TRANSACTION_ID', '', [('transaction_id', '0000000007')], None)
+FAIL_NETWORK = ('30', 'FAIL_NETWORK', '', [], None)
+
+def settle(journal, replies, status, sale_state = READY):
+    sale_id = journal.record_sale('Lucky Charms', '1 cup', 200)
+    journal.mark_dispensed(sale_id)
+    if sale_state == SUBMITTED:
+        journal.mark_submitted(sale_id)
+    eport = FakeePort(replies)
+    worker = SettlementWorker(journal, eport, FakeWatcher(status), settle_timeout = .1)
+    return sale_id, worker._settle(sale_id, 200, sale_state), eport.commands
+
+def test_settle(journal):
+    sale_id, result, commands = settle(journal, {}, TRANSACTION_ID)
+    assert result == ('0000000007', None)
+    assert commands == [ePort.TRANSACTION_RESULT, ePort.ACQUIRE_TRANSACTION_ID, ePort.DISABLE]
+    assert state(journal, sale_id) == SUBMITTED
+
+def test_submitted_sale_only_asks_for_the_transaction_id(journal):
+    sale_id, result, commands = settle(journal, {}, TRANSACTION_ID, SUBMITTED)
+    assert result == ('0000000007', None)
+    assert ePort.TRANSACTION_RESULT not in commands
+
+def test_nak_to_transaction_result_is_retried_from_ready(journal):
+    sale_id, result, commands = settle(journal, {ePort.TRANSACTION_RESULT: NAK}, TRANSACTION_ID)
+    assert result == (None, 'TRANSACTION_RESULT NAK')
+    assert commands == [ePort.TRANSACTION_RESULT]
+    assert state(journal, sale_id) == READY
+
+def test_lost_transaction_result_reply_counts_as_submitted(journal):
+    lost = ePortTimeoutError(ePort.TRANSACTION_RESULT, b'')
+    sale_id, result, commands = settle(journal, {ePort.TRANSACTION_RESULT: lost}, TRANSACTION_ID)
+    assert result == ('0000000007', None)
+    assert state(journal, sale_id) == SUBMITTED
+
+def test_network_failure(journal):
+    sale_id, result, commands = settle(journal, {}, FAIL_NETWORK)
+    assert result == (None, 'FAIL_NETWORK')
+    assert ePort.DISABLE not in commands
+
+def test_no_transaction_id_before_settle_timeout(journal):
+    sale_id, result, commands = settle(journal, {}, None)
+    assert result == (None, 'No transaction ID before settle timeout')
+
+def test_failed_disable_still_settles(journal):
+    failed = ePortTimeoutError(ePort.DISABLE, b'')
+    sale_id, result, commands = settle(journal, {ePort.DISABLE: failed}, TRANSACTION_ID)
+    assert result == ('0000000007', None)
+
+def test_worker_retries_without_resending_the_result(journal):
+    sale_id = journal.record_sale('Lucky Charms', '1 cup', 200)
+    journal.mark_dispensed(sale_id)
+    eport = FakeePort({})
+    watcher = FakeWatcher(FAIL_NETWORK)
+    worker = SettlementWorker(journal, eport, watcher, settle_timeout = .1, retry_interval = .01)
+    worker.start()
+    try:
+        assert not worker.wait_drained(.2)
+        watcher.status = TRANSACTION_ID
+        assert worker.wait_drained(5)
+    finally:
+        worker.stop()
+    sale_state, attempts, transaction_id = journal.sale(sale_id)[4:7]
+    assert (sale_state, transaction_id) == (SETTLED, '0000000007')
+    assert attempts > 1
+    assert eport.commands.count(ePort.TRANSACTION_RESULT) == 1
+
+# A sale is dispensed and notified after the worker found nothing pending,
+# but before it reports drained
+def test_notify_while_finding_nothing_pending(journal):
+    worker = SettlementWorker(journal, FakeePort({}), FakeWatcher(), settle_timeout = .5)
+    notified = threading.Event()
+    def dispense_and_notify():
+        journal.mark_dispensed(journal.record_sale('Lucky Charms', '1 cup', 200))
+        worker.notify()
+        notified.set()
+    pending = journal.pending
+    notifier = threading.Thread(target=dispense_and_notify)
+    def pending_then_notify():
+        result = pending()
+        if notifier.ident is None:
+            notifier.start()
+            notifier.join(.2)
+        return result
+    journal.pending = pending_then_notify
+    worker.start()
+    try:
+        assert notified.wait(5)
+        assert not worker.wait_drained(.2)
+    finally:
+        worker.stop()
@@ -0,0 +1,131 @@
+import pytest
+import hal
+from ePort import ePort
+from keypad import KeyEvent, PRESS
+from kiosk_simulation import SimulatedKiosk, BUY, SELECT_PRODUCT_TEXT, SELECT_AMOUNT_TEXT, CONFIRM_TEXT, THANK_YOU_TEXT, FAILED_TEXT
+from vending_machine import Vending_Machine
+from async_vending_machine import Async_Vending_Machine
+from transaction_journal import REFUND_DUE
+
+# The amount key bounces: a second press is queued before the confirmation
+# screen is drawn
+class DoubleTapVending_Machine(Vending_Machine):
+    def _get_amount_selection(self, wait_time = 30):
+        key = Vending_Machine._get_amount_selection(self, wait_time)
+        self.keypad.events.put(KeyEvent(key, PRESS, hal.clock.monotonic()))
+        return key
+
+# The Roboclaw stops answering once the dispense commands are in its buffer
+class UnpluggedAfterSend:
+    def _settle_sale(self, sale_id):
+        super()._settle_sale(sale_id)
+        def unplugged(address):
+            raise OSError('Roboclaw unplugged')
+        self.roboclaw.ReadBuffers = unplugged
+
+class UnpluggedVending_Machine(UnpluggedAfterSend, Vending_Machine):
+    pass
+
+class UnpluggedAsync_Vending_Machine(UnpluggedAfterSend, Async_Vending_Machine):
+    pass
+
+# The reader refuses AUTH_REQ, as it does when out of sequence
+class RefusesAuthReq:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        send_command = self.ePort.send_command
+        def refuse_auth_req(command, data = []):
+            if command == ePort.AUTH_REQ:
+                return ('\x15', 'NAK', 'command not acknowleged', [], None)
+            return send_command(command, data)
+        self.ePort.send_command = refuse_auth_req
+
+class RefusingVending_Machine(RefusesAuthReq, Vending_Machine):
+    pass
+
+class RefusingAsync_Vending_Machine(RefusesAuthReq, Async_Vending_Machine):
+    pass
+
+@pytest.fixture
+def kiosk(request):
+    kiosk = SimulatedKiosk(seed = 1, machine_class = getattr(request, 'param', Vending_Machine))
+    yield kiosk
+    kiosk.close()
+
+def stays_on(kiosk, text, seconds = 5):
+    deadline = hal.clock.monotonic() + seconds
+    while hal.clock.monotonic() < deadline:
+        if not kiosk.screen_shows(text):
+            return False
+        hal.clock.sleep(.1)
+    return True
+
+@pytest.mark.parametrize('kiosk', [DoubleTapVending_Machine], indirect = True)
+def test_double_tap_does_not_confirm(kiosk):
+    kiosk.wait_for_screen(SELECT_PRODUCT_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(SELECT_AMOUNT_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(CONFIRM_TEXT)
+    assert stays_on(kiosk, CONFIRM_TEXT)
+    kiosk.press('2')
+    kiosk.wait_for_screen(SELECT_PRODUCT_TEXT)
+    assert kiosk.machine.journal.state_counts() == {}
+
+@pytest.mark.parametrize('kiosk', [Vending_Machine, Async_Vending_Machine], indirect = True)
+def test_keys_pressed_during_thank_you_do_not_start_the_next_customer(kiosk):
+    kiosk.wait_for_screen(SELECT_PRODUCT_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(SELECT_AMOUNT_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(CONFIRM_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(THANK_YOU_TEXT)
+    kiosk.machine.keypad.events.put(KeyEvent('2', PRESS, hal.clock.monotonic()))
+    # A carried over key would hold the amount screen for its 30 s timeout
+    kiosk.wait_for_screen(SELECT_PRODUCT_TEXT, timeout = 10)
+    assert stays_on(kiosk, SELECT_PRODUCT_TEXT)
+
+@pytest.mark.parametrize('kiosk', [UnpluggedVending_Machine, UnpluggedAsync_Vending_Machine], indirect = True)
+def test_failure_after_settlement_started_is_refunded(kiosk):
+    kiosk.wait_for_screen(SELECT_PRODUCT_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(SELECT_AMOUNT_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(CONFIRM_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(FAILED_TEXT)
+    # The vend loop carries on with the next customer
+    kiosk.wait_for_screen(SELECT_PRODUCT_TEXT)
+    assert kiosk.machine.settlement_worker.wait_drained(60)
+    [(_, _, _, _, state, transaction_id, error)] = kiosk.machine.journal.dispense_errors()
+    assert (state, error) == (REFUND_DUE, 'Roboclaw unplugged')
+    assert transaction_id is not None
+    assert kiosk.roboclaw.motors[0].target_speed == 0
+
+@pytest.mark.parametrize('kiosk', [RefusingVending_Machine, RefusingAsync_Vending_Machine], indirect = True)
+def test_refused_auth_req_does_not_wait_for_a_card(kiosk):
+    kiosk.wait_for_screen(SELECT_PRODUCT_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(SELECT_AMOUNT_TEXT)
+    kiosk.press('1')
+    kiosk.wait_for_screen(CONFIRM_TEXT)
+    kiosk.press('1')
+    # Waiting for the card would hold the swipe screen for 30 s
+    kiosk.wait_for_screen(SELECT_PRODUCT_TEXT, timeout = 10)
+    assert kiosk.machine.journal.state_counts() == {}
+
+# The cycle ends at the re-arm after the dispense, not a later one
+def test_cycle_ends_at_the_next_re_arm(kiosk):
+    machine = kiosk.machine
+    assert hal.clock.wait(machine.ePort_ready, 60)
+    # As settling the sale does
+    machine._rearm_ePort_in_background()
+    begin_time = hal.clock.monotonic() - 3
+    machine._end_cycle(begin_time, begin_time + 1, begin_time + 2)
+    assert hal.clock.wait(machine.ePort_ready, 60)
+    ready_time = machine.ePort_ready_time
+    machine._rearm_ePort_in_background()
+    assert hal.clock.wait(machine.ePort_ready, 60)
+    assert machine.ePort_ready_time > ready_time
+    assert machine.cycle_times == [ready_time - begin_time]
@@ -0,0 +1,211 @@
+import sqlite3
+import threading
+import traceback
+import hal
+from ePort import ePort, ePortCRCError, ePortTimeoutError
+
+# Sale states
+AUTHORIZED = 'authorized'         # card approved, dispense not finished
+READY = 'ready'                   # dispensed, waiting to be settled with the ePort
+SUBMITTED = 'submitted'           # TRANSACTION_RESULT sent, waiting for the transaction ID
+SETTLED = 'settled'               # ePort reported a transaction ID
+DISPENSE_FAILED = 'dispense_failed'
+INTERRUPTED = 'interrupted'       # machine stopped between authorization and dispense result
+ABANDONED = 'abandoned'           # settlement retries exhausted, kept for review
+REFUND_DUE = 'refund_due'         # settled, but the dispense failed after settlement started
+REFUNDED = 'refunded'             # refund_due sale refunded by the operator
+
+# Append-only record of sales in an SQLite database in WAL mode with
+# synchronous=FULL, so every state change is on disk before it returns
+class TransactionJournal:
+    def __init__(self, journal_file_path):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(journal_file_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=FULL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS sales (
+                                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                        created REAL NOT NULL,
+                                        updated REAL NOT NULL,
+                                        product TEXT NOT NULL,
+                                        amount TEXT NOT NULL,
+                                        price INTEGER NOT NULL,
+                                        state TEXT NOT NULL,
+                                        attempts INTEGER NOT NULL DEFAULT 0,
+                                        transaction_id TEXT,
+                                        last_error TEXT,
+                                        dispense_error TEXT
+                                    )''')
+        # Journals written before dispense_error
+        if 'dispense_error' not in [column[1] for column in self._connection.execute('PRAGMA table_info(sales)')]:
+            self._connection.execute('ALTER TABLE sales ADD COLUMN dispense_error TEXT')
+        # Sales that never got a dispense result cannot be settled safely
+        self._execute('UPDATE sales SET state = ?, updated = ? WHERE state = ?', (INTERRUPTED, hal.clock.time(), AUTHORIZED))
+
+    def _execute(self, statement, parameters=()):
+        with self._lock:
+            return self._connection.execute(statement, parameters)
+
+    def record_sale(self, product, amount, price):
+        now = hal.clock.time()
+        cursor = self._execute('INSERT INTO sales (created, updated, product, amount, price, state) VALUES (?, ?, ?, ?, ?, ?)',
+                               (now, now, product, amount, price, AUTHORIZED))
+        return cursor.lastrowid
+
+    # error: why a failed dispense failed, kept in last_error for review
+    def mark_dispensed(self, sale_id, success=True, error=None):
+        self._execute('UPDATE sales SET state = ?, updated = ?, last_error = ? WHERE id = ?',
+                      (READY if success else DISPENSE_FAILED, hal.clock.time(), error, sale_id))
+
+    # A dispense that failed after its sale went to settlement, e.g. a jam.
+    # Settlement is not stopped: a settled sale becomes REFUND_DUE now, one
+    # still being settled when mark_settled is called.
+    def mark_dispense_error(self, sale_id, error):
+        self._execute('UPDATE sales SET state = CASE state WHEN ? THEN ? ELSE state END, updated = ?, dispense_error = ? WHERE id = ?',
+                      (SETTLED, REFUND_DUE, hal.clock.time(), error, sale_id))
+
+    def mark_settled(self, sale_id, transaction_id):
+        self._execute('UPDATE sales SET state = CASE WHEN dispense_error IS NULL THEN ? ELSE ? END, updated = ?, transaction_id = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?',
+                      (SETTLED, REFUND_DUE, hal.clock.time(), transaction_id, sale_id))
+
+    # Returns False unless the sale was REFUND_DUE
+    def mark_refunded(self, sale_id):
+        cursor = self._execute('UPDATE sales SET state = ?, updated = ? WHERE id = ? AND state = ?', (REFUNDED, hal.clock.time(), sale_id, REFUND_DUE))
+        return cursor.rowcount == 1
+
+    # A submitted sale is never sent back to READY, so its TRANSACTION_RESULT
+    # is not sent twice
+    def mark_submitted(self, sale_id):
+        self._execute('UPDATE sales SET state = ?, updated = ? WHERE id = ?', (SUBMITTED, hal.clock.time(), sale_id))
+
+    # Keeps the sale's state unless abandon
+    def mark_attempt_failed(self, sale_id, error, abandon=False):
+        self._execute('UPDATE sales SET state = COALESCE(?, state), updated = ?, attempts = attempts + 1, last_error = ? WHERE id = ?',
+                      (ABANDONED if abandon else None, hal.clock.time(), error, sale_id))
+
+    # (id, price, attempts, state) of dispensed sales awaiting settlement,
+    # oldest first
+    def pending(self):
+        return self._execute('SELECT id, price, attempts, state FROM sales WHERE state IN (?, ?) ORDER BY id', (READY, SUBMITTED)).fetchall()
+
+    # {state: number of sales}
+    def state_counts(self):
+        return dict(self._execute('SELECT state, COUNT(*) FROM sales GROUP BY state').fetchall())
+
+    def sale(self, sale_id):
+        return self._execute('SELECT id, product, amount, price, state, attempts, transaction_id, last_error, dispense_error FROM sales WHERE id = ?', (sale_id,)).fetchone()
+
+    # (id, product, amount, price, state, transaction_id, dispense_error) of
+    # sales whose dispense failed after settlement started, oldest first.
+    # Those in REFUND_DUE were charged.
+    def dispense_errors(self):
+        return self._execute('SELECT id, product, amount, price, state, transaction_id, dispense_error FROM sales WHERE dispense_error IS NOT NULL ORDER BY id').fetchall()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+# Drains READY sales to the ePort in the background: TRANSACTION_RESULT, then
+# ACQUIRE_TRANSACTION_ID and a wait for the TRANSACTION_ID status. Network and
+# server failures are retried with exponential backoff; a SUBMITTED sale only
+# asks for the transaction ID again.
+class SettlementWorker:
+    FAILURE_CODES = ('30', '31', '32')
+
+    def __init__(self, journal, eport, watcher, settle_timeout=30, retry_interval=2, max_retry_interval=60, max_attempts=20):
+        self.journal = journal
+        self.ePort = eport
+        self.watcher = watcher
+        self.settle_timeout = settle_timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self._wake_event = threading.Event()
+        self._drained_event = threading.Event()
+        # Held from the pending() check to setting drained, so a notify() in
+        # between cannot be undone
+        self._drained_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='SettlementWorker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Call after a sale is marked dispensed
+    def notify(self):
+        with self._drained_lock:
+            self._drained_event.clear()
+        self._wake_event.set()
+
+    # The ePort holds one authorization at a time, so a new AUTH_REQ has to wait
+    # until earlier sales are settled; returns False if timeout passes first
+    def wait_drained(self, timeout=None):
+        return hal.clock.wait(self._drained_event, timeout)
+
+    def _settle(self, sale_id, price, state):
+        waiter = self.watcher.expect(('17',) + SettlementWorker.FAILURE_CODES)
+        transaction_id = None
+        try:
+            if state == READY:
+                try:
+                    response = self.ePort.send_command(ePort.TRANSACTION_RESULT, ['1', '1', str(price), '999', 'print'])
+                except (ePortTimeoutError, ePortCRCError):
+                    # The reader may have taken it, so it counts as submitted
+                    response = None
+                if response is not None and response[1] != 'ACK':
+                    self.watcher.cancel(waiter)
+                    return None, f"TRANSACTION_RESULT {response[1]}"
+                self.journal.mark_submitted(sale_id)
+            response = self.ePort.send_command(ePort.ACQUIRE_TRANSACTION_ID)
+            if response[1] != 'ACK':
+                self.watcher.cancel(waiter)
+                return None, f"ACQUIRE_TRANSACTION_ID {response[1]}"
+            status = waiter.wait(self.settle_timeout)
+            if status is None:
+                self.watcher.cancel(waiter)
+                return None, 'No transaction ID before settle timeout'
+            if status.code != '17':
+                return None, status.name
+            transaction_id = status.values['transaction_id']
+            self.ePort.send_command(ePort.DISABLE)
+        except (ePortTimeoutError, ePortCRCError) as error:
+            self.watcher.cancel(waiter)
+            # Settled all the same, _rearm_ePort disables the reader
+            if transaction_id is not None:
+                return transaction_id, None
+            return None, str(error)
+        return transaction_id, None
+
+    def _run(self):
+        retry_interval = self.retry_interval
+        while not self._stop_event.is_set():
+            self._wake_event.clear()
+            with self._drained_lock:
+                pending = self.journal.pending()
+                if not pending:
+                    self._drained_event.set()
+            if not pending:
+                self._wake_event.wait()
+                continue
+            self._drained_event.clear()
+            sale_id, price, attempts, state = pending[0]
+            try:
+                transaction_id, error = self._settle(sale_id, price, state)
+            except Exception:
+                transaction_id, error = None, traceback.format_exc(limit=1)
+            if transaction_id is not None:
+                self.journal.mark_settled(sale_id, transaction_id)
+                retry_interval = self.retry_interval
+                continue
+            self.journal.mark_attempt_failed(sale_id, error, attempts + 1 >= self.max_attempts)
+            hal.clock.wait(self._wake_event, retry_interval)
+            retry_interval = min(retry_interval * 2, self.max_retry_interval)
@@ -1,9 +1,16 @@
-import time
 import math
+import os
+import threading
+import hal
 from I2C_LCD_driver import lcd
-from roboclaw_zwv import Roboclaw_zwv
-from keypad import keypad
-from ePort import ePort
+from lcd_framebuffer import LcdFramebuffer
+from lcd_renderer import LcdRenderer
+from lcd_screens import ScreenRegistry
+from roboclaw_zwv import Roboclaw_zwv, RoboclawMotionTimeoutError
+from keypad import keypad, INTERRUPT
+from ePort import ePort, ePortCRCError, ePortTimeoutError
+from ePort_watcher import ePortStatusWatcher
+from transaction_journal import TransactionJournal, SettlementWorker
 
 roboclaw_serial_port = "/dev/ttyACM0"
 roboclaw_baud_rate = 38400
@@ -12,6 +19,25 @@ roboclaw_address = 0x80
 ePort_serial_port = "/dev/ttyUSB0"
 ePort_baud_rate = 9600
 
+log_directory = "../../Logs"
+transaction_journal_file_name = "transactions.sqlite3"
+vend_cycle_log_file_name = "vend_cycles.csv"
+
+# A dispense normally takes about 8 s; past this the auger is taken to be
+# jammed and the motor is stopped
+dispense_motion_timeout = 20
+
+# Thank-you screen stays up at least the minimum and at most the maximum,
+# leaving earlier once the machine is ready for the next customer
+thank_you_min_time = 2
+thank_you_max_time = 5
+
+# A customer waits at most this long for the reader to be re-armed, e.g.
+# while settlement retries without a network, before the out-of-service
+# screen is shown for out_of_service_time
+ePort_ready_timeout = 20
+out_of_service_time = 5
+
 products = {
                 '1': 'Lucky Charms',
                 '2': 'Fruit Loops'
@@ -39,12 +65,15 @@ confirmations = {
               }
 
 class Vending_Machine:
-    def __init__(self):
+    def __init__(self, log_directory = log_directory):
         self.lcd = lcd()
-        self.lcd.lcd_clear()
-        self.lcd.lcd_display_string("Booting...", 2, 5)
+        # Screens are drawn on the renderer thread, show() never waits on the bus
+        self.display = LcdRenderer(LcdFramebuffer(self.lcd))
+        self.display.start()
+        self._compile_screens()
+        self.display.show_screen(self.screens.render('booting'))
         
-        self.roboclaw = Roboclaw_zwv(roboclaw_serial_port, roboclaw_baud_rate)
+        self.roboclaw = Roboclaw_zwv(roboclaw_serial_port, roboclaw_baud_rate, log_file_dir = log_directory)
         if not self.roboclaw.Open():
             raise Exception(f"Unable to open port {roboclaw_serial_port}")
         
@@ -52,118 +81,211 @@ class Vending_Machine:
         if not self.ePort.Open():
             raise Exception(f"Unable to open port {ePort_serial_port}")
         self.ePort.send_command(ePort.DISABLE)
+        self.ePort_watcher = ePortStatusWatcher(self.ePort)
+        self.ePort_watcher.start()
+
+        self.journal = TransactionJournal(os.path.join(log_directory, transaction_journal_file_name))
+        self.settlement_worker = SettlementWorker(self.journal, self.ePort, self.ePort_watcher)
+        self.settlement_worker.start()
+        self.ePort_ready = threading.Event()
+        self._rearm_lock = threading.Lock()
+        self._rearming = False
+        # (begin_time, authorized_time, dispensed_time) of vend cycles that end
+        # with the next re-arm
+        self._cycles_awaiting_ready = []
+        self._rearm_ePort_in_background()
         
-        self.keypad = keypad()
+        # Scans only after a column edge, the Pi stays idle between customers
+        self.keypad = keypad(mode = INTERRUPT)
+        self.keypad.start()
         self.pressed_keys = []
+        self.cycle_times = []
+        self.jams = 0
+        self.vend_cycle_log_path = os.path.join(log_directory, vend_cycle_log_file_name)
         
+    # Screens are compiled into I2C byte sequences once; call again after
+    # changing products or amounts
+    def _compile_screens(self):
+        self.screens = ScreenRegistry()
+        self.screens.register('booting', [("Booting...", 2, 5)])
+        self.screens.register('select_product', [("Please select", 2, 5), ("product", 3, 6)])
+        self.screens.register('select_amount', [(f"{key}: {description}", line, 4) for line, (key, description) in enumerate(amount_descriptions.items(), 1)])
+        self.screens.register('confirm', [("1-confirm 2-cancel", 4, 0)], {'amount': (1, 0, 20), 'product': (2, 0, 20), 'price': (3, 0, 20)})
+        self.screens.register('please_wait', [('Please wait...', 2, 3)])
+        self.screens.register('swipe_card', [('Please swipe card...', 1, 0)])
+        self.screens.register('dispensing', [('Dispensing...', 1, 0)])
+        self.screens.register('thank_you', [('Thank you for ', 2, 3), ('your purchase!', 3, 3)])
+        self.screens.register('purchase_failed', [('Something went wrong', 2, 0), ('Purchase cancelled', 3, 0)])
+        self.screens.register('out_of_service', [('Out of service', 2, 3), ('Please try later', 3, 2)])
+
+    # Each customer starts without the keys pressed during the last one
     def _get_product_selection(self, wait_time = 30):
-        self.lcd.lcd_clear()
-        self.lcd.lcd_display_string("Please select", 2, 5)
-        self.lcd.lcd_display_string("product", 3, 6)
+        self.keypad.clear_events()
+        self.display.show_screen(self.screens.render('select_product'))
         
-        begin_time = time.time()
-        while True:
-            time.sleep(.1)
-            if (wait_time > 0) and (time.time() - begin_time) > wait_time:
-                return None
-            pressed_keys = self.keypad.pressed_keys()
-            if len(pressed_keys) != 1:
-                continue
-            if pressed_keys[0] not in products:
-                continue
-            return pressed_keys[0]
+        return self.keypad.get_key(products, wait_time if wait_time > 0 else None)
     
     def _get_amount_selection(self, wait_time = 30):
-        self.lcd.lcd_clear()
-        self.lcd.lcd_display_string("1: 1/2 cup", 1, 4)
-        self.lcd.lcd_display_string("2: 1 cup", 2, 4)
-        self.lcd.lcd_display_string("3: 1 1/2 cup", 3, 4)
-        self.lcd.lcd_display_string("4: 2 cups", 4, 4)
+        self.display.show_screen(self.screens.render('select_amount'))
         
-        begin_time = time.time()
-        while True:
-            time.sleep(.1)
-            if (wait_time > 0) and (time.time() - begin_time) > wait_time:
-                return None
-            pressed_keys = self.keypad.pressed_keys()
-            if len(pressed_keys) != 1:
-                continue
-            if pressed_keys[0] not in amounts:
-                continue
-            return pressed_keys[0]
+        return self.keypad.get_key(amounts, wait_time if wait_time > 0 else None)
     
+    # Only a key pressed once the price is on screen confirms; the amount
+    # screen keeps type-ahead
     def _get_selection_confirmation(self, wait_time = 30):
-        self.lcd.lcd_clear()
-        self.lcd.lcd_display_string(amount_descriptions[self.amount_selection] + ' of ', 1)
-        self.lcd.lcd_display_string(products[self.product_selection], 2)
-        self.lcd.lcd_display_string(f'${self.selection_price/100:0.2f}', 3)
-        self.lcd.lcd_display_string("1-confirm 2-cancel", 4)
+        self.keypad.clear_events()
+        self.display.show_screen(self.screens.render('confirm',
+                                                     amount = amount_descriptions[self.amount_selection] + ' of ',
+                                                     product = products[self.product_selection],
+                                                     price = f'${self.selection_price/100:0.2f}'))
         
-        begin_time = time.time()
-        while True:
-            time.sleep(.1)
-            if (wait_time > 0) and (time.time() - begin_time) > wait_time:
-                return None
-            pressed_keys = self.keypad.pressed_keys()
-            if len(pressed_keys) != 1:
-                continue
-            if pressed_keys[0] not in confirmations:
-                continue
-            return pressed_keys[0]
+        return self.keypad.get_key(confirmations, wait_time if wait_time > 0 else None)
         
     def _authorize_payment(self, wait_time = 30):
-        auth_req_response = self.ePort.send_command(ePort.AUTH_REQ, [str(self.selection_price)])
-        self.lcd.lcd_clear()
-        self.lcd.lcd_display_string('Please swipe card...', 1)
-
-        begin_time = time.time()
-        while True:
-            status = self.ePort.send_command(ePort.STATUS)
-            if status[0] == "2":
-                return True
-            if status[0] == "3":
-                return False
-            if (wait_time > 0) and (time.time() - begin_time) > wait_time:
+        # The reader holds one sale at a time, usually settled and re-armed
+        # while the customer chose
+        if not self.ePort_ready.is_set():
+            self.display.show_screen(self.screens.render('please_wait'))
+            # The last re-arm may have given up on settlement
+            self._rearm_ePort_in_background()
+            if not hal.clock.wait(self.ePort_ready, ePort_ready_timeout):
+                self.display.show_screen(self.screens.render('out_of_service'))
+                hal.clock.sleep(out_of_service_time)
                 return None
-            time.sleep(.5)
+        waiter = self.ePort_watcher.expect(("2", "3"))
+        try:
+            auth_req_response = self.ePort.send_command(ePort.AUTH_REQ, [str(self.selection_price)])
+        except (ePortTimeoutError, ePortCRCError):
+            # vend_loop re-arms the reader and goes back to product selection
+            self.ePort_watcher.cancel(waiter)
+            return None
+        if auth_req_response[1] != 'ACK':
+            # NAK or INVALID_CMD, no authorization status is coming
+            self.ePort_watcher.cancel(waiter)
+            return None
+        self.display.show_screen(self.screens.render('swipe_card'))
+
+        status = waiter.wait(wait_time if wait_time > 0 else None)
+        if status is None:
+            self.ePort_watcher.cancel(waiter)
+            return None
+        return status.code == "2"
             
-    def _dispense_product(self):
-        self.lcd.lcd_clear()
-        self.lcd.lcd_display_string('Dispensing...', 1)
-        self.roboclaw.execute_buffered_commands_with_logging(roboclaw_address,
-                                                    [
-                                                        lambda : self.roboclaw.SpeedDistanceM1(roboclaw_address, 200, 1400, 0),
-                                                        lambda : self.roboclaw.SpeedDistanceM1(roboclaw_address, 100, 50, 0)
-                                                    ]
-                                                    )
+    # Settlement starts as soon as the motor has accepted the dispense
+    # commands instead of after it stops
+    def _dispense_product(self, sale_id):
+        self.display.show_screen(self.screens.render('dispensing'))
+        commands_sent = threading.Event()
+        def settle():
+            commands_sent.set()
+            self._settle_sale(sale_id)
+        try:
+            self.roboclaw.execute_buffered_commands_with_logging(roboclaw_address, self._dispense_commands(), on_commands_sent = settle,
+                                                                 motion_timeout = dispense_motion_timeout)
+        except RoboclawMotionTimeoutError as error:
+            # The sale is already being settled, the journal marks it
+            # REFUND_DUE; M1 was stopped before the raise
+            self.jams += 1
+            self.journal.mark_dispense_error(sale_id, str(error))
+            return False
+        except Exception as error:
+            if not commands_sent.is_set():
+                self.journal.mark_dispensed(sale_id, False, str(error))
+                self._rearm_ePort_in_background()
+                return False
+            # Settlement has started, handled as a jam
+            self.journal.mark_dispense_error(sale_id, str(error))
+            self._stop_motor()
+            return False
         return True
+
+    # Best effort, the Roboclaw may be what failed
+    def _stop_motor(self):
+        try:
+            with self.roboclaw.port_lock:
+                self.roboclaw.DutyM1(roboclaw_address, 0)
+        except Exception:
+            pass
+
+    def _dispense_commands(self):
+        return [
+                    lambda : self.roboclaw.SpeedDistanceM1(roboclaw_address, 200, 1400, 0),
+                    lambda : self.roboclaw.SpeedDistanceM1(roboclaw_address, 100, 50, 0)
+               ]
+
+    def _settle_sale(self, sale_id):
+        self.journal.mark_dispensed(sale_id)
+        self.settlement_worker.notify()
+        self._rearm_ePort_in_background()
+
+    # Once earlier sales are settled, puts the reader back in the disabled
+    # state expected before AUTH_REQ and sets ePort_ready. Gives up after
+    # ePort_ready_timeout while settlement keeps retrying, leaving
+    # ePort_ready clear for _authorize_payment to try again.
+    def _rearm_ePort(self):
+        ready = False
+        cycles = []
+        try:
+            if self.settlement_worker.wait_drained(ePort_ready_timeout):
+                ePort_status = self.ePort_watcher.status
+                if ePort_status == '9':
+                    waiter = self.ePort_watcher.expect(('0', '6'))
+                    self.ePort.send_command(ePort.RESET)
+                elif ePort_status != '6':
+                    waiter = self.ePort_watcher.expect(('6',))
+                    self.ePort.send_command(ePort.DISABLE)
+                else:
+                    waiter = None
+                if waiter is not None and waiter.wait(3) is None:
+                    self.ePort_watcher.cancel(waiter)
+                ready = True
+        finally:
+            with self._rearm_lock:
+                self._rearming = False
+                if ready:
+                    ready_time = self.ePort_ready_time = hal.clock.monotonic()
+                    self.ePort_ready.set()
+                    cycles, self._cycles_awaiting_ready = self._cycles_awaiting_ready, []
+            for cycle in cycles:
+                self._record_cycle(*cycle, ready_time)
+
+    # At most one re-arm runs at a time. One already running is still valid:
+    # no AUTH_REQ can be sent before it sets ePort_ready.
+    def _rearm_ePort_in_background(self):
+        with self._rearm_lock:
+            self.ePort_ready.clear()
+            if self._rearming:
+                return
+            self._rearming = True
+        threading.Thread(target=self._rearm_ePort, name='ePortRearm', daemon=True).start()
+
+    # Cycle time runs from product selection until the machine can take the
+    # next customer: motor stopped, sale settled and reader re-armed. Settling
+    # the sale started a re-arm, the cycle is recorded when it finishes.
+    def _end_cycle(self, begin_time, authorized_time, dispensed_time):
+        with self._rearm_lock:
+            if not self.ePort_ready.is_set():
+                self._cycles_awaiting_ready.append((begin_time, authorized_time, dispensed_time))
+                return
+            ready_time = self.ePort_ready_time
+        self._record_cycle(begin_time, authorized_time, dispensed_time, ready_time)
+
+    def _record_cycle(self, begin_time, authorized_time, dispensed_time, ready_time):
+        ready_time = max(dispensed_time, ready_time)
+        cycle_time = ready_time - begin_time
+        self.cycle_times.append(cycle_time)
+        with open(self.vend_cycle_log_path, 'a') as file:
+            file.write(f"{hal.clock.time()},{authorized_time - begin_time},{dispensed_time - authorized_time},{ready_time - dispensed_time},{cycle_time}\n")
     
-    def _send_transaction_result(self):
-        self.ePort.send_command(ePort.TRANSACTION_RESULT, ['1', '1', str(self.selection_price), '999', 'print'])
-        self.ePort.send_command(ePort.ACQUIRE_TRANSACTION_ID)
-        status = self.ePort.send_command(ePort.STATUS)
-        while status[0] != "17":
-            status = self.ePort.send_command(ePort.STATUS)
-            time.sleep(.1)
-        return status[3][0]
-            
-        
     def vend_loop(self):
         while True:
-            ePort_status = self.ePort.send_command(ePort.STATUS)
-            if ePort_status == '9':
-                self.ePort.send_command(ePort.RESET)
-                time.sleep(3)
-            elif ePort_status != '6':
-                self.ePort.send_command(ePort.DISABLE)
-                time.sleep(3)
-            
             self.product_selection = self._get_product_selection(0)
             if not self.product_selection:
                 continue
+            begin_time = hal.clock.monotonic()
             
             self.amount_selection = self._get_amount_selection()
-            if not self.product_selection:
+            if not self.amount_selection:
                 continue
             
             self.selection_price = math.ceil(100 * prices[self.product_selection] * amounts[self.amount_selection])
@@ -173,25 +295,20 @@ class Vending_Machine:
                 continue
             
             if not self._authorize_payment():
+                self._rearm_ePort_in_background()
                 continue
+            authorized_time = hal.clock.monotonic()
             
-            if self._dispense_product():
-                transaction_ID = self._send_transaction_result()
-                self.ePort.send_command(ePort.DISABLE)
-                self.lcd.lcd_clear()
-                self.lcd.lcd_display_string('Thank you for ', 2, 3)
-                self.lcd.lcd_display_string('your purchase!', 3, 3)
-                time.sleep(5)
+            sale_id = self.journal.record_sale(products[self.product_selection], amount_descriptions[self.amount_selection], self.selection_price)
+            if self._dispense_product(sale_id):
+                dispensed_time = hal.clock.monotonic()
+                self.display.show_screen(self.screens.render('thank_you'))
+                hal.clock.sleep(thank_you_min_time - (hal.clock.monotonic() - dispensed_time))
+                hal.clock.wait(self.ePort_ready, thank_you_max_time - (hal.clock.monotonic() - dispensed_time))
+                self._end_cycle(begin_time, authorized_time, dispensed_time)
             else:
-                self.lcd.lcd_clear()
-                self.lcd.lcd_display_string('Something went wrong', 2)
-                self.lcd.lcd_display_string('Purchase cancelled', 3)
-                self.ePort.send_command(ePort.RESET)
-                time.sleep(5)
-
-            self.lcd.lcd_clear()
-            self.lcd.lcd_display_string('More to come...', 1)
-            time.sleep(5)
+                self.display.show_screen(self.screens.render('purchase_failed'))
+                hal.clock.sleep(5)
 
 
 if __name__ == '__main__':